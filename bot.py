@@ -4,19 +4,435 @@ from discord.ext import commands, tasks
 from discord.ui import Button, View, Select
 import os
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2 import pool as pg_pool
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque, namedtuple
 from datetime import datetime, timedelta
 import json
+import re
+import struct
+import array
 import asyncio
+import bisect
+import csv
+import functools
+import hashlib
+import io
+import random
+import signal
+import threading
+import time
+import unicodedata
+import uuid
 
 intents = discord.Intents.default()
 intents.members = True
 intents.message_content = True
 intents.guilds = True
+intents.moderation = True
 intents.message_content = True
 
-def get_db():
-    return psycopg2.connect(os.getenv('DATABASE_URL'))
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '2'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv('DB_POOL_ACQUIRE_TIMEOUT', '5'))
+DB_SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', '250'))
+CONFIG_NOTIFY_CHANNEL = 'bot_config_changed'
+INSTANCE_ID = uuid.uuid4().hex
+ACTIVITY_LOG_BUFFER_SIZE = int(os.getenv('ACTIVITY_LOG_BUFFER_SIZE', '50000'))
+ACTIVITY_LOG_BATCH_SIZE = int(os.getenv('ACTIVITY_LOG_BATCH_SIZE', '500'))
+ACTIVITY_LOG_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_LOG_FLUSH_INTERVAL', '2'))
+WRITE_BEHIND_MAX_RETRIES = 3
+AUDIT_LOG_TTL = 60
+AUDIT_LOG_WAIT = float(os.getenv('AUDIT_LOG_WAIT', '2'))
+CHANNEL_EDIT_CONCURRENCY = int(os.getenv('CHANNEL_EDIT_CONCURRENCY', '10'))
+CHANNEL_EDIT_RATE = float(os.getenv('CHANNEL_EDIT_RATE', '40'))
+LOCKDOWN_JOB_BATCH_SIZE = 25
+LOCKDOWN_ITEM_LEASE = 60
+JOIN_WAVE_WINDOW = float(os.getenv('JOIN_WAVE_WINDOW', '3600'))
+JOIN_WAVE_MAX_JOINS = int(os.getenv('JOIN_WAVE_MAX_JOINS', '10000'))
+BLOCKLIST_PATH = os.getenv('BLOCKLIST_PATH', 'blocklist.txt')
+BLOCKLIST_RELOAD_INTERVAL = float(os.getenv('BLOCKLIST_RELOAD_INTERVAL', '30'))
+AUTOMOD_MAX_USERS = int(os.getenv('AUTOMOD_MAX_USERS', '50000'))
+AUTOMOD_IDLE_SECONDS = float(os.getenv('AUTOMOD_IDLE_SECONDS', '600'))
+RAID_MODE_QUIET_SECONDS = float(os.getenv('RAID_MODE_QUIET_SECONDS', '120'))
+GUILD_SNAPSHOT_INTERVAL = float(os.getenv('GUILD_SNAPSHOT_INTERVAL', '60'))
+GUILD_SNAPSHOT_KEEP = int(os.getenv('GUILD_SNAPSHOT_KEEP', '24'))
+
+class Metrics:
+    """In-process counters and latency stats, shown by /botmetrics"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+    
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+    
+    def observe(self, name, seconds):
+        with self._lock:
+            stat = self.timings.setdefault(name, [0, 0.0, 0.0])
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] = max(stat[2], seconds)
+    
+    def snapshot(self):
+        """Return (counters, timings) where timings map name -> (count, avg_ms, max_ms)"""
+        with self._lock:
+            counters = dict(self.counters)
+            timings = {
+                name: (count, total / count * 1000 if count else 0.0, peak * 1000)
+                for name, (count, total, peak) in self.timings.items()
+            }
+        return counters, timings
+
+metrics = Metrics()
+
+class AsyncCursor:
+    """Async facade over a pooled psycopg2 cursor; statements run on the database executor"""
+    
+    def __init__(self, database, cur):
+        self._database = database
+        self._cur = cur
+    
+    async def execute(self, query, params=None):
+        await self._database.run(self._timed_execute, query, params)
+    
+    def _timed_execute(self, query, params):
+        started = time.perf_counter()
+        try:
+            self._cur.execute(query, params)
+        finally:
+            self._database.record_query(query, time.perf_counter() - started)
+    
+    async def call(self, fn, *args):
+        """Run fn(cursor, *args) on the executor, for helpers like execute_values"""
+        started = time.perf_counter()
+        try:
+            return await self._database.run(fn, self._cur, *args)
+        finally:
+            metrics.observe('db.query', time.perf_counter() - started)
+    
+    # psycopg2 buffers results client-side, so fetching never touches the network
+    def fetchone(self):
+        return self._cur.fetchone()
+    
+    def fetchall(self):
+        return self._cur.fetchall()
+    
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+class DatabasePool:
+    """Shared PostgreSQL connection pool, opened once in setup_hook and closed on shutdown.
+    
+    Callers wait for a free connection on the event loop, and only then hand statements to
+    a thread pool sized to the connection pool. A worker thread is therefore never parked
+    waiting for a connection, so a queue of waiting callers can't starve the callers that
+    already hold one.
+    """
+    
+    def __init__(self, dsn, min_size, max_size, acquire_timeout):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self._pool = None
+        self._slots = None
+        self._executor = None
+        self._loop = None
+        self._bound = threading.local()
+    
+    def open(self):
+        if self._pool is not None:
+            return
+        self._pool = pg_pool.ThreadedConnectionPool(self.min_size, self.max_size, self.dsn)
+        # min_size connections are opened up front, but putconn closes a returned connection
+        # once minconn are idle, which would reconnect on every checkout above min_size.
+        # minconn is only read there after startup, so raising it keeps all of them open.
+        self._pool.minconn = self.max_size
+        self._slots = asyncio.BoundedSemaphore(self.max_size)
+        self._loop = asyncio.get_running_loop()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_size, thread_name_prefix='db')
+    
+    def close(self):
+        if self._pool is None:
+            return
+        self._executor.shutdown(wait=True)
+        self._pool.closeall()
+        self._pool = None
+        self._slots = None
+        self._executor = None
+    
+    async def run(self, fn, *args):
+        """Run a blocking callable on the database executor"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args))
+    
+    def submit(self, fn, *args):
+        """Queue a blocking callable on the database executor without waiting for it"""
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._report_background_error)
+        return future
+    
+    @staticmethod
+    def _report_background_error(future):
+        if not future.cancelled() and future.exception():
+            print(f'Error in background database task: {future.exception()}')
+    
+    def record_query(self, query, elapsed):
+        metrics.observe('db.query', elapsed)
+        verb = query.lstrip().split(None, 1)[0].lower() if query.strip() else 'unknown'
+        metrics.observe(f'db.query.{verb}', elapsed)
+        if elapsed * 1000 >= DB_SLOW_QUERY_MS:
+            metrics.incr('db.slow_queries')
+            print(f'Slow query ({elapsed * 1000:.0f} ms): {" ".join(query.split())[:200]}')
+    
+    async def _acquire(self):
+        """Reserve a pool slot on the event loop, then check out a connection on the executor"""
+        if self._pool is None:
+            raise pg_pool.PoolError('Database pool is not open')
+        
+        # ThreadedConnectionPool fails immediately when exhausted, so callers queue on the slots instead
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            metrics.incr('db.acquire_timeouts')
+            raise pg_pool.PoolError(f'Timed out after {self.acquire_timeout}s waiting for a database connection')
+        metrics.observe('db.acquire', time.perf_counter() - started)
+        
+        checkout = self._executor.submit(self._getconn)
+        try:
+            return await asyncio.wrap_future(checkout)
+        except asyncio.CancelledError:
+            checkout.add_done_callback(self._release_abandoned)
+            raise
+        except BaseException:
+            self._slots.release()
+            raise
+    
+    def _getconn(self):
+        conn = self._pool.getconn()
+        if conn.closed:
+            self._pool.putconn(conn, close=True)
+            conn = self._pool.getconn()
+        return conn
+    
+    def _putconn(self, conn, discard=False):
+        self._pool.putconn(conn, close=discard or bool(conn.closed))
+    
+    def _release(self, conn, discard=False):
+        """Return a connection from the event loop thread"""
+        try:
+            self._putconn(conn, discard)
+        finally:
+            self._slots.release()
+    
+    def _release_later(self, future):
+        # Runs on a worker thread; the asyncio semaphore may only be touched from the loop
+        self._loop.call_soon_threadsafe(self._slots.release)
+    
+    def _release_abandoned(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self.submit(self._putconn, future.result()).add_done_callback(self._release_later)
+        else:
+            self._release_later(future)
+    
+    def _discard(self, conn):
+        """Abort whatever a worker may still be running on conn and throw the connection away"""
+        try:
+            conn.cancel()
+        except Exception:
+            pass
+        self.submit(self._putconn, conn, True).add_done_callback(self._release_later)
+    
+    @staticmethod
+    def _rollback(conn):
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+    
+    def _run_bound(self, conn, fn, args):
+        self._bound.conn = conn
+        try:
+            result = fn(*args)
+            conn.commit()
+            return result
+        except Exception:
+            self._rollback(conn)
+            raise
+        finally:
+            self._bound.conn = None
+    
+    async def run_sync(self, fn, *args):
+        """Run blocking fn(*args) on the executor with a connection reserved for it.
+        
+        sync_cursor() inside fn uses that connection. Commits when fn returns and rolls
+        back if it raises.
+        """
+        conn = await self._acquire()
+        try:
+            result = await self.run(self._run_bound, conn, fn, args)
+        except asyncio.CancelledError:
+            self._discard(conn)
+            raise
+        except BaseException:
+            self._release(conn)
+            raise
+        self._release(conn)
+        return result
+    
+    @contextmanager
+    def sync_cursor(self, dict_rows=False):
+        """Blocking cursor for code running under run_sync()"""
+        conn = getattr(self._bound, 'conn', None)
+        if conn is None:
+            raise pg_pool.PoolError('sync_cursor() can only be used inside db.run_sync()')
+        cur = conn.cursor(cursor_factory=RealDictCursor) if dict_rows else conn.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+    
+    @asynccontextmanager
+    async def cursor(self, dict_rows=False):
+        """Borrow a connection without blocking the event loop and yield an AsyncCursor.
+        
+        Commits when the block exits cleanly and rolls back on error. RealDictCursor
+        rows are returned when dict_rows is set.
+        """
+        conn = await self._acquire()
+        
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor) if dict_rows else conn.cursor()
+            try:
+                yield AsyncCursor(self, cur)
+            finally:
+                cur.close()
+            await self.run(conn.commit)
+        except asyncio.CancelledError:
+            # A worker thread may still be running a statement on this connection, so
+            # abort it server-side and throw the connection away instead of reusing it
+            self._discard(conn)
+            raise
+        except BaseException:
+            await self.run(self._rollback, conn)
+            self._release(conn)
+            raise
+        else:
+            self._release(conn)
+
+db = DatabasePool(os.getenv('DATABASE_URL'), DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_ACQUIRE_TIMEOUT)
+
+class WriteBehindBuffer:
+    """Bounded in-memory buffer of rows written to the database in batches by a background task.
+    
+    A flush runs when batch_size rows are waiting or flush_interval seconds have passed,
+    whichever comes first. When the buffer is full the oldest rows are dropped and counted.
+    A batch that fails WRITE_BEHIND_MAX_RETRIES times in a row is written one row at a time,
+    and rows the database rejects are dropped so one bad row can't hold up the rest.
+    """
+    
+    def __init__(self, name, write_rows, max_size, batch_size, flush_interval):
+        self.name = name
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._write_rows = write_rows
+        self._rows = deque()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._failures = 0
+    
+    def __len__(self):
+        return len(self._rows)
+    
+    def add(self, row):
+        self._rows.append(row)
+        self._trim()
+        if len(self._rows) >= self.batch_size:
+            self._wakeup.set()
+    
+    def _trim(self):
+        while len(self._rows) > self.max_size:
+            self._rows.popleft()
+            metrics.incr(f'{self.name}.dropped')
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Stop the background task and write out everything still buffered"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+    
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+    
+    async def flush(self):
+        async with self._flush_lock:
+            while self._rows:
+                batch = [self._rows.popleft() for _ in range(min(len(self._rows), self.batch_size))]
+                started = time.perf_counter()
+                rejected = 0
+                try:
+                    if self._failures >= WRITE_BEHIND_MAX_RETRIES:
+                        rejected = await db.run_sync(self._write_each, batch)
+                    else:
+                        await db.run_sync(self._write_batch, batch)
+                except Exception as e:
+                    print(f'Error flushing {self.name} ({len(batch)} rows): {e}')
+                    metrics.incr(f'{self.name}.flush_errors')
+                    self._failures += 1
+                    # Put the batch back in front so it is retried on the next flush
+                    self._rows.extendleft(reversed(batch))
+                    self._trim()
+                    return
+                self._failures = 0
+                if rejected:
+                    print(f'Dropped {rejected} {self.name} rows the database rejected')
+                    metrics.incr(f'{self.name}.rejected', rejected)
+                metrics.observe(f'{self.name}.flush', time.perf_counter() - started)
+                metrics.incr(f'{self.name}.flushed_rows', len(batch) - rejected)
+    
+    def _write_batch(self, batch):
+        with db.sync_cursor() as cur:
+            self._write_rows(cur, batch)
+    
+    def _write_each(self, batch):
+        """Write rows one by one under savepoints; returns how many were rejected"""
+        rejected = 0
+        with db.sync_cursor() as cur:
+            for row in batch:
+                cur.execute('SAVEPOINT write_row')
+                try:
+                    self._write_rows(cur, [row])
+                except (psycopg2.DataError, psycopg2.IntegrityError, ValueError, TypeError):
+                    cur.execute('ROLLBACK TO SAVEPOINT write_row')
+                    rejected += 1
+                else:
+                    cur.execute('RELEASE SAVEPOINT write_row')
+        return rejected
 
 def parse_time_string(time_str):
     """Parse natural language time like '2 hours', '30 minutes', '1 day' into seconds or absolute datetime"""
@@ -49,346 +465,3003 @@ def parse_time_string(time_str):
     return None
 
 def log_event(guild_id, event_type, target_user_id=None, actor_user_id=None, details=None):
-    """Log an event to the database"""
+    """Queue an event for the activity log; it is written by the next batch flush"""
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        
-        cur.execute('''
-            INSERT INTO activity_logs (guild_id, event_type, target_user_id, actor_user_id, details, timestamp)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        ''', (guild_id, event_type, target_user_id, actor_user_id, json.dumps(details) if details else None, datetime.now()))
-        
-        conn.commit()
-        cur.close()
-        conn.close()
+        activity_log_buffer.add((guild_id, event_type, target_user_id, actor_user_id,
+                                 json.dumps(details) if details else None, datetime.now()))
     except Exception as e:
         print(f'Error logging event: {e}')
 
+def copy_activity_logs(cur, rows):
+    """Bulk-load activity_logs rows with COPY FROM STDIN"""
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    query = '''
+        COPY activity_logs (guild_id, event_type, target_user_id, actor_user_id, details, timestamp)
+        FROM STDIN WITH (FORMAT csv)
+    '''
+    started = time.perf_counter()
+    cur.copy_expert(query, buf)
+    db.record_query(query, time.perf_counter() - started)
+
+activity_log_buffer = WriteBehindBuffer('activity_logs', copy_activity_logs, ACTIVITY_LOG_BUFFER_SIZE,
+                                        ACTIVITY_LOG_BATCH_SIZE, ACTIVITY_LOG_FLUSH_INTERVAL)
+
+def upsert_raid_tracking(cur, rows):
+    """Upsert a batch of raid_tracking joins in one statement"""
+    # A member who rejoins within one batch would hit the same row twice, which ON CONFLICT rejects
+    latest = {}
+    for row in rows:
+        latest[(row[0], row[1])] = row
+    query = '''
+        INSERT INTO raid_tracking (guild_id, user_id, joined_at, account_created_at, is_suspicious, suspicion_score)
+        VALUES %s
+        ON CONFLICT (guild_id, user_id) DO UPDATE
+        SET joined_at = EXCLUDED.joined_at, is_suspicious = EXCLUDED.is_suspicious,
+            suspicion_score = EXCLUDED.suspicion_score
+    '''
+    started = time.perf_counter()
+    execute_values(cur, query, list(latest.values()), page_size=len(latest))
+    db.record_query(query, time.perf_counter() - started)
+
+raid_tracking_buffer = WriteBehindBuffer('raid_tracking', upsert_raid_tracking, 10000, 500, 2)
+
+class GuildConfigCache:
+    """In-memory copy of the per-guild config tables, loaded in bulk at startup.
+    
+    Event handlers read config from here instead of the database. Commands that change
+    config call refresh() after writing, and invalidate() drops an entry so the next
+    read reloads it. Guilds with no row are known to be unconfigured once loaded.
+    
+    invalidate() also bumps a generation per (table, guild). A read that started before the
+    bump may have seen the old row, so refresh() and load_all() only store what they read
+    if the generation is unchanged when they finish.
+    """
+    
+    TABLES = ('automod_config', 'global_log_config', 'log_channels', 'name_patterns', 'security_config',
+              'welcome_config')
+    
+    def __init__(self):
+        self._entries = {table: {} for table in self.TABLES}
+        self._stale = {table: set() for table in self.TABLES}
+        self._generations = {}
+        self._loaded = False
+    
+    @staticmethod
+    def _group(table, rows):
+        if table == 'log_channels':
+            grouped = {}
+            for row in rows:
+                grouped.setdefault(row['guild_id'], {})[row['event_type']] = row['channel_id']
+            return grouped
+        if table == 'name_patterns':
+            grouped = {}
+            for row in rows:
+                grouped.setdefault(row['guild_id'], []).append(dict(row))
+            return grouped
+        return {row['guild_id']: dict(row) for row in rows}
+    
+    async def load_all(self):
+        generations = dict(self._generations)
+        entries = {}
+        async with db.cursor(dict_rows=True) as cur:
+            for table in self.TABLES:
+                await cur.execute(f'SELECT * FROM {table}')
+                entries[table] = self._group(table, cur.fetchall())
+        
+        stale = {table: set() for table in self.TABLES}
+        for (table, guild_id), generation in self._generations.items():
+            if generations.get((table, guild_id)) != generation:
+                # Invalidated while loading, so what was read may already be out of date
+                entries[table].pop(guild_id, None)
+                stale[table].add(guild_id)
+        
+        self._entries = entries
+        self._stale = stale
+        self._loaded = True
+        metrics.incr('config_cache.loads')
+    
+    async def get(self, table, guild_id):
+        """Return the cached row for a guild (for log_channels, a dict of event_type -> channel_id)"""
+        entries = self._entries[table]
+        if guild_id in entries:
+            metrics.incr('config_cache.hits')
+            return entries[guild_id]
+        if self._loaded and guild_id not in self._stale[table]:
+            metrics.incr('config_cache.hits')
+            return None
+        return await self.refresh(guild_id, table)
+    
+    async def refresh(self, guild_id, table):
+        """Re-read one guild's rows for a table, e.g. right after a command wrote them"""
+        metrics.incr('config_cache.misses')
+        generation = self._generations.get((table, guild_id), 0)
+        async with db.cursor(dict_rows=True) as cur:
+            await cur.execute(f'SELECT * FROM {table} WHERE guild_id = %s', (guild_id,))
+            value = self._group(table, cur.fetchall()).get(guild_id)
+        
+        if self._generations.get((table, guild_id), 0) != generation:
+            # Invalidated while reading; leave it stale so the next read loads the new row
+            return value
+        if value is None:
+            self._entries[table].pop(guild_id, None)
+        else:
+            self._entries[table][guild_id] = value
+        self._stale[table].discard(guild_id)
+        return value
+    
+    def invalidate(self, guild_id, table=None):
+        for name in ([table] if table else self.TABLES):
+            self._entries[name].pop(guild_id, None)
+            self._stale[name].add(guild_id)
+            self._generations[(name, guild_id)] = self._generations.get((name, guild_id), 0) + 1
+    
+    async def log_channel(self, guild_id, event_type):
+        channels = await self.get('log_channels', guild_id)
+        return channels.get(event_type) if channels else None
+
+config_cache = GuildConfigCache()
+
+async def publish_config_change(cur, guild_id, table):
+    """Tell other bot processes to drop their cached copy of a guild's config.
+    
+    Sent on the writing transaction, so Postgres delivers it only once the change commits.
+    """
+    payload = json.dumps({'guild_id': guild_id, 'table': table, 'origin': INSTANCE_ID})
+    await cur.execute('SELECT pg_notify(%s, %s)', (CONFIG_NOTIFY_CHANNEL, payload))
+
+class ConfigChangeListener:
+    """Evicts config_cache entries when another bot process changes a guild's config.
+    
+    Uses its own autocommit connection outside the pool and watches the socket with
+    loop.add_reader, so notifications are handled as soon as they arrive without polling.
+    """
+    
+    def __init__(self, dsn, cache):
+        self.dsn = dsn
+        self.cache = cache
+        self._conn = None
+        self._loop = None
+        self._reconnect_task = None
+    
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        try:
+            await self._connect()
+        except Exception as e:
+            print(f'Config listener failed to connect: {e}')
+            self._disconnect()
+            self._reconnect_task = self._loop.create_task(self._reconnect())
+    
+    async def stop(self):
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        self._disconnect()
+    
+    def _open_connection(self):
+        conn = psycopg2.connect(self.dsn)
+        conn.set_session(autocommit=True)
+        with conn.cursor() as cur:
+            cur.execute(f'LISTEN {CONFIG_NOTIFY_CHANNEL}')
+        return conn
+    
+    async def _connect(self):
+        self._conn = await db.run(self._open_connection)
+        self._loop.add_reader(self._conn.fileno(), self._on_readable)
+    
+    def _disconnect(self):
+        if self._conn is None:
+            return
+        try:
+            self._loop.remove_reader(self._conn.fileno())
+        except Exception:
+            pass
+        try:
+            self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
+    
+    def _on_readable(self):
+        try:
+            self._conn.poll()
+        except Exception as e:
+            print(f'Config listener connection lost: {e}')
+            self._disconnect()
+            self._reconnect_task = self._loop.create_task(self._reconnect())
+            return
+        
+        while self._conn.notifies:
+            notify = self._conn.notifies.pop(0)
+            self._handle(notify.payload)
+    
+    def _handle(self, payload):
+        try:
+            change = json.loads(payload)
+            guild_id = int(change['guild_id'])
+        except (ValueError, KeyError, TypeError):
+            print(f'Ignoring malformed config notification: {payload!r}')
+            return
+        
+        if change.get('origin') == INSTANCE_ID:
+            return
+        
+        table = change.get('table')
+        self.cache.invalidate(guild_id, table if table in self.cache.TABLES else None)
+        metrics.incr('config_cache.remote_invalidations')
+    
+    async def _reconnect(self):
+        delay = 1
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self._connect()
+                # Changes made while we were disconnected were never delivered, so start over
+                await self.cache.load_all()
+                print('Config listener reconnected')
+                return
+            except Exception as e:
+                print(f'Config listener reconnect failed: {e}')
+                self._disconnect()
+                delay = min(delay * 2, 60)
+
+config_listener = ConfigChangeListener(db.dsn, config_cache)
+
+class AuditLogIndex:
+    """Recent audit log entries pushed by the gateway, indexed by (guild, action, target).
+    
+    Event handlers call find() to get the entry behind a change instead of querying
+    guild.audit_logs(). If the entry hasn't arrived yet the caller waits for it briefly, and
+    only falls back to REST after AUDIT_LOG_WAIT seconds. Entries are matched first-in
+    first-out and consumed, so two quick changes to the same target get their own actors.
+    """
+    
+    def __init__(self, ttl=AUDIT_LOG_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._expiry = deque()
+        self._waiters = {}
+        self._listeners = []
+    
+    def add_listener(self, listener):
+        """Call listener(entry) for every entry as it arrives"""
+        self._listeners.append(listener)
+    
+    def ingest(self, entry):
+        metrics.incr('audit_log.ingested')
+        for listener in self._listeners:
+            try:
+                listener(entry)
+            except Exception as e:
+                print(f'Error in audit log listener: {e}')
+        
+        key = (entry.guild.id, entry.action, getattr(entry.target, 'id', None))
+        for waiter in self._waiters.get(key, []):
+            future, check = waiter
+            if not future.done() and check(entry):
+                future.set_result(entry)
+                self._waiters[key].remove(waiter)
+                return
+        
+        now = time.monotonic()
+        self._entries.setdefault(key, deque()).append((now, entry))
+        self._expiry.append((now + self.ttl, key))
+        self._evict(now)
+    
+    def _evict(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            _, key = self._expiry.popleft()
+            entries = self._entries.get(key)
+            while entries and entries[0][0] + self.ttl <= now:
+                entries.popleft()
+            if not entries:
+                self._entries.pop(key, None)
+    
+    def _take(self, key, check):
+        entries = self._entries.get(key)
+        if not entries:
+            return None
+        cutoff = time.monotonic() - self.ttl
+        for item in entries:
+            received, entry = item
+            if received > cutoff and check(entry):
+                entries.remove(item)
+                return entry
+        return None
+    
+    async def find(self, guild, action, target_id, check=None, timeout=AUDIT_LOG_WAIT):
+        """The audit log entry for a change to target_id, or None if it can't be found"""
+        check = check or (lambda entry: True)
+        key = (guild.id, action, target_id)
+        
+        entry = self._take(key, check)
+        if entry is not None:
+            metrics.incr('audit_log.hits')
+            return entry
+        
+        future = asyncio.get_running_loop().create_future()
+        waiter = (future, check)
+        self._waiters.setdefault(key, []).append(waiter)
+        try:
+            entry = await asyncio.wait_for(future, timeout=timeout)
+            metrics.incr('audit_log.waited')
+            return entry
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            waiters = self._waiters.get(key)
+            if waiters and waiter in waiters:
+                waiters.remove(waiter)
+            if not waiters:
+                self._waiters.pop(key, None)
+        
+        metrics.incr('audit_log.rest_fallbacks')
+        try:
+            async for entry in guild.audit_logs(limit=5, action=action):
+                if getattr(entry.target, 'id', None) == target_id and check(entry):
+                    return entry
+        except discord.HTTPException as e:
+            print(f'Error fetching audit log: {e}')
+        return None
+
+audit_log_index = AuditLogIndex()
+
+def audit_actor_mention(entry):
+    """Mention for whoever made an audit log entry; gateway entries may not carry a cached user"""
+    return entry.user.mention if entry.user else f'<@{entry.user_id}>'
+
 async def send_global_log(guild, event_type, embed):
     """Send log to global log channel if configured"""
     try:
-        conn = get_db()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
+        config = await config_cache.get('global_log_config', guild.id)
         
-        cur.execute('SELECT * FROM global_log_config WHERE guild_id = %s AND enabled = true', (guild.id,))
-        config = cur.fetchone()
+        if config and config['enabled'] and config['channel_id']:
+            channel = guild.get_channel(config['channel_id'])
+            if channel:
+                await channel.send(embed=embed)
+    except Exception as e:
+        print(f'Error sending global log: {e}')
+
+def parse_raid_windows(text):
+    """Parse extra raid windows like '10:8,60:20' into a list of (seconds, threshold) pairs"""
+    windows = []
+    if not text:
+        return windows
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        seconds, _, threshold = part.partition(':')
+        seconds, threshold = int(seconds), int(threshold)
+        if seconds <= 0 or threshold <= 0:
+            raise ValueError(f'window and threshold must be positive: {part}')
+        windows.append((seconds, threshold))
+    return windows
+
+class RaidDetector:
+    """Counts recent joins per guild over one or more sliding windows.
+    
+    Each (guild, window) keeps a deque of join times; old entries are popped off the left
+    as new joins arrive, so a check costs O(1) amortized no matter how large raid_tracking gets.
+    A window is reported once when it crosses its threshold and re-arms only after its count
+    falls back below it, so a long raid raises one alert per window instead of one per join.
+    """
+    
+    def __init__(self):
+        self._joins = {}
+        self._over = {}
+        self._parsed = {}
+    
+    def windows_for(self, config):
+        """The (seconds, threshold) windows configured for a guild, primary window first"""
+        extra = config.get('raid_windows') or ''
+        if extra not in self._parsed:
+            try:
+                self._parsed[extra] = parse_raid_windows(extra)
+            except ValueError as e:
+                print(f'Ignoring invalid raid_windows {extra!r}: {e}')
+                self._parsed[extra] = []
+        windows = [(config['raid_time_window'], config['raid_threshold'])]
+        windows.extend(w for w in self._parsed[extra] if w[0] != config['raid_time_window'])
+        return windows
+    
+    def record(self, guild_id, windows, now=None):
+        """Record a join and return (seconds, threshold, count) for every window that just crossed its threshold"""
+        now = time.monotonic() if now is None else now
+        guild_joins = self._joins.setdefault(guild_id, {})
+        over = self._over.setdefault(guild_id, set())
+        
+        # Drop deques for windows that are no longer configured
+        for seconds in list(guild_joins):
+            if all(seconds != w[0] for w in windows):
+                del guild_joins[seconds]
+                over.discard(seconds)
+        
+        tripped = []
+        for seconds, threshold in windows:
+            joins = guild_joins.setdefault(seconds, deque())
+            joins.append(now)
+            cutoff = now - seconds
+            while joins and joins[0] <= cutoff:
+                joins.popleft()
+            if len(joins) < threshold:
+                over.discard(seconds)
+            elif seconds not in over:
+                over.add(seconds)
+                tripped.append((seconds, threshold, len(joins)))
+        return tripped
+
+raid_detector = RaidDetector()
+
+def snowflake_seconds(snowflake):
+    """Creation time of a Discord ID in seconds since the Discord epoch, straight from its bits"""
+    return (snowflake >> 22) / 1000
+
+class JoinWaveDetector:
+    """Spots batches of accounts created around the same time joining together.
+    
+    Raids often use aged accounts that were all made in one sitting, so a minimum account
+    age doesn't catch them. For each guild the joins of the last JOIN_WAVE_WINDOW seconds
+    are kept in a list sorted by account creation time (taken from the member's snowflake).
+    A new join only has to check the windows exactly wave_span wide that contain its own
+    creation time, by sliding one over that sorted list instead of rescoring every join.
+    Each wave is reported once; joins that extend an already reported wave are folded into it.
+    """
+    
+    def __init__(self, window=JOIN_WAVE_WINDOW, max_joins=JOIN_WAVE_MAX_JOINS):
+        self.window = window
+        self.max_joins = max_joins
+        self._arrivals = {}
+        self._created = {}
+        self._reported = {}
+    
+    def _evict(self, guild_id, now):
+        arrivals = self._arrivals[guild_id]
+        created = self._created[guild_id]
+        while arrivals and (arrivals[0][0] <= now - self.window or len(arrivals) > self.max_joins):
+            _, entry = arrivals.popleft()
+            index = bisect.bisect_left(created, entry)
+            if index < len(created) and created[index] == entry:
+                del created[index]
         
-        cur.close()
-        conn.close()
+        reported = self._reported.get(guild_id)
+        if reported:
+            self._reported[guild_id] = [wave for wave in reported if wave[2] > now]
+    
+    def record(self, guild_id, member_id, size, span, now=None):
+        """Add a join; returns (count, member_ids, first_created, last_created) for a new wave, else None"""
+        now = time.monotonic() if now is None else now
+        entry = (snowflake_seconds(member_id), member_id)
+        self._arrivals.setdefault(guild_id, deque()).append((now, entry))
+        created = self._created.setdefault(guild_id, [])
+        bisect.insort(created, entry)
+        self._evict(guild_id, now)
+        
+        if not size or size <= 1:
+            return None
+        
+        # Slide a window span wide from the earliest start that still covers the new entry;
+        # the end only moves forward, so this is one pass over that part of the list
+        index = bisect.bisect_left(created, entry)
+        lo, hi = None, index + 1
+        end = index + 1
+        for start in range(bisect.bisect_left(created, (entry[0] - span, 0)), index + 1):
+            while end < len(created) and created[end][0] <= created[start][0] + span:
+                end += 1
+            if end - start >= size and (lo is None or end - start > hi - lo):
+                lo, hi = start, end
+        if lo is None:
+            return None
+        
+        first, last = created[lo][0], created[hi - 1][0]
+        reported = self._reported.setdefault(guild_id, [])
+        for wave in reported:
+            if wave[0] - span <= entry[0] <= wave[1] + span:
+                wave[0], wave[1] = min(wave[0], first), max(wave[1], last)
+                return None
+        reported.append([first, last, now + self.window])
+        return hi - lo, [member_id for _, member_id in created[lo:hi]], first, last
+
+join_wave_detector = JoinWaveDetector()
+
+SNAPSHOT_ENTRY = struct.Struct('<BQQQ')
+SNAPSHOT_ROLE = 0
+SNAPSHOT_MEMBER = 1
+# Advisory lock key: writers of snapshot_blobs hold it shared, the blob GC holds it exclusively
+SNAPSHOT_BLOB_LOCK = 0x736e6170
+
+def pack_overwrites(entries):
+    """Pack (target_type, target_id, allow_bits, deny_bits) tuples into a lockdown snapshot blob.
+    
+    Entries are sorted so the same overwrites always pack to the same bytes, which lets
+    unlock compare a channel against its snapshot with a plain equality check.
+    """
+    return b''.join(SNAPSHOT_ENTRY.pack(*entry) for entry in sorted(entries))
+
+def unpack_overwrites(blob):
+    """Inverse of pack_overwrites"""
+    return list(SNAPSHOT_ENTRY.iter_unpack(bytes(blob)))
+
+def snapshot_hash(blob):
+    """Content address of a packed snapshot in snapshot_blobs"""
+    return hashlib.blake2b(blob, digest_size=16).digest()
+
+def store_snapshot_blobs(cur, blobs):
+    """Insert packed snapshots into snapshot_blobs, skipping ones already stored.
+    
+    blobs maps hash to data. Runs on the executor with a plain cursor. Holds the shared blob
+    lock until the caller's transaction ends, so the GC can't delete a blob that was skipped
+    as already stored before the caller's rows point at it.
+    """
+    cur.execute('SELECT pg_advisory_xact_lock_shared(%s)', (SNAPSHOT_BLOB_LOCK,))
+    if blobs:
+        execute_values(cur, '''
+            INSERT INTO snapshot_blobs (hash, data) VALUES %s
+            ON CONFLICT (hash) DO NOTHING
+        ''', [(psycopg2.Binary(h), psycopg2.Binary(data)) for h, data in blobs.items()])
+
+def snapshot_overwrites(channel):
+    """Serialize a channel's permission overwrites for lockdown_permissions"""
+    entries = []
+    for target, overwrite in channel.overwrites.items():
+        if isinstance(target, discord.Role):
+            target_type = SNAPSHOT_ROLE
+        elif isinstance(target, discord.Member):
+            target_type = SNAPSHOT_MEMBER
+        else:
+            continue
+        allow, deny = overwrite.pair()
+        entries.append((target_type, target.id, allow.value, deny.value))
+    return pack_overwrites(entries)
+
+def legacy_snapshot_to_blob(perms_json):
+    """Convert an old JSON lockdown snapshot into the packed format"""
+    entries = []
+    for target_key, perms_dict in json.loads(perms_json).items():
+        target_type, _, target_id = target_key.partition('_')
+        if target_type not in ('role', 'member') or not target_id.isdigit():
+            continue
+        overwrite = discord.PermissionOverwrite()
+        for perm_name, perm_value in perms_dict.items():
+            if perm_name in discord.Permissions.VALID_FLAGS:
+                setattr(overwrite, perm_name, perm_value)
+        allow, deny = overwrite.pair()
+        entries.append((SNAPSHOT_ROLE if target_type == 'role' else SNAPSHOT_MEMBER, int(target_id),
+                        allow.value, deny.value))
+    return pack_overwrites(entries)
+
+async def restore_overwrites(guild, channel, blob):
+    """Put a channel's overwrites back from a lockdown_permissions snapshot"""
+    new_overwrites = {}
+    
+    for target_type, target_id, allow, deny in unpack_overwrites(blob):
+        if target_type == SNAPSHOT_ROLE:
+            target = guild.get_role(target_id)
+        else:
+            target = guild.get_member(target_id)
+            if not target:
+                try:
+                    target = await guild.fetch_member(target_id)
+                except discord.HTTPException:
+                    pass
+        
+        if not target:
+            continue
+        
+        new_overwrites[target] = discord.PermissionOverwrite.from_pair(
+            discord.Permissions(allow), discord.Permissions(deny)
+        )
+    
+    await channel.edit(overwrites=new_overwrites)
+
+def lockdown_summary(done, failed, elapsed, mode='channel', skipped=0):
+    """Short edit count and timing line for lockdown messages"""
+    summary = f"{done} {'roles/channels' if mode == 'role' else 'channels'} in {elapsed:.1f}s"
+    if failed:
+        summary += f" ({failed} failed)"
+    if skipped:
+        summary += f"\n{skipped} already unchanged, skipped"
+    return summary
+
+def interaction_progress(interaction, verb):
+    """Progress callback that keeps a command's ephemeral reply updated"""
+    async def progress(done, failed, total):
+        await interaction.edit_original_response(content=f'{verb} {done + failed}/{total} channels...')
+    return progress
+
+class ChannelEditScheduler:
+    """Runs a batch of channel edits concurrently while staying under Discord's rate limits.
+    
+    Each channel has its own PATCH rate-limit bucket, so edits to different channels can run
+    side by side; the shared limit is the global requests-per-second cap, which is paced here
+    with a simple start-time slot. 429s and 5xx errors that reach us are retried with backoff.
+    """
+    
+    def __init__(self, concurrency=CHANNEL_EDIT_CONCURRENCY, rate=CHANNEL_EDIT_RATE, max_retries=5,
+                 progress_interval=2):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.max_retries = max_retries
+        self.progress_interval = progress_interval
+        self._next_slot = 0
+        self._slot_lock = asyncio.Lock()
+    
+    async def _wait_for_slot(self):
+        async with self._slot_lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + 1 / self.rate
+        if wait > 0:
+            await asyncio.sleep(wait)
+    
+    async def _edit(self, channel, edit):
+        delay = 1
+        for attempt in range(self.max_retries + 1):
+            await self._wait_for_slot()
+            try:
+                await edit(channel)
+                return
+            except discord.HTTPException as e:
+                retryable = e.status == 429 or e.status >= 500
+                if not retryable or attempt == self.max_retries:
+                    raise
+                metrics.incr('channel_edits.retries')
+                retry_after = getattr(e, 'retry_after', None)
+                await asyncio.sleep(retry_after if retry_after else delay)
+                delay = min(delay * 2, 30)
+    
+    async def run(self, channels, edit, progress=None):
+        """Call edit(channel) for every channel; returns (done, failed, elapsed_seconds).
+        
+        progress(done, failed, total) is awaited at most every progress_interval seconds
+        and once more when everything has finished.
+        """
+        started = time.perf_counter()
+        total = len(channels)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        counts = {'done': 0, 'failed': 0}
+        last_report = [started]
+        
+        async def report(final=False):
+            if progress is None:
+                return
+            now = time.perf_counter()
+            if not final and now - last_report[0] < self.progress_interval:
+                return
+            last_report[0] = now
+            try:
+                await progress(counts['done'], counts['failed'], total)
+            except Exception as e:
+                print(f'Error reporting channel edit progress: {e}')
+        
+        async def worker(channel):
+            async with semaphore:
+                try:
+                    await self._edit(channel, edit)
+                    counts['done'] += 1
+                except Exception as e:
+                    counts['failed'] += 1
+                    print(f'Error editing channel {channel.name}: {e}')
+            await report()
+        
+        await asyncio.gather(*(worker(channel) for channel in channels))
+        elapsed = time.perf_counter() - started
+        metrics.incr('channel_edits.done', counts['done'])
+        metrics.incr('channel_edits.failed', counts['failed'])
+        metrics.observe('channel_edits.batch', elapsed)
+        await report(final=True)
+        return counts['done'], counts['failed'], elapsed
+
+channel_edit_scheduler = ChannelEditScheduler()
+
+DEFAULT_DANGEROUS_PERMISSIONS = discord.Permissions(
+    administrator=True,
+    manage_guild=True,
+    manage_roles=True,
+    manage_channels=True,
+    manage_webhooks=True,
+    manage_messages=True,
+    kick_members=True,
+    ban_members=True,
+    moderate_members=True,
+    mention_everyone=True
+)
+
+def dangerous_permissions_mask(config):
+    """The permission bits the permission guard watches for a guild"""
+    if config and config.get('dangerous_permissions') is not None:
+        return config['dangerous_permissions']
+    return DEFAULT_DANGEROUS_PERMISSIONS.value
+
+def is_trusted_actor(guild, user_id, config):
+    """Whether a change made by user_id should be left alone by the permission guard"""
+    if user_id == guild.owner_id or (bot.user and user_id == bot.user.id):
+        return True
+    member = guild.get_member(user_id)
+    if member is None:
+        return False
+    trusted_ids = set(parse_id_list(config.get('trusted_role_ids')))
+    return any(role.id in trusted_ids for role in member.roles)
+
+def permission_names(value):
+    """Names of the permission flags set in a raw permission value"""
+    return [name for name, flag in discord.Permissions.VALID_FLAGS.items() if value & flag]
+
+LOCKDOWN_REVOKED_PERMISSIONS = discord.Permissions(
+    view_channel=True,
+    send_messages=True,
+    send_messages_in_threads=True,
+    add_reactions=True
+)
+
+def parse_id_list(text):
+    """Parse a comma-separated list of IDs stored in a TEXT column"""
+    if not text:
+        return []
+    return [int(part) for part in text.split(',') if part.strip().isdigit()]
+
+def plan_role_lockdown(guild, config):
+    """Roles to revoke and channels whose overwrites would undo that, for role-level lockdown.
+    
+    A channel overwrite that allows a revoked permission for @everyone or a locked role wins
+    over the role-level change, so only those channels (plus the announcement channel, which
+    stays readable) need their own edit.
+    """
+    roles = [guild.default_role]
+    for role_id in parse_id_list(config.get('lockdown_role_ids')):
+        role = guild.get_role(role_id)
+        if role and not role.is_default() and not role.managed and role < guild.me.top_role:
+            roles.append(role)
+    
+    locked_ids = {role.id for role in roles}
+    revoked = LOCKDOWN_REVOKED_PERMISSIONS.value
+    channels = []
+    for channel in guild.channels:
+        if channel.id == config.get('announcement_channel_id'):
+            channels.append(channel)
+            continue
+        for target, overwrite in channel.overwrites.items():
+            if isinstance(target, discord.Role) and target.id in locked_ids and overwrite.pair()[0].value & revoked:
+                channels.append(channel)
+                break
+    return roles, channels
+
+def plan_channel_lockdown(guild, config):
+    """Split a guild's channels for channel-mode lockdown.
+    
+    Returns (categories, individual, synced). Channels whose overwrites are synced to their
+    category are locked by locking the category and then re-syncing them to it; everything
+    else (channels with their own overwrites, channels outside a category, and the
+    announcement channel) is edited on its own. Text, voice, stage and forum channels are
+    all included.
+    """
+    announcement_id = config.get('announcement_channel_id')
+    individual = []
+    synced = []
+    for channel in guild.channels:
+        if isinstance(channel, discord.CategoryChannel):
+            continue
+        if channel.category and channel.permissions_synced and channel.id != announcement_id:
+            synced.append(channel)
+        else:
+            individual.append(channel)
+    categories = list(dict.fromkeys(channel.category for channel in synced))
+    return categories, individual, synced
+
+def restored_role_value(role, stored_value):
+    """Role permissions with only the bits lockdown took away put back from the snapshot"""
+    revoked = LOCKDOWN_REVOKED_PERMISSIONS.value
+    return (role.permissions.value & ~revoked) | (stored_value & revoked)
+
+def channel_needs_restore(guild, channel, blob):
+    """Whether unlock has to edit a channel, comparing it with its packed snapshot"""
+    if blob is None:
+        return guild.default_role in channel.overwrites
+    return snapshot_overwrites(channel) != bytes(blob)
+
+class LockdownEngine:
+    """Locks and unlocks a guild for /lockdown, /unlockdown and auto-lockdown.
+    
+    In 'channel' mode every text channel gets an @everyone overwrite. In 'role' mode the
+    permissions are revoked on @everyone and the configured roles instead, and only channels
+    whose overwrites would override that are edited. The mode used is stored in active_mode
+    so unlock undoes the same thing even if the setting changes meanwhile.
+    
+    Each lock or unlock is a lockdown_jobs row with one lockdown_job_items row per role or
+    channel. Items are claimed in batches with FOR UPDATE SKIP LOCKED and checkpointed as
+    done or failed, so after a restart setup_hook resumes the job where it stopped. An item
+    left 'running' by a dead process becomes claimable again once its lease runs out.
+    
+    Only one lockdown or unlock runs per guild in this process, and is_active is claimed with
+    a conditional upsert so two processes can't both start one for the same guild.
+    """
+    
+    def __init__(self):
+        self._busy = set()
+        self._tasks = set()
+    
+    def is_busy(self, guild_id):
+        return guild_id in self._busy
+    
+    def spawn(self, coro):
+        """Run coro in the background, keeping a reference so the task isn't garbage collected"""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+    
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            print(f'Error in lockdown task: {task.exception()}')
+    
+    async def activate(self, guild, actor, reason, automatic=False, progress=None):
+        """Lock the guild; returns False if a lockdown is already active or running"""
+        if guild.id in self._busy:
+            return False
+        self._busy.add(guild.id)
+        try:
+            # Claiming is_active, the snapshot and the job commit together, so a failure in
+            # any of them leaves the guild unlocked instead of flagged active with nothing saved
+            async with db.cursor(dict_rows=True) as cur:
+                await cur.execute('''
+                    INSERT INTO lockdown_config (guild_id, is_active, initiated_by, initiated_at, active_mode)
+                    VALUES (%s, true, %s, %s, 'channel')
+                    ON CONFLICT (guild_id) DO UPDATE
+                    SET is_active = true, initiated_by = EXCLUDED.initiated_by, initiated_at = EXCLUDED.initiated_at,
+                        active_mode = COALESCE(lockdown_config.lockdown_mode, 'channel')
+                    WHERE NOT COALESCE(lockdown_config.is_active, false)
+                    RETURNING *
+                ''', (guild.id, actor.id, datetime.now()))
+                config = cur.fetchone()
+                
+                if not config:
+                    return False
+                
+                if config['active_mode'] == 'role':
+                    roles, channels = plan_role_lockdown(guild, config)
+                    await self._snapshot_roles(cur, guild, roles)
+                    await self._snapshot_channels(cur, guild, channels)
+                    items = [('role', role.id) for role in roles]
+                    items.extend(('channel', channel.id) for channel in channels)
+                else:
+                    categories, individual, synced = plan_channel_lockdown(guild, config)
+                    await self._snapshot_channels(cur, guild, categories + individual + synced)
+                    items = [('channel', channel.id) for channel in categories + individual]
+                    items.extend(('synced', channel.id) for channel in synced)
+                
+                job = await self._create_job(cur, guild, 'lock', config['active_mode'], actor.id, reason, automatic, items)
+            
+            return await self._run_job(guild, job, progress) is not None
+        except Exception as e:
+            print(f'Error activating lockdown: {e}')
+            return False
+        finally:
+            self._busy.discard(guild.id)
+    
+    async def deactivate(self, guild, actor, progress=None):
+        """Undo the active lockdown.
+        
+        Returns a dict of done/failed/skipped edit counts, or None if no lockdown is active
+        or one is already running.
+        """
+        if guild.id in self._busy:
+            return None
+        self._busy.add(guild.id)
+        try:
+            # Clearing is_active commits with the unlock job, so if planning fails the guild
+            # stays marked locked and its snapshots can't be overwritten by a new lockdown
+            async with db.cursor(dict_rows=True) as cur:
+                await cur.execute('''
+                    UPDATE lockdown_config SET is_active = false
+                    WHERE guild_id = %s AND is_active
+                    RETURNING *
+                ''', (guild.id,))
+                config = cur.fetchone()
+                
+                if not config:
+                    return None
+                
+                stored, stored_roles = await self._load_snapshots(cur, guild.id)
+                
+                if config['active_mode'] == 'role':
+                    roles = [role for role in (guild.get_role(role_id) for role_id in stored_roles) if role]
+                    changed_roles = [role for role in roles if restored_role_value(role, stored_roles[role.id]) != role.permissions.value]
+                    skipped = len(roles) - len(changed_roles)
+                    items = [('role', role.id) for role in changed_roles]
+                else:
+                    skipped = 0
+                    items = []
+                # Only channels snapshotted at lock time were touched; anything else (including
+                # channels made during the lockdown) keeps whatever overwrites it has now
+                channels = [channel for channel in guild.channels if channel.id in stored]
+                changed_channels = [channel for channel in channels if channel_needs_restore(guild, channel, stored.get(channel.id))]
+                skipped += len(channels) - len(changed_channels)
+                for channel in changed_channels:
+                    # Children that matched their category when locked are restored after it
+                    category_blob = stored.get(channel.category.id) if channel.category else None
+                    was_synced = category_blob is not None and stored.get(channel.id) == category_blob
+                    items.append(('synced' if was_synced else 'channel', channel.id))
+                
+                job = await self._create_job(cur, guild, 'unlock', config['active_mode'], actor.id, None, False, items, skipped)
+            return await self._run_job(guild, job, progress)
+        except Exception as e:
+            print(f'Error deactivating lockdown: {e}')
+            return None
+        finally:
+            self._busy.discard(guild.id)
+    
+    async def resume_jobs(self):
+        """Carry on with lockdown jobs that were still running when the bot last stopped"""
+        await bot.wait_until_ready()
+        async with db.cursor(dict_rows=True) as cur:
+            await cur.execute("SELECT * FROM lockdown_jobs WHERE status = 'running' ORDER BY job_id")
+            jobs = cur.fetchall()
+        
+        for job in jobs:
+            guild = bot.get_guild(job['guild_id'])
+            if not guild or guild.id in self._busy:
+                continue
+            print(f"Resuming lockdown job {job['job_id']} ({job['action']}) for {guild.name}")
+            self._busy.add(guild.id)
+            self.spawn(self._resume(guild, job))
+    
+    async def _resume(self, guild, job):
+        try:
+            await self._run_job(guild, job, None)
+        except Exception as e:
+            print(f"Error resuming lockdown job {job['job_id']}: {e}")
+        finally:
+            self._busy.discard(guild.id)
+    
+    async def _create_job(self, cur, guild, action, mode, actor_id, reason, automatic, items, skipped=0):
+        """Insert a job and its items using the caller's dict_rows cursor and transaction"""
+        # A newer lock/unlock supersedes anything still running for this guild
+        await cur.execute('''
+            UPDATE lockdown_jobs SET status = 'cancelled', finished_at = %s
+            WHERE guild_id = %s AND status = 'running'
+        ''', (datetime.now(), guild.id))
+        await cur.execute('''
+            INSERT INTO lockdown_jobs (guild_id, action, mode, actor_id, reason, automatic, skipped, created_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING *
+        ''', (guild.id, action, mode, actor_id, reason, automatic, skipped, datetime.now()))
+        job = cur.fetchone()
+        if items:
+            await cur.call(execute_values, '''
+                INSERT INTO lockdown_job_items (job_id, kind, target_id) VALUES %s
+            ''', [(job['job_id'], kind, target_id) for kind, target_id in items])
+        return job
+    
+    async def _claim_items(self, job_id):
+        """Claim the next batch of items, all from the earliest unfinished stage.
+        
+        Stages run in order: roles, then categories and standalone channels, then channels
+        synced to a category, which must not start before their category is done. Nothing is
+        claimed once the job is no longer running, e.g. cancelled by another process.
+        """
+        now = datetime.now()
+        stage = "CASE kind WHEN 'role' THEN 0 WHEN 'channel' THEN 1 ELSE 2 END"
+        async with db.cursor() as cur:
+            await cur.execute(f'''
+                WITH current_stage AS (
+                    SELECT MIN({stage}) AS stage FROM lockdown_job_items i
+                    JOIN lockdown_jobs j ON j.job_id = i.job_id AND j.status = 'running'
+                    WHERE i.job_id = %s AND i.state IN ('pending', 'running')
+                )
+                UPDATE lockdown_job_items SET state = 'running', claimed_at = %s
+                WHERE (job_id, kind, target_id) IN (
+                    SELECT job_id, kind, target_id FROM lockdown_job_items, current_stage
+                    WHERE job_id = %s AND {stage} = current_stage.stage
+                    AND (state = 'pending' OR (state = 'running' AND claimed_at < %s))
+                    ORDER BY target_id
+                    LIMIT %s
+                    FOR UPDATE OF lockdown_job_items SKIP LOCKED
+                )
+                RETURNING kind, target_id
+            ''', (job_id, now, job_id, now - timedelta(seconds=LOCKDOWN_ITEM_LEASE), LOCKDOWN_JOB_BATCH_SIZE))
+            return cur.fetchall()
+    
+    async def _checkpoint(self, job_id, states):
+        async with db.cursor() as cur:
+            await cur.call(execute_values, '''
+                UPDATE lockdown_job_items AS i SET state = v.state
+                FROM (VALUES %s) AS v(job_id, kind, target_id, state)
+                WHERE i.job_id = v.job_id AND i.kind = v.kind AND i.target_id = v.target_id
+            ''', [(job_id, kind, target_id, state) for (kind, target_id), state in states.items()])
+    
+    async def _job_progress(self, job_id):
+        """Item counts by state, and whether the job is still running"""
+        async with db.cursor(dict_rows=True) as cur:
+            await cur.execute('SELECT status FROM lockdown_jobs WHERE job_id = %s', (job_id,))
+            job = cur.fetchone()
+            await cur.execute('''
+                SELECT state, COUNT(*) as count FROM lockdown_job_items WHERE job_id = %s GROUP BY state
+            ''', (job_id,))
+            counts = {row['state']: row['count'] for row in cur.fetchall()}
+        return counts, job is not None and job['status'] == 'running'
+    
+    async def _load_snapshots(self, cur, guild_id):
+        await cur.execute('''
+            SELECT p.channel_id, b.data FROM lockdown_permissions p
+            JOIN snapshot_blobs b ON b.hash = p.snapshot_hash
+            WHERE p.guild_id = %s
+        ''', (guild_id,))
+        stored = {row['channel_id']: row['data'] for row in cur.fetchall()}
+        
+        await cur.execute('''
+            SELECT role_id, permissions FROM lockdown_role_permissions WHERE guild_id = %s
+        ''', (guild_id,))
+        stored_roles = {row['role_id']: row['permissions'] for row in cur.fetchall()}
+        return stored, stored_roles
+    
+    async def _snapshot_channels(self, cur, guild, channels):
+        """Save channel overwrites before any channel is touched, in the caller's transaction.
+        
+        Channels synced to the same category share identical overwrites, so each distinct
+        packed snapshot is stored once in snapshot_blobs and channels point at its hash.
+        A snapshot left by a failed unlock is kept: it holds the state from before that
+        lockdown, while the channel itself is still locked.
+        """
+        blobs = {}
+        rows = []
+        for channel in channels:
+            blob = snapshot_overwrites(channel)
+            h = snapshot_hash(blob)
+            blobs[h] = blob
+            rows.append((guild.id, channel.id, psycopg2.Binary(h)))
+        if not rows:
+            return
+        
+        await cur.call(store_snapshot_blobs, blobs)
+        await cur.call(execute_values, '''
+            INSERT INTO lockdown_permissions (guild_id, channel_id, snapshot_hash)
+            VALUES %s
+            ON CONFLICT (guild_id, channel_id) DO NOTHING
+        ''', rows)
+        metrics.incr('lockdown.snapshots', len(rows))
+        metrics.incr('lockdown.snapshot_blobs', len(blobs))
+    
+    async def _snapshot_roles(self, cur, guild, roles):
+        await cur.call(execute_values, '''
+            INSERT INTO lockdown_role_permissions (guild_id, role_id, permissions)
+            VALUES %s
+            ON CONFLICT (guild_id, role_id) DO NOTHING
+        ''', [(guild.id, role.id, role.permissions.value) for role in roles])
+    
+    async def _handlers(self, guild, job, config):
+        """The edit to apply for each item kind of a job"""
+        revoked = LOCKDOWN_REVOKED_PERMISSIONS.value
+        announcement_channel_id = config['announcement_channel_id'] if config else None
+        
+        if job['action'] == 'unlock':
+            async with db.cursor(dict_rows=True) as cur:
+                stored, stored_roles = await self._load_snapshots(cur, guild.id)
+            
+            async def unlock_role(role):
+                await role.edit(permissions=discord.Permissions(restored_role_value(role, stored_roles[role.id])))
+            
+            async def unlock_channel(channel):
+                blob = stored.get(channel.id)
+                if blob is not None:
+                    try:
+                        await restore_overwrites(guild, channel, blob)
+                        return
+                    except discord.HTTPException as e:
+                        if e.status == 429 or e.status >= 500:
+                            raise
+                        print(f'Error restoring permissions for {channel.name}: {e}')
+                    except Exception as e:
+                        print(f'Error restoring permissions for {channel.name}: {e}')
+                
+                overwrites = channel.overwrites
+                if guild.default_role in overwrites:
+                    del overwrites[guild.default_role]
+                    await channel.edit(overwrites=overwrites)
+            
+            async def unlock_synced(channel):
+                # Restoring the category may already have put the child back
+                if channel_needs_restore(guild, channel, stored.get(channel.id)):
+                    await unlock_channel(channel)
+            
+            return {'role': unlock_role, 'channel': unlock_channel, 'synced': unlock_synced}
+        
+        async with db.cursor() as cur:
+            await cur.execute('''
+                SELECT target_id FROM lockdown_job_items WHERE job_id = %s AND kind = 'role'
+            ''', (job['job_id'],))
+            locked_ids = {row[0] for row in cur.fetchall()}
+        
+        async def lock_role(role):
+            await role.edit(permissions=discord.Permissions(role.permissions.value & ~revoked))
+        
+        async def lock_channel(channel):
+            overwrites = channel.overwrites
+            if job['mode'] == 'role':
+                for target, overwrite in overwrites.items():
+                    if isinstance(target, discord.Role) and target.id in locked_ids:
+                        # Clearing the allow lets the role-level revoke apply here too
+                        for perm_name, revoke in LOCKDOWN_REVOKED_PERMISSIONS:
+                            if revoke and getattr(overwrite, perm_name):
+                                setattr(overwrite, perm_name, None)
+            
+            if channel.id == announcement_channel_id:
+                overwrites[guild.default_role] = discord.PermissionOverwrite(
+                    view_channel=True,
+                    send_messages=False,
+                    add_reactions=False
+                )
+            elif job['mode'] != 'role':
+                overwrites[guild.default_role] = discord.PermissionOverwrite(
+                    view_channel=False
+                )
+            
+            await channel.edit(overwrites=overwrites)
+        
+        async def lock_synced(channel):
+            category = channel.category
+            if category is None or category.overwrites_for(guild.default_role).view_channel is not False:
+                # The category itself didn't get locked, so lock the channel directly
+                await lock_channel(channel)
+            else:
+                # Discord doesn't copy category edits to its children, so each one is re-synced
+                await channel.edit(sync_permissions=True)
+        
+        return {'role': lock_role, 'channel': lock_channel, 'synced': lock_synced}
+    
+    async def _run_job(self, guild, job, progress):
+        """Work through a job's items until none are left; returns its counts, or None if cancelled"""
+        async with db.cursor(dict_rows=True) as cur:
+            await cur.execute('SELECT * FROM lockdown_config WHERE guild_id = %s', (guild.id,))
+            config = cur.fetchone()
+        handlers = await self._handlers(guild, job, config)
+        
+        while True:
+            batch = await self._claim_items(job['job_id'])
+            if not batch:
+                counts, running = await self._job_progress(job['job_id'])
+                if not running:
+                    return None
+                if not counts.get('pending') and not counts.get('running'):
+                    break
+                # Another process holds the rest; wait for it to finish or for its lease to run out
+                await asyncio.sleep(5)
+                continue
+            
+            states = {}
+            targets = []
+            for kind, target_id in batch:
+                target = guild.get_role(target_id) if kind == 'role' else guild.get_channel(target_id)
+                if target is None:
+                    # Deleted since the job started, so there is nothing left to change
+                    states[(kind, target_id)] = 'done'
+                else:
+                    states[(kind, target_id)] = 'failed'
+                    targets.append(target)
+            
+            async def edit(target):
+                await handlers[kind](target)
+                states[(kind, target.id)] = 'done'
+            
+            await channel_edit_scheduler.run(targets, edit)
+            await self._checkpoint(job['job_id'], states)
+            
+            if progress is not None:
+                counts, _ = await self._job_progress(job['job_id'])
+                try:
+                    await progress(counts.get('done', 0), counts.get('failed', 0), sum(counts.values()))
+                except Exception as e:
+                    print(f'Error reporting lockdown progress: {e}')
+        
+        return await self._finish_job(guild, job, config)
+    
+    async def _finish_job(self, guild, job, config):
+        async with db.cursor(dict_rows=True) as cur:
+            await cur.execute('''
+                UPDATE lockdown_jobs SET status = 'done', finished_at = %s
+                WHERE job_id = %s AND status = 'running'
+                RETURNING *
+            ''', (datetime.now(), job['job_id']))
+            finished = cur.fetchone()
+            
+            await cur.execute('''
+                SELECT state, COUNT(*) as count FROM lockdown_job_items WHERE job_id = %s GROUP BY state
+            ''', (job['job_id'],))
+            counts = {row['state']: row['count'] for row in cur.fetchall()}
+            
+            if finished and job['action'] == 'unlock':
+                # Failed items are still locked, so their snapshots stay for the next unlock
+                await cur.execute('''
+                    DELETE FROM lockdown_permissions p WHERE guild_id = %s AND NOT EXISTS (
+                        SELECT 1 FROM lockdown_job_items i
+                        WHERE i.job_id = %s AND i.kind IN ('channel', 'synced')
+                        AND i.target_id = p.channel_id AND i.state <> 'done'
+                    )
+                ''', (guild.id, job['job_id']))
+                await cur.execute('''
+                    DELETE FROM lockdown_role_permissions r WHERE guild_id = %s AND NOT EXISTS (
+                        SELECT 1 FROM lockdown_job_items i
+                        WHERE i.job_id = %s AND i.kind = 'role' AND i.target_id = r.role_id AND i.state <> 'done'
+                    )
+                ''', (guild.id, job['job_id']))
+        
+        result = {'done': counts.get('done', 0), 'failed': counts.get('failed', 0), 'skipped': job['skipped']}
+        if not finished:
+            # Another process finished the job and sent the announcement
+            return result
+        
+        elapsed = (finished['finished_at'] - job['created_at']).total_seconds()
+        if job['action'] == 'lock':
+            metrics.observe('lockdown.activate', elapsed)
+            await self._announce_activated(guild, config, job, result, elapsed)
+            log_event(guild.id, 'lockdown_activated', actor_user_id=job['actor_id'],
+                     details={'reason': job['reason'], 'automatic': job['automatic'], 'mode': job['mode']})
+        else:
+            metrics.observe('lockdown.deactivate', elapsed)
+            await self._announce_deactivated(guild, config, job, result, elapsed)
+            log_event(guild.id, 'lockdown_deactivated', actor_user_id=job['actor_id'])
+        return result
+    
+    async def _announce_activated(self, guild, config, job, result, elapsed):
+        announcement_channel = guild.get_channel(config['announcement_channel_id']) if config else None
+        if not announcement_channel:
+            return
+        
+        director_role = guild.get_role(config['director_role_id']) if config['director_role_id'] else None
+        
+        embed = discord.Embed(
+            title="🚨 EMERGENCY LOCKDOWN ACTIVATED 🚨",
+            description=f"**The server is now under emergency lockdown.**\n\nAll non-essential communications are restricted.",
+            color=discord.Color.red(),
+            timestamp=datetime.now()
+        )
+        embed.add_field(name="Initiated By", value="🤖 Anti-Raid System" if job['automatic'] else f"<@{job['actor_id']}>", inline=True)
+        embed.add_field(name="Completed", value=lockdown_summary(result['done'], result['failed'], elapsed, job['mode']), inline=True)
+        embed.add_field(name="Reason", value=job['reason'], inline=False)
+        embed.add_field(name="Instructions", value="Stay calm and await further instructions from leadership.", inline=False)
+        embed.set_footer(text="This is an emergency protocol")
+        
+        if director_role:
+            await announcement_channel.send(f'{director_role.mention} @everyone', embed=embed)
+        else:
+            await announcement_channel.send('@everyone', embed=embed)
+    
+    async def _announce_deactivated(self, guild, config, job, result, elapsed):
+        announcement_channel = guild.get_channel(config['announcement_channel_id']) if config else None
+        if not announcement_channel:
+            return
+        
+        embed = discord.Embed(
+            title="✅ LOCKDOWN DEACTIVATED",
+            description="The emergency lockdown has been lifted. Normal operations may resume.",
+            color=discord.Color.green(),
+            timestamp=datetime.now()
+        )
+        embed.add_field(name="Deactivated By", value=f"<@{job['actor_id']}>", inline=True)
+        embed.add_field(name="Completed", value=lockdown_summary(result['done'], result['failed'], elapsed, job['mode'], result['skipped']), inline=True)
+        embed.set_footer(text="Emergency protocol ended")
+        
+        await announcement_channel.send(embed=embed)
+
+lockdown_engine = LockdownEngine()
+
+SnapshotItem = namedtuple('SnapshotItem', 'kind object_id name data')
+
+def serialize_snapshot_item(data):
+    """Encode a role or channel snapshot so unchanged objects always give the same bytes"""
+    return json.dumps(data, sort_keys=True, separators=(',', ':')).encode()
+
+def snapshot_role(role):
+    return {
+        'name': role.name,
+        'permissions': role.permissions.value,
+        'color': role.color.value,
+        'hoist': role.hoist,
+        'mentionable': role.mentionable,
+        'position': role.position,
+    }
+
+def snapshot_channel(channel):
+    data = {
+        'name': channel.name,
+        'type': channel.type.value,
+        'position': channel.position,
+        'category_id': channel.category_id,
+        'overwrites': [list(entry) for entry in unpack_overwrites(snapshot_overwrites(channel))],
+    }
+    for attr in ('topic', 'nsfw', 'slowmode_delay', 'bitrate', 'user_limit'):
+        value = getattr(channel, attr, None)
+        if value is not None:
+            data[attr] = value
+    return data
+
+class GuildSnapshotter:
+    """Periodic snapshots of a guild's roles, channels, categories and overwrites, and restore.
+    
+    Every role and channel is serialized on its own and stored by content hash in
+    snapshot_blobs, so a snapshot is just a list of (kind, id, hash) rows and objects that
+    didn't change between runs cost nothing extra. If nothing changed at all since the last
+    snapshot, no new one is written. Only the newest GUILD_SNAPSHOT_KEEP are kept per guild.
+    
+    Restore only recreates what is missing: roles first, then categories, then channels, and
+    finally adds overwrites for recreated roles back onto channels that still exist. Creates go
+    through channel_edit_scheduler so they stay under the rate limits.
+    """
+    
+    def __init__(self):
+        self._latest = {}
+        self._restoring = set()
+    
+    def is_restoring(self, guild_id):
+        return guild_id in self._restoring
+    
+    async def _latest_items(self, guild_id):
+        if guild_id not in self._latest:
+            async with db.cursor() as cur:
+                await cur.execute('''
+                    SELECT kind, object_id, item_hash FROM guild_snapshot_items
+                    WHERE snapshot_id = (SELECT MAX(snapshot_id) FROM guild_snapshots WHERE guild_id = %s)
+                ''', (guild_id,))
+                self._latest[guild_id] = {(kind, object_id): bytes(h) for kind, object_id, h in cur.fetchall()}
+        return self._latest[guild_id]
+    
+    async def take(self, guild):
+        """Snapshot the guild; returns the new snapshot_id, or None if nothing changed"""
+        items = {}
+        for role in guild.roles:
+            if not role.is_default() and not role.managed:
+                items[('role', role.id)] = serialize_snapshot_item(snapshot_role(role))
+        for channel in guild.channels:
+            items[('channel', channel.id)] = serialize_snapshot_item(snapshot_channel(channel))
+        hashes = {key: snapshot_hash(blob) for key, blob in items.items()}
+        
+        previous = await self._latest_items(guild.id)
+        if hashes == previous:
+            metrics.incr('guild_snapshots.unchanged')
+            return None
+        
+        blobs = {hashes[key]: blob for key, blob in items.items() if previous.get(key) != hashes[key]}
+        async with db.cursor() as cur:
+            await cur.execute('''
+                INSERT INTO guild_snapshots (guild_id, role_count, channel_count)
+                VALUES (%s, %s, %s) RETURNING snapshot_id
+            ''', (guild.id, sum(1 for kind, _ in hashes if kind == 'role'),
+                  sum(1 for kind, _ in hashes if kind == 'channel')))
+            snapshot_id = cur.fetchone()[0]
+            await cur.call(store_snapshot_blobs, blobs)
+            await cur.call(execute_values, '''
+                INSERT INTO guild_snapshot_items (snapshot_id, kind, object_id, item_hash) VALUES %s
+            ''', [(snapshot_id, kind, object_id, psycopg2.Binary(h)) for (kind, object_id), h in hashes.items()])
+            await cur.execute('''
+                DELETE FROM guild_snapshots WHERE guild_id = %s AND snapshot_id NOT IN (
+                    SELECT snapshot_id FROM guild_snapshots WHERE guild_id = %s
+                    ORDER BY snapshot_id DESC LIMIT %s
+                )
+            ''', (guild.id, guild.id, GUILD_SNAPSHOT_KEEP))
+        
+        self._latest[guild.id] = hashes
+        metrics.incr('guild_snapshots.taken')
+        metrics.incr('guild_snapshots.new_blobs', len(blobs))
+        return snapshot_id
+    
+    async def collect_garbage(self):
+        """Delete snapshot_blobs no lockdown or guild snapshot points at; returns how many.
+        
+        Blobs are shared between guilds and processes, so this only runs while no writer
+        holds the shared blob lock, and skips the round if another process is collecting.
+        """
+        async with db.cursor() as cur:
+            await cur.execute('SELECT pg_try_advisory_xact_lock(%s)', (SNAPSHOT_BLOB_LOCK,))
+            if not cur.fetchone()[0]:
+                return 0
+            await cur.execute('''
+                DELETE FROM snapshot_blobs b
+                WHERE NOT EXISTS (SELECT 1 FROM lockdown_permissions p WHERE p.snapshot_hash = b.hash)
+                AND NOT EXISTS (SELECT 1 FROM guild_snapshot_items i WHERE i.item_hash = b.hash)
+            ''')
+            removed = cur.rowcount
+        metrics.incr('guild_snapshots.blobs_collected', removed)
+        return removed
+    
+    async def recent(self, guild_id, limit=10):
+        async with db.cursor(dict_rows=True) as cur:
+            await cur.execute('''
+                SELECT * FROM guild_snapshots WHERE guild_id = %s ORDER BY snapshot_id DESC LIMIT %s
+            ''', (guild_id, limit))
+            return cur.fetchall()
+    
+    async def load(self, guild_id, snapshot_id=None):
+        """The snapshot row plus its roles and channels as SnapshotItems, or None if not found"""
+        async with db.cursor(dict_rows=True) as cur:
+            if snapshot_id is None:
+                await cur.execute('''
+                    SELECT * FROM guild_snapshots WHERE guild_id = %s ORDER BY snapshot_id DESC LIMIT 1
+                ''', (guild_id,))
+            else:
+                await cur.execute('''
+                    SELECT * FROM guild_snapshots WHERE guild_id = %s AND snapshot_id = %s
+                ''', (guild_id, snapshot_id))
+            snapshot = cur.fetchone()
+            if not snapshot:
+                return None
+            
+            await cur.execute('''
+                SELECT i.kind, i.object_id, b.data FROM guild_snapshot_items i
+                JOIN snapshot_blobs b ON b.hash = i.item_hash
+                WHERE i.snapshot_id = %s
+            ''', (snapshot['snapshot_id'],))
+            rows = cur.fetchall()
+        
+        items = []
+        for row in rows:
+            data = json.loads(bytes(row['data']))
+            items.append(SnapshotItem(row['kind'], row['object_id'], data['name'], data))
+        return snapshot, items
+    
+    def _overwrites(self, guild, entries, role_map):
+        overwrites = {}
+        for target_type, target_id, allow, deny in entries:
+            if target_type == SNAPSHOT_ROLE:
+                target = role_map.get(target_id) or guild.get_role(target_id)
+            else:
+                target = guild.get_member(target_id)
+            if target:
+                overwrites[target] = discord.PermissionOverwrite.from_pair(
+                    discord.Permissions(allow), discord.Permissions(deny)
+                )
+        return overwrites
+    
+    async def restore(self, guild, items, reason, progress=None):
+        """Recreate missing roles and channels from a loaded snapshot.
+        
+        progress(stage, done, failed, total) is awaited as each stage runs. Returns a dict of
+        stage name to (done, failed), or None if a restore is already running for the guild.
+        """
+        if guild.id in self._restoring:
+            return None
+        self._restoring.add(guild.id)
+        try:
+            return await self._restore(guild, items, reason, progress)
+        finally:
+            self._restoring.discard(guild.id)
+    
+    async def _restore(self, guild, items, reason, progress):
+        results = {}
+        role_map = {}
+        channel_map = {}
+        
+        def stage_progress(stage):
+            if progress is None:
+                return None
+            async def report(done, failed, total):
+                await progress(stage, done, failed, total)
+            return report
+        
+        # The bot can only hand out permissions it has itself
+        me = guild.me
+        grantable = (discord.Permissions.all().value if me.guild_permissions.administrator
+                     else me.guild_permissions.value)
+        
+        async def create_role(item):
+            data = item.data
+            role_map[item.object_id] = await guild.create_role(
+                name=data['name'],
+                permissions=discord.Permissions(data['permissions'] & grantable),
+                colour=discord.Colour(data['color']),
+                hoist=data['hoist'],
+                mentionable=data['mentionable'],
+                reason=reason
+            )
+        
+        roles = sorted((item for item in items if item.kind == 'role' and not guild.get_role(item.object_id)),
+                       key=lambda item: item.data['position'])
+        done, failed, _ = await channel_edit_scheduler.run(roles, create_role, stage_progress('roles'))
+        results['roles'] = (done, failed)
+        
+        # Put recreated roles back near their old place, but never above the bot's own role
+        positions = {}
+        for item in roles:
+            role = role_map.get(item.object_id)
+            if role:
+                positions[role] = max(1, min(item.data['position'], me.top_role.position - 1))
+        if positions:
+            try:
+                await guild.edit_role_positions(positions, reason=reason)
+            except discord.HTTPException as e:
+                print(f'Error moving restored roles: {e}')
+        
+        async def create_channel(item):
+            data = item.data
+            overwrites = self._overwrites(guild, data['overwrites'], role_map)
+            category = None
+            if data.get('category_id'):
+                category = channel_map.get(data['category_id']) or guild.get_channel(data['category_id'])
+            
+            channel_type = discord.ChannelType(data['type'])
+            options = {'overwrites': overwrites, 'position': data['position'], 'reason': reason}
+            if channel_type == discord.ChannelType.category:
+                channel = await guild.create_category(data['name'], **options)
+            elif channel_type in (discord.ChannelType.voice, discord.ChannelType.stage_voice):
+                options['category'] = category
+                if channel_type == discord.ChannelType.stage_voice:
+                    channel = await guild.create_stage_channel(data['name'], **options)
+                else:
+                    channel = await guild.create_voice_channel(
+                        data['name'], bitrate=min(data.get('bitrate', 64000), int(guild.bitrate_limit)),
+                        user_limit=data.get('user_limit', 0), **options
+                    )
+            elif channel_type == discord.ChannelType.forum:
+                channel = await guild.create_forum(
+                    data['name'], category=category, topic=data.get('topic') or '',
+                    nsfw=data.get('nsfw', False), **options
+                )
+            else:
+                channel = await guild.create_text_channel(
+                    data['name'], category=category, topic=data.get('topic'), nsfw=data.get('nsfw', False),
+                    slowmode_delay=data.get('slowmode_delay', 0),
+                    news=channel_type == discord.ChannelType.news, **options
+                )
+            channel_map[item.object_id] = channel
+        
+        missing = sorted((item for item in items if item.kind == 'channel' and not guild.get_channel(item.object_id)),
+                         key=lambda item: item.data['position'])
+        categories = [item for item in missing if item.data['type'] == discord.ChannelType.category.value]
+        channels = [item for item in missing if item.data['type'] != discord.ChannelType.category.value]
+        
+        done, failed, _ = await channel_edit_scheduler.run(categories, create_channel, stage_progress('categories'))
+        results['categories'] = (done, failed)
+        done, failed, _ = await channel_edit_scheduler.run(channels, create_channel, stage_progress('channels'))
+        results['channels'] = (done, failed)
+        
+        # Channels that survived lost their overwrites for any role that was deleted
+        recreated = set(role_map)
+        stale = []
+        for item in items:
+            channel = guild.get_channel(item.object_id) if item.kind == 'channel' else None
+            if channel and any(entry[0] == SNAPSHOT_ROLE and entry[1] in recreated for entry in item.data['overwrites']):
+                stale.append(channel)
+        entries = {item.object_id: item.data['overwrites'] for item in items if item.kind == 'channel'}
+        
+        async def fix_overwrites(channel):
+            restored = self._overwrites(
+                guild, [entry for entry in entries[channel.id] if entry[0] == SNAPSHOT_ROLE and entry[1] in recreated],
+                role_map
+            )
+            await channel.edit(overwrites={**channel.overwrites, **restored}, reason=reason)
+        
+        done, failed, _ = await channel_edit_scheduler.run(stale, fix_overwrites, stage_progress('overwrites'))
+        results['overwrites'] = (done, failed)
+        
+        metrics.incr('guild_snapshots.restores')
+        return results
+
+guild_snapshotter = GuildSnapshotter()
+
+AVATAR_HASH_PATTERN = re.compile(r'^(?:a_)?([0-9a-f]{32})$')
+
+def parse_blocklist(path):
+    """Read a blocklist file into sorted arrays: (user_ids, avatar_hi, avatar_lo).
+    
+    One entry per line: a user ID, or an avatar hash (32 hex characters, with or without the
+    'a_' animated prefix). Blank lines and anything after '#' are ignored. Avatar hashes are
+    split into high and low 64-bit halves sorted together, so both fit in plain arrays.
+    """
+    user_ids = set()
+    avatars = set()
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip().lower()
+            if not line:
+                continue
+            if line.isdigit():
+                user_ids.add(int(line))
+                continue
+            match = AVATAR_HASH_PATTERN.match(line)
+            if match:
+                value = int(match.group(1), 16)
+                avatars.add((value >> 64, value & 0xFFFFFFFFFFFFFFFF))
+    avatars = sorted(avatars)
+    return (array.array('Q', sorted(user_ids)),
+            array.array('Q', (hi for hi, _ in avatars)),
+            array.array('Q', (lo for _, lo in avatars)))
+
+class BlocklistIndex:
+    """In-memory index of known raider user IDs and avatar hashes, checked on every join.
+    
+    IDs live in one sorted array('Q') and avatar hashes in two (high and low halves), so a
+    lookup is a bisect over contiguous memory: a few microseconds even with millions of
+    entries. Memory is 8 bytes per user ID and 16 per avatar hash, about 4 MB for 500,000
+    IDs, with no per-entry Python objects. The file is parsed off the event loop and the
+    arrays are swapped in whole, so lookups never see a half-loaded list. reload_if_changed
+    re-reads it when its modification time changes.
+    """
+    
+    def __init__(self, path=BLOCKLIST_PATH):
+        self.path = path
+        self._user_ids = array.array('Q')
+        self._avatar_hi = array.array('Q')
+        self._avatar_lo = array.array('Q')
+        self._mtime = None
+        self.loaded_at = None
+    
+    def __len__(self):
+        return len(self._user_ids) + len(self._avatar_hi)
+    
+    @property
+    def memory_bytes(self):
+        return sum(a.itemsize * len(a) for a in (self._user_ids, self._avatar_hi, self._avatar_lo))
+    
+    def has_user(self, user_id):
+        user_ids = self._user_ids
+        index = bisect.bisect_left(user_ids, user_id)
+        return index < len(user_ids) and user_ids[index] == user_id
+    
+    def has_avatar(self, avatar_hash):
+        match = AVATAR_HASH_PATTERN.match(avatar_hash or '')
+        if not match:
+            return False
+        value = int(match.group(1), 16)
+        hi, lo = value >> 64, value & 0xFFFFFFFFFFFFFFFF
+        avatar_hi, avatar_lo = self._avatar_hi, self._avatar_lo
+        index = bisect.bisect_left(avatar_hi, hi)
+        while index < len(avatar_hi) and avatar_hi[index] == hi:
+            if avatar_lo[index] == lo:
+                return True
+            index += 1
+        return False
+    
+    def match(self, member):
+        """Why a member is on the blocklist ('user_id' or 'avatar'), or None"""
+        if self.has_user(member.id):
+            return 'user_id'
+        if member.avatar and self.has_avatar(member.avatar.key):
+            return 'avatar'
+        return None
+    
+    async def reload(self):
+        """Re-read the blocklist file; returns the number of entries loaded"""
+        started = time.perf_counter()
+        mtime = os.stat(self.path).st_mtime
+        loop = asyncio.get_running_loop()
+        user_ids, avatar_hi, avatar_lo = await loop.run_in_executor(None, parse_blocklist, self.path)
+        self._user_ids, self._avatar_hi, self._avatar_lo = user_ids, avatar_hi, avatar_lo
+        self._mtime = mtime
+        self.loaded_at = datetime.now()
+        metrics.observe('blocklist.reload', time.perf_counter() - started)
+        return len(self)
+    
+    async def reload_if_changed(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return False
+        if mtime == self._mtime:
+            return False
+        count = await self.reload()
+        print(f'Loaded {count} blocklist entries from {self.path} ({self.memory_bytes // 1024} KB)')
+        return True
+
+blocklist = BlocklistIndex()
+
+async def check_blocklist(member):
+    """Act on a joining member who is on the blocklist; returns True if they were removed or quarantined"""
+    reason = blocklist.match(member)
+    if not reason:
+        return False
+    
+    guild = member.guild
+    metrics.incr('blocklist.hits')
+    config = await config_cache.get('security_config', guild.id)
+    action = (config or {}).get('blocklist_action') or 'alert'
+    if action == 'off':
+        return False
+    
+    outcome = "⚠️ Alert only"
+    acted = False
+    try:
+        if action == 'ban':
+            await member.ban(reason=f'Blocklist match ({reason})', delete_message_days=0)
+            outcome = "🔨 Banned"
+            acted = True
+        elif action == 'quarantine':
+            await quarantine_member(member, f'Blocklist match ({reason})', timeout=timedelta(days=7))
+            outcome = "🔒 Timed out for 7 days"
+            acted = True
+    except discord.HTTPException as e:
+        outcome = f"❌ Could not {action}: {e}"
+        print(f'Error acting on blocklist match {member}: {e}')
+    
+    log_event(guild.id, 'blocklist_match', target_user_id=member.id,
+             details={'match': reason, 'action': action, 'acted': acted})
+    
+    embed = discord.Embed(
+        title="⛔ BLOCKLISTED ACCOUNT JOINED",
+        description=f"{member.mention} ({member.id}) matches the blocklist by {'user ID' if reason == 'user_id' else 'avatar'}.",
+        color=discord.Color.dark_red(),
+        timestamp=datetime.now()
+    )
+    embed.add_field(name="Response", value=outcome[:1024], inline=False)
+    
+    if config and config['alert_role_id']:
+        alert_role = guild.get_role(config['alert_role_id'])
+        if alert_role:
+            embed.description = f"{alert_role.mention}\n\n" + embed.description
+    
+    await send_global_log(guild, 'blocklist_match', embed)
+    return acted
+
+def name_pattern_source(row):
+    """Regex source for one name_patterns row; plain patterns match as literal text"""
+    return row['pattern'] if row['is_regex'] else re.escape(row['pattern'])
+
+NAME_PATTERN_MAX_LENGTH = 100
+REGEX_QUANTIFIER = re.compile(r'\{(\d*)(,?)(\d*)\}')
+
+def name_pattern_problem(pattern):
+    """Why a regex name pattern can't be used, or None if it can.
+    
+    All of a guild's patterns run on the event loop as one combined regex for every join, so
+    named groups, backreferences and conditionals (which clash with the other patterns'
+    groups) are refused, and so is a repeated group holding another repeat or an
+    alternation, like (a+)+ or (a|ab)*, which can take exponential time on a short name.
+    """
+    if len(pattern) > NAME_PATTERN_MAX_LENGTH:
+        return f'patterns can be at most {NAME_PATTERN_MAX_LENGTH} characters'
+    try:
+        re.compile(pattern)
+    except re.error as e:
+        return f'invalid regular expression: {e}'
+    
+    # One [has a repeat, has an alternation] entry per open group
+    groups = [[False, False]]
+    closed = None
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        repeats = char in '*+'
+        if char == '{':
+            bounds = REGEX_QUANTIFIER.match(pattern, i)
+            if bounds:
+                low, comma, high = bounds.groups()
+                repeats = bool(comma and not high) or int((high if comma else low) or 0) > 1
+                i = bounds.end() - 1
+        
+        if repeats:
+            if closed and (closed[0] or closed[1]):
+                return 'a repeated group may not contain another repeat or an alternation'
+            groups[-1][0] = True
+            closed = None
+        elif char == '\\':
+            if pattern[i + 1:i + 2] in set('123456789'):
+                return 'backreferences are not allowed'
+            closed = None
+            i += 1
+        elif char == '[':
+            i += 1
+            if pattern[i:i + 1] == '^':
+                i += 1
+            if pattern[i:i + 1] == ']':
+                i += 1
+            while i < len(pattern) and pattern[i] != ']':
+                i += 2 if pattern[i] == '\\' else 1
+            closed = None
+        elif char == '(':
+            if pattern.startswith(('(?P', '(?('), i):
+                return 'named groups, backreferences and conditionals are not allowed'
+            groups.append([False, False])
+            closed = None
+        elif char == ')':
+            closed = groups.pop()
+            groups[-1][0] |= closed[0]
+            groups[-1][1] |= closed[1]
+        elif char == '|':
+            groups[-1][1] = True
+            closed = None
+        elif char != '?':
+            closed = None
+        i += 1
+    
+    try:
+        # As one alternative among others, the way it is combined; catches inline flags
+        re.compile(f'x|(?P<p0>{pattern})')
+    except re.error as e:
+        return f'it can\'t be combined with other patterns: {e}'
+    return None
+
+class NamePatternMatcher:
+    """Checks joiners' names against a guild's name_patterns in a single pass.
+    
+    All of a guild's patterns are compiled into one case-insensitive regex with a named
+    group per pattern, so a joiner's username, global name and nickname are scanned once no
+    matter how many rules there are. The names are joined one per line and ^/$ match per
+    line. The rows come from config_cache; when they are refreshed or invalidated the cached
+    list object changes and the regex is rebuilt.
+    
+    Matches don't overlap, and where several patterns match at the same spot only the first
+    alternative counts, so patterns are ordered highest weight first, then longest first
+    (discord\\.gg before discord). A pattern whose whole match is inside another's still
+    goes uncounted. Regex patterns that name_pattern_problem refuses are skipped.
+    """
+    
+    def __init__(self):
+        self._compiled = {}
+    
+    def _compile(self, guild_id, rows):
+        compiled = self._compiled.get(guild_id)
+        if compiled is not None and compiled[0] is rows:
+            return compiled
+        
+        patterns = {}
+        parts = []
+        regex = None
+        for row in sorted(rows, key=lambda row: (-row['weight'], -len(name_pattern_source(row)))):
+            problem = name_pattern_problem(row['pattern']) if row['is_regex'] else None
+            if problem:
+                print(f'Skipping name pattern {row["id"]}: {problem}')
+                continue
+            part = f"(?P<p{row['id']}>{name_pattern_source(row)})"
+            try:
+                # Compile with the patterns kept so far, so one that breaks the combined
+                # regex is dropped on its own instead of taking the others with it
+                regex = re.compile('|'.join(parts + [part]), re.IGNORECASE | re.MULTILINE)
+            except re.error as e:
+                print(f'Skipping name pattern {row["id"]}: {e}')
+                continue
+            patterns[f"p{row['id']}"] = row
+            parts.append(part)
+        compiled = (rows, regex, patterns)
+        self._compiled[guild_id] = compiled
+        metrics.incr('name_patterns.compiles')
+        return compiled
+    
+    async def match(self, guild_id, names):
+        """The name_patterns rows matched by any of the given names"""
+        rows = await config_cache.get('name_patterns', guild_id)
+        if not rows:
+            self._compiled.pop(guild_id, None)
+            return []
+        
+        _, regex, patterns = self._compile(guild_id, rows)
+        if regex is None:
+            return []
+        text = '\n'.join(name for name in names if name)
+        matched = {match.lastgroup: patterns[match.lastgroup] for match in regex.finditer(text)}
+        return list(matched.values())
+
+name_matcher = NamePatternMatcher()
+
+class RaidMode:
+    """Holds back per-member welcomes and auto-roles while a guild is being raided.
+    
+    A raid or join wave switches the guild into raid mode; joins in raid mode are only
+    recorded here. Once no raid has been detected for RAID_MODE_QUIET_SECONDS and no lockdown
+    is active, one summary welcome is posted and the deferred auto-roles are handed out in the
+    background through channel_edit_scheduler, skipping anyone who left or was timed out.
+    The deferred list is kept in memory so joins during a raid never wait on the database.
+    """
+    
+    def __init__(self, quiet_seconds=RAID_MODE_QUIET_SECONDS):
+        self.quiet_seconds = quiet_seconds
+        self._until = {}
+        self._deferred = {}
+        self._tasks = {}
+    
+    def is_active(self, guild_id):
+        return guild_id in self._tasks
+    
+    def trigger(self, guild):
+        self._until[guild.id] = time.monotonic() + self.quiet_seconds
+        if guild.id not in self._tasks:
+            metrics.incr('raid_mode.started')
+            self._tasks[guild.id] = asyncio.create_task(self._drain(guild))
+    
+    def defer(self, member):
+        self._deferred.setdefault(member.guild.id, {})[member.id] = None
+    
+    async def _lockdown_active(self, guild_id):
+        async with db.cursor(dict_rows=True) as cur:
+            await cur.execute('SELECT is_active FROM lockdown_config WHERE guild_id = %s', (guild_id,))
+            config = cur.fetchone()
+        return bool(config and config['is_active'])
+    
+    async def _drain(self, guild):
+        try:
+            while True:
+                wait = self._until.get(guild.id, 0) - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                if lockdown_engine.is_busy(guild.id) or await self._lockdown_active(guild.id):
+                    await asyncio.sleep(self.quiet_seconds)
+                    continue
+                
+                # Joins deferred while the release below runs are picked up on the next pass
+                deferred = self._deferred.pop(guild.id, None)
+                if not deferred:
+                    break
+                await self._release(guild, list(deferred))
+        except Exception as e:
+            print(f'Error ending raid mode: {e}')
+        finally:
+            self._tasks.pop(guild.id, None)
+            self._until.pop(guild.id, None)
+    
+    async def _release(self, guild, member_ids):
+        members = []
+        for member_id in member_ids:
+            member = guild.get_member(member_id)
+            if member and not member.is_timed_out():
+                members.append(member)
+        
+        config = await config_cache.get('welcome_config', guild.id)
+        if config and config['channel_id'] and members:
+            channel = guild.get_channel(config['channel_id'])
+            if channel:
+                await channel.send(
+                    f"👋 **{len(members)} new members** joined {guild.name} in the last few minutes. Welcome, everyone!"
+                )
+        
+        done = failed = 0
+        role = guild.get_role(config['auto_role_id']) if config and config['auto_role_id'] else None
+        if role:
+            pending = [member for member in members if role not in member.roles]
+            done, failed, _ = await channel_edit_scheduler.run(
+                pending, lambda member: member.add_roles(role, reason='Auto-role held back during raid')
+            )
+        
+        log_event(guild.id, 'raid_mode_ended', details={'joined': len(member_ids), 'welcomed': len(members),
+                                                        'roles_given': done, 'roles_failed': failed})
+        
+        embed = discord.Embed(
+            title="✅ Raid Mode Ended",
+            description=f"{len(member_ids)} members joined during the raid; {len(members)} are still here and not timed out.",
+            color=discord.Color.green(),
+            timestamp=datetime.now()
+        )
+        if role:
+            embed.add_field(
+                name="Auto-Role",
+                value=f"{role.mention} given to {done} members" + (f" ({failed} failed)" if failed else ""),
+                inline=False
+            )
+        await send_global_log(guild, 'raid_detected', embed)
+
+raid_mode = RaidMode()
+
+async def start_raid_response(guild, config, embed, reason):
+    """Enter raid mode and start auto-lockdown if the guild has them on, noting both on the alert embed"""
+    if config['raid_mode'] and not raid_mode.is_active(guild.id):
+        embed.add_field(name="Raid Mode", value="⏸️ Welcomes and auto-roles paused until the raid is over", inline=False)
+    if config['raid_mode']:
+        raid_mode.trigger(guild)
+    
+    if not config['auto_lockdown'] or lockdown_engine.is_busy(guild.id):
+        return
+    
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('SELECT director_role_id, is_active FROM lockdown_config WHERE guild_id = %s', (guild.id,))
+        lockdown_config = cur.fetchone()
+    
+    # Without a Director role nobody could lift the lockdown again with /unlockdown
+    if not lockdown_config or not guild.get_role(lockdown_config['director_role_id'] or 0):
+        embed.add_field(name="Auto-Response", value="⚠️ Automatic lockdown skipped: no Director role is set. Use /setlockdownconfig.", inline=False)
+    elif lockdown_config['is_active']:
+        embed.add_field(name="Auto-Response", value="🔒 Lockdown is already active", inline=False)
+    else:
+        # Start locking before the alert goes out so channels close as early as possible
+        lockdown_engine.spawn(lockdown_engine.activate(guild, bot.user, reason, automatic=True))
+        embed.add_field(name="Auto-Response", value="🔒 Initiating automatic lockdown...", inline=False)
+
+async def report_join_wave(guild, config, wave):
+    """Alert on a batch of joiners whose accounts were created close together"""
+    count, member_ids, first, last = wave
+    first_created = datetime.utcfromtimestamp(discord.utils.DISCORD_EPOCH / 1000 + first)
+    spread = last - first
+    
+    embed = discord.Embed(
+        title="🌊 JOIN WAVE DETECTED",
+        description=f"{count} recent joiners have accounts created within "
+                    f"{max(1, round(spread / 60))} minutes of each other, around {first_created.strftime('%Y-%m-%d %H:%M')} UTC.",
+        color=discord.Color.orange(),
+        timestamp=datetime.now()
+    )
+    embed.add_field(
+        name="Members",
+        value=' '.join(f"<@{member_id}>" for member_id in member_ids)[:1024],
+        inline=False
+    )
+    
+    if config['alert_role_id']:
+        alert_role = guild.get_role(config['alert_role_id'])
+        if alert_role:
+            embed.description = f"{alert_role.mention}\n\n" + embed.description
+    
+    await start_raid_response(guild, config, embed, f"Auto-lockdown: join wave of {count} accounts created together")
+    
+    metrics.incr('raid.join_waves')
+    log_event(guild.id, 'join_wave_detected', details={'count': count, 'members': member_ids})
+    await send_global_log(guild, 'raid_detected', embed)
+
+async def check_raid_pattern(guild, member):
+    """Check if there's a raid pattern and alert if necessary; returns the name patterns the member matched"""
+    try:
+        config = await config_cache.get('security_config', guild.id)
+        
+        if not config or not config['anti_raid_enabled']:
+            return []
+        
+        # Each signal adds to the join's suspicion score: a young account, a join wave and
+        # every matching name pattern (by its weight)
+        account_age_days = (datetime.now() - member.created_at.replace(tzinfo=None)).days
+        score = 1 if account_age_days < config['min_account_age'] else 0
+        
+        try:
+            name_matches = await name_matcher.match(guild.id, (member.name, member.global_name, member.nick))
+        except Exception as e:
+            # A broken pattern must not stop the raid checks below
+            print(f'Error matching name patterns: {e}')
+            name_matches = []
+        score += sum(row['weight'] for row in name_matches)
+        
+        wave = join_wave_detector.record(guild.id, member.id, config['join_wave_size'], config['join_wave_span'])
+        if wave:
+            score += 1
+            await report_join_wave(guild, config, wave)
+        
+        is_suspicious = score > 0
+        raid_tracking_buffer.add((guild.id, member.id, datetime.now(), member.created_at.replace(tzinfo=None),
+                                  is_suspicious, score))
+        
+        tripped = raid_detector.record(guild.id, raid_detector.windows_for(config))
+        
+        if tripped:
+            window, threshold, join_count = tripped[0]
+            embed = discord.Embed(
+                title="🚨 RAID DETECTED",
+                description=f"Detected {join_count} members joining within {window} seconds!",
+                color=discord.Color.red(),
+                timestamp=datetime.now()
+            )
+            if len(tripped) > 1:
+                embed.add_field(
+                    name="Windows Triggered",
+                    value="\n".join(f"{count} joins in {seconds}s (limit {limit})" for seconds, limit, count in tripped),
+                    inline=False
+                )
+            embed.add_field(name="Latest Member", value=f"{member.mention} ({member.id})", inline=False)
+            embed.add_field(name="Account Age", value=f"{account_age_days} days", inline=True)
+            embed.add_field(name="Suspicious", value=f"Yes (score {score})" if is_suspicious else "No", inline=True)
+            
+            if config['alert_role_id']:
+                alert_role = guild.get_role(config['alert_role_id'])
+                if alert_role:
+                    embed.description = f"{alert_role.mention}\n\n" + embed.description
+            
+            await start_raid_response(guild, config, embed, f"Auto-lockdown: {join_count} joins in {window}s")
+            
+            await send_global_log(guild, 'raid_detected', embed)
+        
+        return name_matches
+    except Exception as e:
+        print(f'Error checking raid pattern: {e}')
+        return []
+
+ANTI_NUKE_ACTIONS = {
+    discord.AuditLogAction.channel_delete: 'channel_delete',
+    discord.AuditLogAction.channel_create: 'channel_create',
+    discord.AuditLogAction.role_delete: 'role_delete',
+    discord.AuditLogAction.role_update: 'role_update',
+    discord.AuditLogAction.ban: 'ban',
+    discord.AuditLogAction.kick: 'kick',
+    discord.AuditLogAction.webhook_create: 'webhook_create',
+}
+
+DEFAULT_NUKE_LIMITS = {
+    'channel_delete': (3, 10),
+    'channel_create': (6, 10),
+    'role_delete': (3, 10),
+    'role_update': (5, 10),
+    'ban': (5, 10),
+    'kick': (5, 10),
+    'webhook_create': (3, 10),
+}
+
+def parse_nuke_limits(text):
+    """Parse per-action limits like 'channel_delete:5/10,ban:3/30' into {action: (count, seconds)}"""
+    limits = {}
+    if not text:
+        return limits
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        action, _, rule = part.partition(':')
+        count, _, seconds = rule.partition('/')
+        action = action.strip().lower()
+        if action not in DEFAULT_NUKE_LIMITS:
+            raise ValueError(f'unknown action: {action}')
+        count, seconds = int(count), int(seconds)
+        if count <= 0 or seconds <= 0:
+            raise ValueError(f'limit and window must be positive: {part}')
+        limits[action] = (count, seconds)
+    return limits
+
+async def quarantine_member(member, reason, timeout=timedelta(hours=1)):
+    """Strip every role the bot can remove and time the member out; returns the roles removed"""
+    removable = [role for role in member.roles
+                 if not role.is_default() and not role.managed and role < member.guild.me.top_role]
+    if removable:
+        kept = [role for role in member.roles if role not in removable and not role.is_default()]
+        await member.edit(roles=kept, reason=reason)
+    try:
+        await member.timeout(timeout, reason=reason)
+    except discord.HTTPException as e:
+        print(f'Could not time out {member}: {e}')
+    return removable
+
+class AntiNukeTracker:
+    """Counts destructive actions per (guild, actor) over sliding windows.
+    
+    Fed from the audit log stream, so every action already has its actor. Config comes from
+    config_cache, so the hot path never waits on the database. An actor who crosses a limit
+    is quarantined once; further actions inside the window don't trigger it again.
+    """
+    
+    def __init__(self):
+        self._actions = {}
+        self._windows = {}
+        self._quarantined = {}
+        self._parsed = {}
+        self._recorded = 0
+        self._tasks = set()
+    
+    def observe(self, entry):
+        action = ANTI_NUKE_ACTIONS.get(entry.action)
+        if action is None or entry.user_id is None:
+            return
+        # Keep a reference until it finishes so the task isn't garbage collected
+        task = asyncio.create_task(self._observe(entry, action, time.monotonic()))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    def limits_for(self, config):
+        text = config.get('anti_nuke_limits') or ''
+        if text not in self._parsed:
+            limits = dict(DEFAULT_NUKE_LIMITS)
+            try:
+                limits.update(parse_nuke_limits(text))
+            except ValueError as e:
+                print(f'Ignoring invalid anti_nuke_limits {text!r}: {e}')
+            self._parsed[text] = limits
+        return self._parsed[text]
+    
+    def record(self, guild_id, actor_id, action, limit, window, now):
+        """Record one action and return how many fall inside the window if over the limit"""
+        key = (guild_id, actor_id, action)
+        actions = self._actions.setdefault(key, deque())
+        self._windows[key] = window
+        actions.append(now)
+        while actions and actions[0] <= now - window:
+            actions.popleft()
+        
+        self._recorded += 1
+        if self._recorded % 1000 == 0:
+            self._sweep(now)
+        return len(actions) if len(actions) >= limit else 0
+    
+    def _sweep(self, now):
+        # Drop actors with nothing left inside the window configured for that action
+        for key in [key for key, actions in self._actions.items() if not actions or actions[-1] <= now - self._windows[key]]:
+            del self._actions[key]
+            del self._windows[key]
+        for key in [key for key, until in self._quarantined.items() if until <= now]:
+            del self._quarantined[key]
+    
+    async def _observe(self, entry, action, now):
+        try:
+            guild = entry.guild
+            config = await config_cache.get('security_config', guild.id)
+            if not config or not config.get('anti_nuke_enabled'):
+                return
+            
+            limit, window = self.limits_for(config)[action]
+            count = self.record(guild.id, entry.user_id, action, limit, window, now)
+            if not count:
+                return
+            
+            key = (guild.id, entry.user_id)
+            if self._quarantined.get(key, 0) > now or is_trusted_actor(guild, entry.user_id, config):
+                return
+            self._quarantined[key] = now + window
+            
+            await self._respond(guild, entry.user_id, action, count, window, config)
+        except Exception as e:
+            print(f'Error in anti-nuke tracker: {e}')
+    
+    async def _respond(self, guild, actor_id, action, count, window, config):
+        metrics.incr('anti_nuke.triggered')
+        member = guild.get_member(actor_id)
+        reason = f'Anti-nuke: {count} {action} actions in {window}s'
+        
+        removed = []
+        error = None
+        if member:
+            try:
+                removed = await quarantine_member(member, reason)
+            except discord.HTTPException as e:
+                error = str(e)
+                print(f'Error quarantining {member}: {e}')
+        
+        log_event(guild.id, 'anti_nuke_triggered', target_user_id=actor_id,
+                 details={'action': action, 'count': count, 'window': window,
+                          'removed_roles': [role.id for role in removed]})
+        
+        embed = discord.Embed(
+            title="☢️ ANTI-NUKE TRIGGERED",
+            description=f"<@{actor_id}> performed **{count}** `{action}` actions within {window} seconds.",
+            color=discord.Color.dark_red(),
+            timestamp=datetime.now()
+        )
+        if error:
+            embed.add_field(name="Response", value=f"❌ Could not quarantine: {error}"[:1024], inline=False)
+        elif member:
+            embed.add_field(
+                name="Response",
+                value=f"🔒 Quarantined: removed {len(removed)} roles and timed out for 1 hour",
+                inline=False
+            )
+            if removed:
+                embed.add_field(name="Roles Removed", value=', '.join(role.mention for role in removed)[:1024], inline=False)
+        else:
+            embed.add_field(name="Response", value="⚠️ Actor is not a member (bot or webhook?) — review manually", inline=False)
+        
+        if config['alert_role_id']:
+            alert_role = guild.get_role(config['alert_role_id'])
+            if alert_role:
+                embed.description = f"{alert_role.mention}\n\n" + embed.description
+        
+        await send_global_log(guild, 'anti_nuke', embed)
+
+anti_nuke = AntiNukeTracker()
+audit_log_index.add_listener(anti_nuke.observe)
+
+# Seconds over which each automod limit applies
+AUTOMOD_WINDOWS = {'messages': 10, 'mentions': 30, 'duplicates': 60, 'links': 30}
+AUTOMOD_LIMIT_COLUMNS = {'messages': 'max_messages', 'mentions': 'max_mentions',
+                         'duplicates': 'max_duplicates', 'links': 'max_links'}
+LINK_PATTERN = re.compile(r'https?://|discord(?:app)?\.(?:gg|com/invite)/', re.IGNORECASE)
+
+class TokenBucket:
+    """Holds up to capacity tokens and refills at capacity/window per second"""
+    
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated')
+    
+    def __init__(self, capacity, window, now):
+        self.capacity = capacity
+        self.rate = capacity / window
+        self.tokens = capacity
+        self.updated = now
+    
+    def take(self, amount, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+class AutomodUserState:
+    __slots__ = ('buckets', 'recent_content', 'recent_messages', 'last_seen', 'muted_until')
+    
+    def __init__(self, now):
+        self.buckets = {}
+        self.recent_content = deque(maxlen=5)
+        self.recent_messages = deque(maxlen=10)
+        self.last_seen = now
+        self.muted_until = 0
+
+class AutomodEngine:
+    """Spam, mass-mention, duplicate and link-flood detection for on_message.
+    
+    Every (guild, user) gets a token bucket per limit; a message spends one token for the
+    message, one per mention, one per link, and one if it repeats a recent message. Running
+    out of any bucket is a violation. All state is in memory and config comes from
+    config_cache, so deciding and responding never touches the database.
+    
+    Users are kept in an LRU ordered by last message: anyone idle for AUTOMOD_IDLE_SECONDS
+    is dropped, and the least recently active go first once AUTOMOD_MAX_USERS is reached,
+    so memory stays bounded however large the guild is.
+    """
+    
+    def __init__(self, max_users=AUTOMOD_MAX_USERS, idle_seconds=AUTOMOD_IDLE_SECONDS):
+        self.max_users = max_users
+        self.idle_seconds = idle_seconds
+        self._users = OrderedDict()
+    
+    def __len__(self):
+        return len(self._users)
+    
+    def _state(self, key, now):
+        users = self._users
+        state = users.get(key)
+        if state is None:
+            state = users[key] = AutomodUserState(now)
+        else:
+            users.move_to_end(key)
+        state.last_seen = now
+        
+        while users:
+            oldest_key, oldest = next(iter(users.items()))
+            if len(users) <= self.max_users and oldest.last_seen > now - self.idle_seconds:
+                break
+            del users[oldest_key]
+            metrics.incr('automod.evictions')
+        return state
+    
+    def _bucket(self, state, name, limit, now):
+        bucket = state.buckets.get(name)
+        if bucket is None or bucket.capacity != limit:
+            bucket = state.buckets[name] = TokenBucket(limit, AUTOMOD_WINDOWS[name], now)
+        return bucket
+    
+    def check(self, message, config, now=None):
+        """Record a message and return the names of the limits it broke"""
+        now = time.monotonic() if now is None else now
+        state = self._state((message.guild.id, message.author.id), now)
+        state.recent_messages.append((message.channel.id, message.id))
+        
+        costs = {
+            'messages': 1,
+            'mentions': len(message.raw_mentions) + len(message.raw_role_mentions) + (5 if message.mention_everyone else 0),
+            'links': len(LINK_PATTERN.findall(message.content)),
+            'duplicates': 0,
+        }
+        content = message.content.strip().lower()
+        if content:
+            content_hash = hash(content)
+            if content_hash in state.recent_content:
+                costs['duplicates'] = 1
+            state.recent_content.append(content_hash)
+        
+        violations = []
+        for name, cost in costs.items():
+            limit = config[AUTOMOD_LIMIT_COLUMNS[name]]
+            if cost and limit and not self._bucket(state, name, limit, now).take(cost, now):
+                violations.append(name)
+        return violations
+    
+    def is_exempt(self, member, config):
+        if member.id == member.guild.owner_id or member.guild_permissions.manage_messages:
+            return True
+        exempt_ids = set(parse_id_list(config.get('exempt_role_ids')))
+        return bool(exempt_ids) and any(role.id in exempt_ids for role in member.roles)
+    
+    async def handle(self, message):
+        config = await config_cache.get('automod_config', message.guild.id)
+        if not config or not config['enabled'] or not isinstance(message.author, discord.Member):
+            return
+        if self.is_exempt(message.author, config):
+            return
+        
+        violations = self.check(message, config)
+        if violations:
+            await self._respond(message, config, violations)
+        
+        cluster = cross_user_spam.record(message, config)
+        if cluster:
+            await cross_user_spam.respond(message, cluster, config)
+    
+    async def _respond(self, message, config, violations):
+        metrics.incr('automod.violations')
+        now = time.monotonic()
+        member = message.author
+        state = self._state((message.guild.id, member.id), now)
+        
+        # Remove the burst, not just the message that tipped it over
+        by_channel = {}
+        for channel_id, message_id in state.recent_messages:
+            by_channel.setdefault(channel_id, []).append(discord.Object(message_id))
+        state.recent_messages.clear()
+        for channel_id, messages in by_channel.items():
+            channel = message.guild.get_channel_or_thread(channel_id)
+            if channel is None:
+                continue
+            try:
+                await channel.delete_messages(messages, reason=f"Automod: {', '.join(violations)}")
+            except discord.HTTPException as e:
+                print(f'Error deleting automod messages in {channel}: {e}')
+        
+        # Anyone already muted only has their messages cleaned up, no repeat alerts
+        if state.muted_until > now:
+            return
+        timeout_minutes = config['timeout_minutes'] or 0
+        state.muted_until = now + max(timeout_minutes * 60, AUTOMOD_WINDOWS['duplicates'])
+        
+        outcome = "🗑️ Messages deleted"
+        if timeout_minutes:
+            try:
+                await member.timeout(timedelta(minutes=timeout_minutes), reason=f"Automod: {', '.join(violations)}")
+                outcome += f", timed out for {timeout_minutes} minutes"
+            except discord.HTTPException as e:
+                outcome += f", could not time out: {e}"
+        
+        log_event(message.guild.id, 'automod_triggered', target_user_id=member.id,
+                 details={'violations': violations, 'channel': message.channel.id})
+        
+        embed = discord.Embed(
+            title="🤖 AUTOMOD",
+            description=f"{member.mention} broke the {', '.join(violations)} limit in {message.channel.mention}.",
+            color=discord.Color.orange(),
+            timestamp=datetime.now()
+        )
+        embed.add_field(name="Response", value=outcome[:1024], inline=False)
+        if message.content:
+            embed.add_field(name="Last Message", value=message.content[:1024], inline=False)
+        
+        await send_global_log(message.guild, 'automod', embed)
+
+automod = AutomodEngine()
+
+MINHASH_PERMUTATIONS = 16
+MINHASH_BANDS = 4
+MINHASH_SHINGLE = 5
+MINHASH_PRIME = (1 << 61) - 1
+MINHASH_COEFFICIENTS = [(rng.randrange(1, MINHASH_PRIME), rng.randrange(MINHASH_PRIME))
+                        for rng in [random.Random(20240601)] for _ in range(MINHASH_PERMUTATIONS)]
+CROSS_SPAM_MIN_LENGTH = 30
+CROSS_SPAM_MAX_LENGTH = 300
+CROSS_SPAM_MAX_WINDOW = 600
+
+def normalize_message(content):
+    """Fold case, look-alike characters, punctuation and spacing so trivial edits don't hide a payload"""
+    text = unicodedata.normalize('NFKC', content).lower()
+    text = ''.join(ch if ch.isalnum() else ' ' for ch in text)
+    return ' '.join(text.split())[:CROSS_SPAM_MAX_LENGTH]
+
+def minhash_bands(text):
+    """LSH band keys of a MinHash signature over character shingles.
+    
+    Messages with similar shingle sets agree on most signature values, so near-duplicates
+    share at least one band key with high probability while unrelated messages almost never do.
+    """
+    shingles = {hash(text[i:i + MINHASH_SHINGLE]) & MINHASH_PRIME
+                for i in range(max(1, len(text) - MINHASH_SHINGLE + 1))}
+    signature = [min((a * h + b) % MINHASH_PRIME for h in shingles) for a, b in MINHASH_COEFFICIENTS]
+    rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    return [(band, hash(tuple(signature[band * rows:(band + 1) * rows]))) for band in range(MINHASH_BANDS)]
+
+class CrossUserSpamDetector:
+    """Finds the same (or nearly the same) message posted by many different accounts.
+    
+    Each guild keeps a rolling window of recent messages per MinHash band key. When one band
+    has messages from more than cross_user_limit distinct authors within cross_user_window
+    seconds, the whole cluster is returned once; later messages that land in a flagged band
+    while it is still hot are returned on their own so they get cleaned up too.
+    """
+    
+    def __init__(self):
+        self._bands = {}
+        self._flagged = {}
+        self._recorded = 0
+    
+    def record(self, message, config, now=None):
+        """Add a message; returns the (author_id, channel_id, message_id) entries to act on, or []"""
+        limit, window = config['cross_user_limit'], config['cross_user_window']
+        if not limit or not window:
+            return []
+        text = normalize_message(message.content)
+        if len(text) < CROSS_SPAM_MIN_LENGTH:
+            return []
+        
+        now = time.monotonic() if now is None else now
+        guild_id = message.guild.id
+        bands = self._bands.setdefault(guild_id, {})
+        flagged = self._flagged.setdefault(guild_id, {})
+        entry = (message.author.id, message.channel.id, message.id)
+        
+        self._recorded += 1
+        if self._recorded % 1000 == 0:
+            self._sweep(now)
+        
+        keys = minhash_bands(text)
+        if any(flagged.get(key, 0) > now for key in keys):
+            for key in keys:
+                flagged[key] = now + window
+            return [entry]
+        
+        cluster = []
+        for key in keys:
+            recent = bands.setdefault(key, deque())
+            recent.append((now, entry))
+            while recent and recent[0][0] <= now - window:
+                recent.popleft()
+            if not cluster and len({author_id for _, (author_id, _, _) in recent}) > limit:
+                cluster = [item for _, item in recent]
+        
+        if cluster:
+            for key in keys:
+                flagged[key] = now + window
+                bands[key].clear()
+            metrics.incr('automod.spam_clusters')
+        return cluster
+    
+    def _sweep(self, now):
+        # Windows are capped at CROSS_SPAM_MAX_WINDOW, so anything older can't count any more
+        for bands in self._bands.values():
+            for key in [key for key, recent in bands.items() if not recent or recent[-1][0] <= now - CROSS_SPAM_MAX_WINDOW]:
+                del bands[key]
+        for flagged in self._flagged.values():
+            for key in [key for key, until in flagged.items() if until <= now]:
+                del flagged[key]
+    
+    async def respond(self, message, cluster, config):
+        """Bulk delete a spam cluster and quarantine every account that posted it.
+        
+        The roles taken from each account are written to the activity log so a false positive
+        can be put back. A single late copy of an already reported cluster only gets its
+        message deleted and its author timed out, without losing roles.
+        """
+        guild = message.guild
+        reason = 'Automod: same message from many accounts'
+        
+        by_channel = {}
+        for _, channel_id, message_id in cluster:
+            by_channel.setdefault(channel_id, []).append(discord.Object(message_id))
+        for channel_id, messages in by_channel.items():
+            channel = guild.get_channel_or_thread(channel_id)
+            if channel is None:
+                continue
+            try:
+                await channel.delete_messages(messages, reason=reason)
+            except discord.HTTPException as e:
+                print(f'Error deleting spam cluster in {channel}: {e}')
+        
+        if len(cluster) == 1:
+            member = guild.get_member(cluster[0][0])
+            if member is None or automod.is_exempt(member, config):
+                return
+            try:
+                await member.timeout(timedelta(hours=1), reason=reason)
+            except discord.HTTPException as e:
+                print(f'Error timing out {member}: {e}')
+            log_event(guild.id, 'spam_cluster_late', target_user_id=member.id,
+                     details={'channel': cluster[0][1], 'message': cluster[0][2]})
+            return
+        
+        quarantined = []
+        removed_roles = {}
+        for author_id in dict.fromkeys(author_id for author_id, _, _ in cluster):
+            member = guild.get_member(author_id)
+            if member is None or automod.is_exempt(member, config):
+                continue
+            try:
+                removed = await quarantine_member(member, reason)
+                quarantined.append(author_id)
+                removed_roles[str(author_id)] = [role.id for role in removed]
+            except discord.HTTPException as e:
+                print(f'Error quarantining {member}: {e}')
+        
+        log_event(guild.id, 'spam_cluster', details={'messages': len(cluster), 'quarantined': quarantined,
+                                                     'removed_roles': removed_roles})
+        
+        embed = discord.Embed(
+            title="📨 SPAM WAVE DETECTED",
+            description=f"The same message was posted by {len(quarantined)} accounts. "
+                        f"Deleted {len(cluster)} messages and quarantined the senders (roles removed, 1 hour timeout).",
+            color=discord.Color.dark_orange(),
+            timestamp=datetime.now()
+        )
+        if message.content:
+            embed.add_field(name="Message", value=message.content[:1024], inline=False)
+        if quarantined:
+            embed.add_field(name="Accounts", value=' '.join(f"<@{author_id}>" for author_id in quarantined)[:1024], inline=False)
+        
+        security = await config_cache.get('security_config', guild.id)
+        if security and security['alert_role_id']:
+            alert_role = guild.get_role(security['alert_role_id'])
+            if alert_role:
+                embed.description = f"{alert_role.mention}\n\n" + embed.description
+        
+        await send_global_log(guild, 'automod', embed)
+
+cross_user_spam = CrossUserSpamDetector()
+
+def init_db():
+    with db.sync_cursor() as cur:
+        cur.execute('DROP TABLE IF EXISTS staff_points CASCADE')
+        cur.execute('DROP TABLE IF EXISTS rank_config CASCADE')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS welcome_config (
+                guild_id BIGINT PRIMARY KEY,
+                channel_id BIGINT,
+                message TEXT,
+                auto_role_id BIGINT
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS automod_config (
+                guild_id BIGINT PRIMARY KEY,
+                enabled BOOLEAN DEFAULT false,
+                max_messages INTEGER DEFAULT 8,
+                max_mentions INTEGER DEFAULT 10,
+                max_duplicates INTEGER DEFAULT 3,
+                max_links INTEGER DEFAULT 5,
+                timeout_minutes INTEGER DEFAULT 10,
+                exempt_role_ids TEXT
+            )
+        ''')
+        
+        cur.execute('ALTER TABLE automod_config ADD COLUMN IF NOT EXISTS cross_user_limit INTEGER DEFAULT 4')
+        cur.execute('ALTER TABLE automod_config ADD COLUMN IF NOT EXISTS cross_user_window INTEGER DEFAULT 30')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS training_config (
+                guild_id BIGINT,
+                training_type TEXT,
+                channel_id BIGINT,
+                message TEXT,
+                PRIMARY KEY (guild_id, training_type)
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS monthly_awards (
+                guild_id BIGINT,
+                award_type TEXT,
+                channel_id BIGINT,
+                message TEXT,
+                PRIMARY KEY (guild_id, award_type)
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS warnings (
+                id SERIAL PRIMARY KEY,
+                guild_id BIGINT,
+                user_id BIGINT,
+                warning_number INTEGER,
+                reason TEXT,
+                issued_by BIGINT,
+                issued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS training_messages (
+                message_id BIGINT PRIMARY KEY,
+                guild_id BIGINT,
+                channel_id BIGINT,
+                training_type TEXT,
+                message_template TEXT,
+                training_time TEXT,
+                host_id BIGINT
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS training_roles (
+                guild_id BIGINT PRIMARY KEY,
+                helper_role_id BIGINT
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS reaction_role_groups (
+                id SERIAL PRIMARY KEY,
+                guild_id BIGINT,
+                group_name TEXT,
+                message_id BIGINT,
+                channel_id BIGINT,
+                description TEXT,
+                is_exclusive BOOLEAN DEFAULT true
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS reaction_role_options (
+                id SERIAL PRIMARY KEY,
+                group_id INTEGER REFERENCES reaction_role_groups(id) ON DELETE CASCADE,
+                role_id BIGINT,
+                button_label TEXT,
+                button_style TEXT DEFAULT 'primary'
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS agent_files (
+                guild_id BIGINT,
+                user_id BIGINT,
+                agent_name TEXT,
+                division TEXT,
+                rank TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (guild_id, user_id)
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS duty_status (
+                guild_id BIGINT,
+                user_id BIGINT,
+                is_on_duty BOOLEAN DEFAULT false,
+                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_by BIGINT,
+                PRIMARY KEY (guild_id, user_id)
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS polls (
+                poll_id SERIAL PRIMARY KEY,
+                guild_id BIGINT,
+                channel_id BIGINT,
+                message_id BIGINT,
+                question TEXT,
+                options TEXT,
+                created_by BIGINT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                expires_at TIMESTAMP,
+                is_active BOOLEAN DEFAULT true
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS poll_votes (
+                poll_id INTEGER REFERENCES polls(poll_id) ON DELETE CASCADE,
+                user_id BIGINT,
+                option_index INTEGER,
+                voted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (poll_id, user_id)
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS activity_logs (
+                id SERIAL PRIMARY KEY,
+                guild_id BIGINT,
+                event_type TEXT,
+                target_user_id BIGINT,
+                actor_user_id BIGINT,
+                details TEXT,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS log_channels (
+                guild_id BIGINT,
+                event_type TEXT,
+                channel_id BIGINT,
+                PRIMARY KEY (guild_id, event_type)
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS lockdown_config (
+                guild_id BIGINT PRIMARY KEY,
+                is_active BOOLEAN DEFAULT false,
+                director_role_id BIGINT,
+                announcement_channel_id BIGINT,
+                roles_to_ping TEXT,
+                initiated_by BIGINT,
+                initiated_at TIMESTAMP
+            )
+        ''')
+        
+        cur.execute("ALTER TABLE lockdown_config ADD COLUMN IF NOT EXISTS lockdown_mode TEXT DEFAULT 'channel'")
+        cur.execute('ALTER TABLE lockdown_config ADD COLUMN IF NOT EXISTS lockdown_role_ids TEXT')
+        cur.execute('ALTER TABLE lockdown_config ADD COLUMN IF NOT EXISTS active_mode TEXT')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS lockdown_jobs (
+                job_id SERIAL PRIMARY KEY,
+                guild_id BIGINT,
+                action TEXT,
+                mode TEXT,
+                actor_id BIGINT,
+                reason TEXT,
+                automatic BOOLEAN DEFAULT false,
+                skipped INTEGER DEFAULT 0,
+                status TEXT DEFAULT 'running',
+                created_at TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS lockdown_job_items (
+                job_id INTEGER REFERENCES lockdown_jobs(job_id) ON DELETE CASCADE,
+                kind TEXT,
+                target_id BIGINT,
+                state TEXT DEFAULT 'pending',
+                claimed_at TIMESTAMP,
+                PRIMARY KEY (job_id, kind, target_id)
+            )
+        ''')
+        
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_lockdown_jobs_running ON lockdown_jobs (guild_id) WHERE status = 'running'")
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS lockdown_role_permissions (
+                guild_id BIGINT,
+                role_id BIGINT,
+                permissions BIGINT,
+                PRIMARY KEY (guild_id, role_id)
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS lockdown_permissions (
+                guild_id BIGINT,
+                channel_id BIGINT,
+                permissions_json TEXT,
+                PRIMARY KEY (guild_id, channel_id)
+            )
+        ''')
+        
+        cur.execute('ALTER TABLE lockdown_permissions ADD COLUMN IF NOT EXISTS permissions_blob BYTEA')
+        cur.execute('ALTER TABLE lockdown_permissions ADD COLUMN IF NOT EXISTS snapshot_hash BYTEA')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS snapshot_blobs (
+                hash BYTEA PRIMARY KEY,
+                data BYTEA NOT NULL
+            )
+        ''')
+        
+        # Snapshots taken before the packed format still hold JSON; convert them once
+        cur.execute('''
+            SELECT guild_id, channel_id, permissions_json FROM lockdown_permissions
+            WHERE permissions_blob IS NULL AND permissions_json IS NOT NULL
+        ''')
+        for guild_id, channel_id, perms_json in cur.fetchall():
+            try:
+                blob = legacy_snapshot_to_blob(perms_json)
+            except (ValueError, AttributeError) as e:
+                print(f'Could not convert lockdown snapshot for channel {channel_id}: {e}')
+                continue
+            cur.execute('''
+                UPDATE lockdown_permissions SET permissions_blob = %s, permissions_json = NULL
+                WHERE guild_id = %s AND channel_id = %s
+            ''', (psycopg2.Binary(blob), guild_id, channel_id))
+        
+        # Move per-channel packed snapshots into the shared, deduplicated snapshot_blobs
+        cur.execute('''
+            SELECT guild_id, channel_id, permissions_blob FROM lockdown_permissions
+            WHERE snapshot_hash IS NULL AND permissions_blob IS NOT NULL
+        ''')
+        blobs = {}
+        moved = []
+        for guild_id, channel_id, blob in cur.fetchall():
+            h = snapshot_hash(bytes(blob))
+            blobs[h] = bytes(blob)
+            moved.append((psycopg2.Binary(h), guild_id, channel_id))
+        if moved:
+            store_snapshot_blobs(cur, blobs)
+            execute_values(cur, '''
+                UPDATE lockdown_permissions AS p SET snapshot_hash = v.hash, permissions_blob = NULL
+                FROM (VALUES %s) AS v(hash, guild_id, channel_id)
+                WHERE p.guild_id = v.guild_id AND p.channel_id = v.channel_id
+            ''', moved)
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS guild_snapshots (
+                snapshot_id SERIAL PRIMARY KEY,
+                guild_id BIGINT NOT NULL,
+                role_count INTEGER,
+                channel_count INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS guild_snapshot_items (
+                snapshot_id INTEGER REFERENCES guild_snapshots(snapshot_id) ON DELETE CASCADE,
+                kind TEXT NOT NULL,
+                object_id BIGINT NOT NULL,
+                item_hash BYTEA NOT NULL,
+                PRIMARY KEY (snapshot_id, kind, object_id)
+            )
+        ''')
         
-        if config and config['channel_id']:
-            channel = guild.get_channel(config['channel_id'])
-            if channel:
-                await channel.send(embed=embed)
-    except Exception as e:
-        print(f'Error sending global log: {e}')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_guild_snapshots_guild ON guild_snapshots(guild_id, snapshot_id)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_guild_snapshot_items_hash ON guild_snapshot_items(item_hash)')
 
-async def check_raid_pattern(guild, member):
-    """Check if there's a raid pattern and alert if necessary"""
-    try:
-        conn = get_db()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
         
-        cur.execute('SELECT * FROM security_config WHERE guild_id = %s AND anti_raid_enabled = true', (guild.id,))
-        config = cur.fetchone()
-        
-        if not config:
-            cur.close()
-            conn.close()
-            return
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS presence_config (
+                guild_id BIGINT PRIMARY KEY,
+                activity_type TEXT DEFAULT 'playing',
+                status_message TEXT DEFAULT 'Managing the Agency',
+                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
         
-        account_age_days = (datetime.now() - member.created_at.replace(tzinfo=None)).days
-        is_suspicious = account_age_days < config['min_account_age']
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS duty_role_config (
+                guild_id BIGINT PRIMARY KEY,
+                on_duty_role_id BIGINT
+            )
+        ''')
         
         cur.execute('''
-            INSERT INTO raid_tracking (guild_id, user_id, account_created_at, is_suspicious)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (guild_id, user_id) DO UPDATE SET joined_at = CURRENT_TIMESTAMP
-        ''', (guild.id, member.id, member.created_at, is_suspicious))
+            CREATE TABLE IF NOT EXISTS global_log_config (
+                guild_id BIGINT PRIMARY KEY,
+                channel_id BIGINT,
+                enabled BOOLEAN DEFAULT true
+            )
+        ''')
         
         cur.execute('''
-            SELECT COUNT(*) as join_count FROM raid_tracking 
-            WHERE guild_id = %s AND joined_at > NOW() - INTERVAL '%s seconds'
-        ''', (guild.id, config['raid_time_window']))
+            CREATE TABLE IF NOT EXISTS security_config (
+                guild_id BIGINT PRIMARY KEY,
+                anti_raid_enabled BOOLEAN DEFAULT false,
+                raid_threshold INTEGER DEFAULT 5,
+                raid_time_window INTEGER DEFAULT 30,
+                min_account_age INTEGER DEFAULT 7,
+                auto_lockdown BOOLEAN DEFAULT false,
+                alert_role_id BIGINT,
+                permission_guard_enabled BOOLEAN DEFAULT false,
+                trusted_role_ids TEXT
+            )
+        ''')
         
-        join_count = cur.fetchone()['join_count']
+        cur.execute('ALTER TABLE security_config ADD COLUMN IF NOT EXISTS raid_windows TEXT')
+        cur.execute('ALTER TABLE security_config ADD COLUMN IF NOT EXISTS join_wave_size INTEGER DEFAULT 0')
+        cur.execute('ALTER TABLE security_config ALTER COLUMN join_wave_size SET DEFAULT 0')
+        cur.execute('ALTER TABLE security_config ADD COLUMN IF NOT EXISTS join_wave_span INTEGER DEFAULT 600')
+        cur.execute("ALTER TABLE security_config ADD COLUMN IF NOT EXISTS blocklist_action TEXT DEFAULT 'alert'")
+        cur.execute('ALTER TABLE security_config ADD COLUMN IF NOT EXISTS raid_mode BOOLEAN DEFAULT true')
+        cur.execute('ALTER TABLE security_config ADD COLUMN IF NOT EXISTS dangerous_permissions BIGINT')
+        cur.execute('ALTER TABLE security_config ADD COLUMN IF NOT EXISTS auto_revert BOOLEAN DEFAULT false')
+        cur.execute('ALTER TABLE security_config ADD COLUMN IF NOT EXISTS anti_nuke_enabled BOOLEAN DEFAULT false')
+        cur.execute('ALTER TABLE security_config ADD COLUMN IF NOT EXISTS anti_nuke_limits TEXT')
         
-        conn.commit()
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS raid_tracking (
+                guild_id BIGINT,
+                user_id BIGINT,
+                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                account_created_at TIMESTAMP,
+                is_suspicious BOOLEAN DEFAULT false,
+                PRIMARY KEY (guild_id, user_id)
+            )
+        ''')
         
-        if join_count >= config['raid_threshold']:
-            embed = discord.Embed(
-                title="🚨 RAID DETECTED",
-                description=f"Detected {join_count} members joining within {config['raid_time_window']} seconds!",
-                color=discord.Color.red(),
-                timestamp=datetime.now()
+        cur.execute('ALTER TABLE raid_tracking ADD COLUMN IF NOT EXISTS suspicion_score INTEGER DEFAULT 0')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS name_patterns (
+                id SERIAL PRIMARY KEY,
+                guild_id BIGINT NOT NULL,
+                pattern TEXT NOT NULL,
+                is_regex BOOLEAN DEFAULT false,
+                weight INTEGER DEFAULT 1,
+                created_by BIGINT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
-            embed.add_field(name="Latest Member", value=f"{member.mention} ({member.id})", inline=False)
-            embed.add_field(name="Account Age", value=f"{account_age_days} days", inline=True)
-            embed.add_field(name="Suspicious", value="Yes" if is_suspicious else "No", inline=True)
-            
-            if config['alert_role_id']:
-                alert_role = guild.get_role(config['alert_role_id'])
-                if alert_role:
-                    embed.description = f"{alert_role.mention}\n\n" + embed.description
-            
-            await send_global_log(guild, 'raid_detected', embed)
-            
-            if config['auto_lockdown']:
-                lockdown_config = cur.execute('SELECT * FROM lockdown_config WHERE guild_id = %s', (guild.id,))
-                if lockdown_config and not lockdown_config.get('is_active'):
-                    embed.add_field(name="Auto-Response", value="🔒 Initiating automatic lockdown...", inline=False)
+        ''')
         
-        cur.close()
-        conn.close()
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS permission_changes (
+                id SERIAL PRIMARY KEY,
+                guild_id BIGINT,
+                role_id BIGINT,
+                changed_by BIGINT,
+                changes TEXT,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                reverted BOOLEAN DEFAULT false
+            )
+        ''')
         
-    except Exception as e:
-        print(f'Error checking raid pattern: {e}')
-
-def init_db():
-    conn = get_db()
-    cur = conn.cursor()
-    
-    cur.execute('DROP TABLE IF EXISTS staff_points CASCADE')
-    cur.execute('DROP TABLE IF EXISTS rank_config CASCADE')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS welcome_config (
-            guild_id BIGINT PRIMARY KEY,
-            channel_id BIGINT,
-            message TEXT,
-            auto_role_id BIGINT
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS training_config (
-            guild_id BIGINT,
-            training_type TEXT,
-            channel_id BIGINT,
-            message TEXT,
-            PRIMARY KEY (guild_id, training_type)
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS monthly_awards (
-            guild_id BIGINT,
-            award_type TEXT,
-            channel_id BIGINT,
-            message TEXT,
-            PRIMARY KEY (guild_id, award_type)
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS warnings (
-            id SERIAL PRIMARY KEY,
-            guild_id BIGINT,
-            user_id BIGINT,
-            warning_number INTEGER,
-            reason TEXT,
-            issued_by BIGINT,
-            issued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS training_messages (
-            message_id BIGINT PRIMARY KEY,
-            guild_id BIGINT,
-            channel_id BIGINT,
-            training_type TEXT,
-            message_template TEXT,
-            training_time TEXT,
-            host_id BIGINT
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS training_roles (
-            guild_id BIGINT PRIMARY KEY,
-            helper_role_id BIGINT
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS reaction_role_groups (
-            id SERIAL PRIMARY KEY,
-            guild_id BIGINT,
-            group_name TEXT,
-            message_id BIGINT,
-            channel_id BIGINT,
-            description TEXT,
-            is_exclusive BOOLEAN DEFAULT true
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS reaction_role_options (
-            id SERIAL PRIMARY KEY,
-            group_id INTEGER REFERENCES reaction_role_groups(id) ON DELETE CASCADE,
-            role_id BIGINT,
-            button_label TEXT,
-            button_style TEXT DEFAULT 'primary'
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS agent_files (
-            guild_id BIGINT,
-            user_id BIGINT,
-            agent_name TEXT,
-            division TEXT,
-            rank TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (guild_id, user_id)
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS duty_status (
-            guild_id BIGINT,
-            user_id BIGINT,
-            is_on_duty BOOLEAN DEFAULT false,
-            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_by BIGINT,
-            PRIMARY KEY (guild_id, user_id)
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS polls (
-            poll_id SERIAL PRIMARY KEY,
-            guild_id BIGINT,
-            channel_id BIGINT,
-            message_id BIGINT,
-            question TEXT,
-            options TEXT,
-            created_by BIGINT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            expires_at TIMESTAMP,
-            is_active BOOLEAN DEFAULT true
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS poll_votes (
-            poll_id INTEGER REFERENCES polls(poll_id) ON DELETE CASCADE,
-            user_id BIGINT,
-            option_index INTEGER,
-            voted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (poll_id, user_id)
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS activity_logs (
-            id SERIAL PRIMARY KEY,
-            guild_id BIGINT,
-            event_type TEXT,
-            target_user_id BIGINT,
-            actor_user_id BIGINT,
-            details TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS log_channels (
-            guild_id BIGINT,
-            event_type TEXT,
-            channel_id BIGINT,
-            PRIMARY KEY (guild_id, event_type)
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS lockdown_config (
-            guild_id BIGINT PRIMARY KEY,
-            is_active BOOLEAN DEFAULT false,
-            director_role_id BIGINT,
-            announcement_channel_id BIGINT,
-            roles_to_ping TEXT,
-            initiated_by BIGINT,
-            initiated_at TIMESTAMP
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS lockdown_permissions (
-            guild_id BIGINT,
-            channel_id BIGINT,
-            permissions_json TEXT,
-            PRIMARY KEY (guild_id, channel_id)
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS presence_config (
-            guild_id BIGINT PRIMARY KEY,
-            activity_type TEXT DEFAULT 'playing',
-            status_message TEXT DEFAULT 'Managing the Agency',
-            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS duty_role_config (
-            guild_id BIGINT PRIMARY KEY,
-            on_duty_role_id BIGINT
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS global_log_config (
-            guild_id BIGINT PRIMARY KEY,
-            channel_id BIGINT,
-            enabled BOOLEAN DEFAULT true
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS security_config (
-            guild_id BIGINT PRIMARY KEY,
-            anti_raid_enabled BOOLEAN DEFAULT false,
-            raid_threshold INTEGER DEFAULT 5,
-            raid_time_window INTEGER DEFAULT 30,
-            min_account_age INTEGER DEFAULT 7,
-            auto_lockdown BOOLEAN DEFAULT false,
-            alert_role_id BIGINT,
-            permission_guard_enabled BOOLEAN DEFAULT false,
-            trusted_role_ids TEXT
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS raid_tracking (
-            guild_id BIGINT,
-            user_id BIGINT,
-            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            account_created_at TIMESTAMP,
-            is_suspicious BOOLEAN DEFAULT false,
-            PRIMARY KEY (guild_id, user_id)
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS permission_changes (
-            id SERIAL PRIMARY KEY,
-            guild_id BIGINT,
-            role_id BIGINT,
-            changed_by BIGINT,
-            changes TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            reverted BOOLEAN DEFAULT false
-        )
-    ''')
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+        cur.execute('ALTER TABLE permission_changes ADD COLUMN IF NOT EXISTS before_permissions BIGINT')
+        cur.execute('ALTER TABLE permission_changes ADD COLUMN IF NOT EXISTS after_permissions BIGINT')
+        cur.execute('ALTER TABLE permission_changes ADD COLUMN IF NOT EXISTS revert_latency_ms INTEGER')
 
 class PollView(View):
     def __init__(self, poll_id: int, options: list):
@@ -406,38 +3479,34 @@ class PollView(View):
     
     def create_callback(self, option_index: int):
         async def button_callback(interaction: discord.Interaction):
-            conn = get_db()
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-            
-            cur.execute('SELECT is_active FROM polls WHERE poll_id = %s', (self.poll_id,))
-            poll = cur.fetchone()
+            async with db.cursor(dict_rows=True) as cur:
+                await cur.execute('SELECT is_active FROM polls WHERE poll_id = %s', (self.poll_id,))
+                poll = cur.fetchone()
+                
+                if not poll or not poll['is_active']:
+                    existing_vote = None
+                else:
+                    await cur.execute('SELECT * FROM poll_votes WHERE poll_id = %s AND user_id = %s', 
+                               (self.poll_id, interaction.user.id))
+                    existing_vote = cur.fetchone()
+                    
+                    if existing_vote:
+                        await cur.execute('''
+                            UPDATE poll_votes SET option_index = %s, voted_at = %s
+                            WHERE poll_id = %s AND user_id = %s
+                        ''', (option_index, datetime.now(), self.poll_id, interaction.user.id))
+                    else:
+                        await cur.execute('''
+                            INSERT INTO poll_votes (poll_id, user_id, option_index, voted_at)
+                            VALUES (%s, %s, %s, %s)
+                        ''', (self.poll_id, interaction.user.id, option_index, datetime.now()))
             
             if not poll or not poll['is_active']:
                 await interaction.response.send_message('❌ This poll is no longer active!', ephemeral=True)
-                cur.close()
-                conn.close()
-                return
-            
-            cur.execute('SELECT * FROM poll_votes WHERE poll_id = %s AND user_id = %s', 
-                       (self.poll_id, interaction.user.id))
-            existing_vote = cur.fetchone()
-            
-            if existing_vote:
-                cur.execute('''
-                    UPDATE poll_votes SET option_index = %s, voted_at = %s
-                    WHERE poll_id = %s AND user_id = %s
-                ''', (option_index, datetime.now(), self.poll_id, interaction.user.id))
+            elif existing_vote:
                 await interaction.response.send_message(f'✅ Vote updated!', ephemeral=True)
             else:
-                cur.execute('''
-                    INSERT INTO poll_votes (poll_id, user_id, option_index, voted_at)
-                    VALUES (%s, %s, %s, %s)
-                ''', (self.poll_id, interaction.user.id, option_index, datetime.now()))
                 await interaction.response.send_message(f'✅ Vote recorded!', ephemeral=True)
-            
-            conn.commit()
-            cur.close()
-            conn.close()
         
         return button_callback
 
@@ -473,17 +3542,13 @@ class ReactionRoleView(View):
                 return
             
             if self.is_exclusive:
-                conn = get_db()
-                cur = conn.cursor(cursor_factory=RealDictCursor)
-                
-                cur.execute('''
-                    SELECT role_id FROM reaction_role_options 
-                    WHERE group_id = %s
-                ''', (self.group_id,))
-                
-                group_roles = cur.fetchall()
-                cur.close()
-                conn.close()
+                async with db.cursor(dict_rows=True) as cur:
+                    await cur.execute('''
+                        SELECT role_id FROM reaction_role_options 
+                        WHERE group_id = %s
+                    ''', (self.group_id,))
+                    
+                    group_roles = cur.fetchall()
                 
                 roles_to_remove = []
                 for role_data in group_roles:
@@ -506,10 +3571,24 @@ class ReactionRoleView(View):
 class RoleBot(commands.Bot):
     def __init__(self):
         super().__init__(command_prefix='/', intents=intents)
+        self._shutdown = None
     
     async def setup_hook(self):
+        try:
+            # run() only handles Ctrl+C; hosts stop the process with SIGTERM, so close cleanly then too
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self._on_sigterm)
+        except NotImplementedError:
+            pass
+        print("Opening database pool...")
+        db.open()
         print("Initializing database...")
-        init_db()
+        await db.run_sync(init_db)
+        activity_log_buffer.start()
+        raid_tracking_buffer.start()
+        print("Loading guild configuration...")
+        await config_cache.load_all()
+        await config_listener.start()
+        await blocklist.reload_if_changed()
         print("Loading persistent views...")
         await self.load_persistent_views()
         print("Syncing commands with Discord...")
@@ -517,45 +3596,56 @@ class RoleBot(commands.Bot):
         print("Commands synced!")
         
         self.presence_update_loop.start()
+        self.guild_snapshot_loop.start()
+        self.blocklist_reload_loop.start()
+        lockdown_engine.spawn(lockdown_engine.resume_jobs())
     
     async def load_persistent_views(self):
-        conn = get_db()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cur.execute('SELECT * FROM reaction_role_groups WHERE message_id IS NOT NULL')
-        groups = cur.fetchall()
-        
-        for group in groups:
-            cur.execute('SELECT * FROM reaction_role_options WHERE group_id = %s', (group['id'],))
-            options = cur.fetchall()
+        async with db.cursor(dict_rows=True) as cur:
+            await cur.execute('SELECT * FROM reaction_role_groups WHERE message_id IS NOT NULL')
+            groups = cur.fetchall()
             
-            if options:
-                view = ReactionRoleView(group['id'], options, group['is_exclusive'])
-                self.add_view(view)
-        
-        cur.execute('SELECT * FROM polls WHERE is_active = true')
-        polls = cur.fetchall()
+            for group in groups:
+                await cur.execute('SELECT * FROM reaction_role_options WHERE group_id = %s', (group['id'],))
+                options = cur.fetchall()
+                
+                if options:
+                    view = ReactionRoleView(group['id'], options, group['is_exclusive'])
+                    self.add_view(view)
+            
+            await cur.execute('SELECT * FROM polls WHERE is_active = true')
+            polls = cur.fetchall()
         
         for poll in polls:
             options = json.loads(poll['options'])
             view = PollView(poll['poll_id'], options)
             self.add_view(view)
-        
-        cur.close()
-        conn.close()
+    
+    def _on_sigterm(self):
+        print("Received SIGTERM, shutting down...")
+        self._shutdown = self._shutdown or asyncio.ensure_future(self._close())
+    
+    async def close(self):
+        # run() calls close() again once the connection ends, so both wait on the same shutdown
+        self._shutdown = self._shutdown or asyncio.ensure_future(self._close())
+        await self._shutdown
+    
+    async def _close(self):
+        await super().close()
+        await config_listener.stop()
+        print(f"Flushing {len(activity_log_buffer)} buffered activity logs...")
+        await activity_log_buffer.stop()
+        await raid_tracking_buffer.stop()
+        print("Closing database pool...")
+        db.close()
     
     @tasks.loop(minutes=5)
     async def presence_update_loop(self):
         """Keep bot presence updated"""
         try:
-            conn = get_db()
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-            
-            cur.execute('SELECT * FROM presence_config LIMIT 1')
-            config = cur.fetchone()
-            
-            cur.close()
-            conn.close()
+            async with db.cursor(dict_rows=True) as cur:
+                await cur.execute('SELECT * FROM presence_config LIMIT 1')
+                config = cur.fetchone()
             
             if config:
                 activity_text = config.get('status_message', 'Managing the Agency')
@@ -579,6 +3669,34 @@ class RoleBot(commands.Bot):
     @presence_update_loop.before_loop
     async def before_presence_loop(self):
         await self.wait_until_ready()
+    
+    @tasks.loop(minutes=GUILD_SNAPSHOT_INTERVAL)
+    async def guild_snapshot_loop(self):
+        """Snapshot every guild's roles and channels so /restoreguild can rebuild them"""
+        for guild in self.guilds:
+            if guild_snapshotter.is_restoring(guild.id):
+                continue
+            try:
+                await guild_snapshotter.take(guild)
+            except Exception as e:
+                print(f'Error taking snapshot of {guild.name}: {e}')
+        
+        try:
+            await guild_snapshotter.collect_garbage()
+        except Exception as e:
+            print(f'Error collecting snapshot blobs: {e}')
+    
+    @tasks.loop(seconds=BLOCKLIST_RELOAD_INTERVAL)
+    async def blocklist_reload_loop(self):
+        """Pick up edits to the blocklist file without a restart"""
+        try:
+            await blocklist.reload_if_changed()
+        except Exception as e:
+            print(f'Error reloading blocklist: {e}')
+    
+    @guild_snapshot_loop.before_loop
+    async def before_guild_snapshot_loop(self):
+        await self.wait_until_ready()
 
 bot = RoleBot()
 
@@ -613,28 +3731,34 @@ async def on_member_join(member):
     embed.add_field(name="Account Age", value=f"{account_age_days} days", inline=True)
     embed.set_thumbnail(url=member.display_avatar.url)
     
-    await send_global_log(member.guild, 'member_join', embed)
-    await check_raid_pattern(member.guild, member)
+    # Blocklisted joiners still count toward raid detection and show in the join log
+    blocklisted = await check_blocklist(member)
     
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    name_matches = await check_raid_pattern(member.guild, member)
+    if name_matches:
+        embed.add_field(
+            name="⚠️ Name Matches",
+            value=', '.join(f"`{row['pattern']}`" for row in name_matches)[:1024],
+            inline=False
+        )
+    if blocklisted:
+        embed.add_field(name="⛔ Blocklist", value="Removed or timed out; no welcome or auto-role", inline=False)
+    await send_global_log(member.guild, 'member_join', embed)
     
-    cur.execute('SELECT channel_id FROM log_channels WHERE guild_id = %s AND event_type = %s', 
-                (member.guild.id, 'member_join'))
-    log_channel_config = cur.fetchone()
+    log_channel_id = await config_cache.log_channel(member.guild.id, 'member_join')
+    config = await config_cache.get('welcome_config', member.guild.id)
     
-    if log_channel_config:
-        log_channel = member.guild.get_channel(log_channel_config['channel_id'])
+    if log_channel_id:
+        log_channel = member.guild.get_channel(log_channel_id)
         if log_channel:
             await log_channel.send(embed=embed)
     
-    cur.execute('SELECT * FROM welcome_config WHERE guild_id = %s', (member.guild.id,))
-    config = cur.fetchone()
-    
-    cur.close()
-    conn.close()
+    if blocklisted:
+        return
     
-    if config:
+    if config and raid_mode.is_active(member.guild.id):
+        raid_mode.defer(member)
+    elif config:
         if config['channel_id']:
             channel = member.guild.get_channel(config['channel_id'])
             if channel and config['message']:
@@ -662,18 +3786,10 @@ async def on_member_remove(member):
     
     await send_global_log(member.guild, 'member_leave', embed)
     
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT channel_id FROM log_channels WHERE guild_id = %s AND event_type = %s', 
-                (member.guild.id, 'member_leave'))
-    log_channel_config = cur.fetchone()
-    
-    cur.close()
-    conn.close()
+    log_channel_id = await config_cache.log_channel(member.guild.id, 'member_leave')
     
-    if log_channel_config:
-        log_channel = member.guild.get_channel(log_channel_config['channel_id'])
+    if log_channel_id:
+        log_channel = member.guild.get_channel(log_channel_id)
         if log_channel:
             await log_channel.send(embed=embed)
 
@@ -686,18 +3802,10 @@ async def on_member_update(before, after):
         log_event(after.guild.id, 'member_role_update', target_user_id=after.id, 
                  details={'added': [r.name for r in added_roles], 'removed': [r.name for r in removed_roles]})
         
-        conn = get_db()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
+        log_channel_id = await config_cache.log_channel(after.guild.id, 'member_role_update')
         
-        cur.execute('SELECT channel_id FROM log_channels WHERE guild_id = %s AND event_type = %s', 
-                    (after.guild.id, 'member_role_update'))
-        log_channel_config = cur.fetchone()
-        
-        cur.close()
-        conn.close()
-        
-        if log_channel_config:
-            log_channel = after.guild.get_channel(log_channel_config['channel_id'])
+        if log_channel_id:
+            log_channel = after.guild.get_channel(log_channel_id)
             if log_channel:
                 embed = discord.Embed(
                     title="Member Roles Updated",
@@ -711,6 +3819,16 @@ async def on_member_update(before, after):
                     embed.add_field(name="Removed Roles", value=", ".join([r.mention for r in removed_roles]), inline=False)
                 await log_channel.send(embed=embed)
 
+@bot.event
+async def on_message(message):
+    if message.author.bot or not message.guild:
+        return
+    
+    try:
+        await automod.handle(message)
+    except Exception as e:
+        print(f'Error in automod: {e}')
+
 @bot.event
 async def on_message_delete(message):
     if message.author.bot:
@@ -719,18 +3837,10 @@ async def on_message_delete(message):
     log_event(message.guild.id, 'message_delete', target_user_id=message.author.id, actor_user_id=message.author.id,
              details={'content': message.content[:500], 'channel': message.channel.name})
     
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    log_channel_id = await config_cache.log_channel(message.guild.id, 'message_delete')
     
-    cur.execute('SELECT channel_id FROM log_channels WHERE guild_id = %s AND event_type = %s', 
-                (message.guild.id, 'message_delete'))
-    log_channel_config = cur.fetchone()
-    
-    cur.close()
-    conn.close()
-    
-    if log_channel_config:
-        log_channel = message.guild.get_channel(log_channel_config['channel_id'])
+    if log_channel_id:
+        log_channel = message.guild.get_channel(log_channel_id)
         if log_channel and log_channel.id != message.channel.id:
             embed = discord.Embed(
                 title="Message Deleted",
@@ -751,18 +3861,10 @@ async def on_message_edit(before, after):
     log_event(after.guild.id, 'message_edit', target_user_id=after.author.id, actor_user_id=after.author.id,
              details={'before': before.content[:500], 'after': after.content[:500], 'channel': after.channel.name})
     
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT channel_id FROM log_channels WHERE guild_id = %s AND event_type = %s', 
-                (after.guild.id, 'message_edit'))
-    log_channel_config = cur.fetchone()
-    
-    cur.close()
-    conn.close()
+    log_channel_id = await config_cache.log_channel(after.guild.id, 'message_edit')
     
-    if log_channel_config:
-        log_channel = after.guild.get_channel(log_channel_config['channel_id'])
+    if log_channel_id:
+        log_channel = after.guild.get_channel(log_channel_id)
         if log_channel:
             embed = discord.Embed(
                 title="Message Edited",
@@ -778,57 +3880,81 @@ async def on_message_edit(before, after):
             embed.add_field(name="Jump to Message", value=f"[Click here]({after.jump_url})", inline=False)
             await log_channel.send(embed=embed)
 
+@bot.event
+async def on_audit_log_entry_create(entry):
+    audit_log_index.ingest(entry)
+
 @bot.event
 async def on_guild_role_update(before, after):
     if before.permissions != after.permissions:
         try:
-            conn = get_db()
-            cur = conn.cursor(cursor_factory=RealDictCursor)
+            config = await config_cache.get('security_config', after.guild.id)
             
-            cur.execute('SELECT * FROM security_config WHERE guild_id = %s AND permission_guard_enabled = true', (after.guild.id,))
-            config = cur.fetchone()
+            if not config or not config['permission_guard_enabled']:
+                return
             
-            if config:
-                async for entry in after.guild.audit_logs(limit=1, action=discord.AuditLogAction.role_update):
-                    changed_by = entry.user
-                    
-                    changes = []
-                    dangerous_perms = ['administrator', 'manage_guild', 'manage_roles', 'manage_channels', 'kick_members', 'ban_members']
-                    
-                    for perm in dangerous_perms:
-                        before_val = getattr(before.permissions, perm)
-                        after_val = getattr(after.permissions, perm)
-                        if before_val != after_val:
-                            changes.append(f"{perm}: {before_val} → {after_val}")
-                    
-                    if changes:
-                        changes_str = json.dumps(changes)
-                        cur.execute('''
-                            INSERT INTO permission_changes (guild_id, role_id, changed_by, changes)
-                            VALUES (%s, %s, %s, %s)
-                        ''', (after.guild.id, after.id, changed_by.id, changes_str))
-                        conn.commit()
-                        
-                        embed = discord.Embed(
-                            title="⚠️ Role Permissions Changed",
-                            description=f"Dangerous permissions were modified for {after.mention}",
-                            color=discord.Color.orange(),
-                            timestamp=datetime.now()
-                        )
-                        embed.add_field(name="Role", value=after.mention, inline=True)
-                        embed.add_field(name="Changed By", value=changed_by.mention, inline=True)
-                        embed.add_field(name="Changes", value="\n".join(changes), inline=False)
-                        
-                        if config['alert_role_id']:
-                            alert_role = after.guild.get_role(config['alert_role_id'])
-                            if alert_role:
-                                embed.description = f"{alert_role.mention}\n\n" + embed.description
-                        
-                        await send_global_log(after.guild, 'permission_change', embed)
-                    break
+            before_value = before.permissions.value
+            after_value = after.permissions.value
+            flagged = (before_value ^ after_value) & dangerous_permissions_mask(config)
+            if not flagged:
+                return
             
-            cur.close()
-            conn.close()
+            entry = await audit_log_index.find(
+                after.guild, discord.AuditLogAction.role_update, after.id,
+                check=lambda entry: hasattr(entry.after, 'permissions')
+            )
+            changed_by = entry.user_id if entry else None
+            if bot.user and changed_by == bot.user.id:
+                # Our own edits, including reverts made below
+                return
+            
+            reverted = False
+            revert_latency_ms = None
+            revert_error = None
+            if config.get('auto_revert') and entry and not is_trusted_actor(after.guild, changed_by, config):
+                # Put back only the watched bits, so unrelated edits in the same change survive
+                restored = (after_value & ~flagged) | (before_value & flagged)
+                try:
+                    await after.edit(permissions=discord.Permissions(restored),
+                                     reason=f'Permission guard: unauthorized change by {changed_by}')
+                    reverted = True
+                    revert_latency_ms = int((discord.utils.utcnow() - entry.created_at).total_seconds() * 1000)
+                    metrics.observe('permission_guard.revert', revert_latency_ms / 1000)
+                except discord.HTTPException as e:
+                    revert_error = str(e)
+                    print(f'Error reverting permissions for role {after.name}: {e}')
+            
+            changes = [f"{name}: {bool(before_value & flag)} → {bool(after_value & flag)}"
+                       for name, flag in discord.Permissions.VALID_FLAGS.items() if flagged & flag]
+            
+            async with db.cursor() as cur:
+                await cur.execute('''
+                    INSERT INTO permission_changes (guild_id, role_id, changed_by, changes, before_permissions, after_permissions,
+                                                    reverted, revert_latency_ms)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                ''', (after.guild.id, after.id, changed_by, json.dumps(changes), before_value, after_value,
+                      reverted, revert_latency_ms))
+            
+            embed = discord.Embed(
+                title="⚠️ Role Permissions Changed",
+                description=f"Dangerous permissions were modified for {after.mention}",
+                color=discord.Color.orange(),
+                timestamp=datetime.now()
+            )
+            embed.add_field(name="Role", value=after.mention, inline=True)
+            embed.add_field(name="Changed By", value=audit_actor_mention(entry) if entry else "Unknown", inline=True)
+            embed.add_field(name="Changes", value="\n".join(changes)[:1024], inline=False)
+            if reverted:
+                embed.add_field(name="Auto-Revert", value=f"✅ Reverted {revert_latency_ms} ms after the change", inline=False)
+            elif revert_error:
+                embed.add_field(name="Auto-Revert", value=f"❌ Could not revert: {revert_error}"[:1024], inline=False)
+            
+            if config['alert_role_id']:
+                alert_role = after.guild.get_role(config['alert_role_id'])
+                if alert_role:
+                    embed.description = f"{alert_role.mention}\n\n" + embed.description
+            
+            await send_global_log(after.guild, 'permission_change', embed)
         except Exception as e:
             print(f'Error tracking permission change: {e}')
 
@@ -845,15 +3971,11 @@ async def on_member_ban(guild, user):
     embed.add_field(name="User", value=str(user), inline=True)
     embed.add_field(name="ID", value=user.id, inline=True)
     
-    try:
-        async for entry in guild.audit_logs(limit=1, action=discord.AuditLogAction.ban):
-            if entry.target.id == user.id:
-                embed.add_field(name="Banned By", value=entry.user.mention, inline=True)
-                if entry.reason:
-                    embed.add_field(name="Reason", value=entry.reason, inline=False)
-                break
-    except:
-        pass
+    entry = await audit_log_index.find(guild, discord.AuditLogAction.ban, user.id)
+    if entry:
+        embed.add_field(name="Banned By", value=audit_actor_mention(entry), inline=True)
+        if entry.reason:
+            embed.add_field(name="Reason", value=entry.reason, inline=False)
     
     await send_global_log(guild, 'member_ban', embed)
 
@@ -870,13 +3992,9 @@ async def on_member_unban(guild, user):
     embed.add_field(name="User", value=str(user), inline=True)
     embed.add_field(name="ID", value=user.id, inline=True)
     
-    try:
-        async for entry in guild.audit_logs(limit=1, action=discord.AuditLogAction.unban):
-            if entry.target.id == user.id:
-                embed.add_field(name="Unbanned By", value=entry.user.mention, inline=True)
-                break
-    except:
-        pass
+    entry = await audit_log_index.find(guild, discord.AuditLogAction.unban, user.id)
+    if entry:
+        embed.add_field(name="Unbanned By", value=audit_actor_mention(entry), inline=True)
     
     await send_global_log(guild, 'member_unban', embed)
 
@@ -938,19 +4056,13 @@ async def on_app_command_error(interaction: discord.Interaction, error: app_comm
 ])
 @app_commands.checks.has_permissions(administrator=True)
 async def set_bot_activity(interaction: discord.Interaction, activity_type: str, message: str):
-    conn = get_db()
-    cur = conn.cursor()
-    
-    cur.execute('''
-        INSERT INTO presence_config (guild_id, activity_type, status_message, last_updated)
-        VALUES (%s, %s, %s, %s)
-        ON CONFLICT (guild_id) DO UPDATE 
-        SET activity_type = %s, status_message = %s, last_updated = %s
-    ''', (interaction.guild.id, activity_type, message, datetime.now(), activity_type, message, datetime.now()))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with db.cursor() as cur:
+        await cur.execute('''
+            INSERT INTO presence_config (guild_id, activity_type, status_message, last_updated)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (guild_id) DO UPDATE 
+            SET activity_type = %s, status_message = %s, last_updated = %s
+        ''', (interaction.guild.id, activity_type, message, datetime.now(), activity_type, message, datetime.now()))
     
     if activity_type == 'playing':
         activity = discord.Game(name=message)
@@ -971,20 +4083,14 @@ async def set_bot_activity(interaction: discord.Interaction, activity_type: str,
     rank="Your rank"
 )
 async def register_agent(interaction: discord.Interaction, agent_name: str, division: str, rank: str):
-    conn = get_db()
-    cur = conn.cursor()
-    
-    cur.execute('''
-        INSERT INTO agent_files (guild_id, user_id, agent_name, division, rank, updated_at)
-        VALUES (%s, %s, %s, %s, %s, %s)
-        ON CONFLICT (guild_id, user_id) DO UPDATE 
-        SET agent_name = %s, division = %s, rank = %s, updated_at = %s
-    ''', (interaction.guild.id, interaction.user.id, agent_name, division, rank, datetime.now(),
-          agent_name, division, rank, datetime.now()))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with db.cursor() as cur:
+        await cur.execute('''
+            INSERT INTO agent_files (guild_id, user_id, agent_name, division, rank, updated_at)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (guild_id, user_id) DO UPDATE 
+            SET agent_name = %s, division = %s, rank = %s, updated_at = %s
+        ''', (interaction.guild.id, interaction.user.id, agent_name, division, rank, datetime.now(),
+              agent_name, division, rank, datetime.now()))
     
     log_event(interaction.guild.id, 'agent_registered', target_user_id=interaction.user.id, actor_user_id=interaction.user.id,
              details={'agent_name': agent_name, 'division': division, 'rank': rank})
@@ -1006,15 +4112,10 @@ async def register_agent(interaction: discord.Interaction, agent_name: str, divi
 async def view_agent(interaction: discord.Interaction, member: discord.Member = None):
     target = member or interaction.user
     
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT * FROM agent_files WHERE guild_id = %s AND user_id = %s',
-                (interaction.guild.id, target.id))
-    agent = cur.fetchone()
-    
-    cur.close()
-    conn.close()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('SELECT * FROM agent_files WHERE guild_id = %s AND user_id = %s',
+                    (interaction.guild.id, target.id))
+        agent = cur.fetchone()
     
     if not agent:
         await interaction.response.send_message(f'❌ No agent file found for {target.mention}!', ephemeral=True)
@@ -1037,14 +4138,9 @@ async def view_agent(interaction: discord.Interaction, member: discord.Member =
 @bot.tree.command(name="listagents", description="List all registered agents")
 @app_commands.checks.has_permissions(manage_guild=True)
 async def list_agents(interaction: discord.Interaction):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT * FROM agent_files WHERE guild_id = %s ORDER BY agent_name', (interaction.guild.id,))
-    agents = cur.fetchall()
-    
-    cur.close()
-    conn.close()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('SELECT * FROM agent_files WHERE guild_id = %s ORDER BY agent_name', (interaction.guild.id,))
+        agents = cur.fetchall()
     
     if not agents:
         await interaction.response.send_message('❌ No agents registered yet!')
@@ -1074,41 +4170,30 @@ async def list_agents(interaction: discord.Interaction):
 @app_commands.describe(member="The member whose agent file to delete")
 @app_commands.checks.has_permissions(administrator=True)
 async def delete_agent(interaction: discord.Interaction, member: discord.Member):
-    conn = get_db()
-    cur = conn.cursor()
+    async with db.cursor() as cur:
+        await cur.execute('DELETE FROM agent_files WHERE guild_id = %s AND user_id = %s',
+                    (interaction.guild.id, member.id))
+        deleted = cur.rowcount > 0
     
-    cur.execute('DELETE FROM agent_files WHERE guild_id = %s AND user_id = %s',
-                (interaction.guild.id, member.id))
-    
-    if cur.rowcount > 0:
-        conn.commit()
+    if deleted:
         log_event(interaction.guild.id, 'agent_deleted', target_user_id=member.id, actor_user_id=interaction.user.id)
         await interaction.response.send_message(f'✅ Deleted agent file for {member.mention}!')
     else:
         await interaction.response.send_message(f'❌ No agent file found for {member.mention}!', ephemeral=True)
-    
-    cur.close()
-    conn.close()
 
 @bot.tree.command(name="dutyon", description="Go on duty")
 async def duty_on(interaction: discord.Interaction):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('''
-        INSERT INTO duty_status (guild_id, user_id, is_on_duty, last_updated, updated_by)
-        VALUES (%s, %s, %s, %s, %s)
-        ON CONFLICT (guild_id, user_id) DO UPDATE 
-        SET is_on_duty = true, last_updated = %s, updated_by = %s
-    ''', (interaction.guild.id, interaction.user.id, True, datetime.now(), interaction.user.id,
-          datetime.now(), interaction.user.id))
-    
-    cur.execute('SELECT on_duty_role_id FROM duty_role_config WHERE guild_id = %s', (interaction.guild.id,))
-    role_config = cur.fetchone()
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('''
+            INSERT INTO duty_status (guild_id, user_id, is_on_duty, last_updated, updated_by)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (guild_id, user_id) DO UPDATE 
+            SET is_on_duty = true, last_updated = %s, updated_by = %s
+        ''', (interaction.guild.id, interaction.user.id, True, datetime.now(), interaction.user.id,
+              datetime.now(), interaction.user.id))
+        
+        await cur.execute('SELECT on_duty_role_id FROM duty_role_config WHERE guild_id = %s', (interaction.guild.id,))
+        role_config = cur.fetchone()
     
     if role_config and role_config['on_duty_role_id']:
         duty_role = interaction.guild.get_role(role_config['on_duty_role_id'])
@@ -1124,23 +4209,17 @@ async def duty_on(interaction: discord.Interaction):
 
 @bot.tree.command(name="dutyoff", description="Go off duty")
 async def duty_off(interaction: discord.Interaction):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('''
-        INSERT INTO duty_status (guild_id, user_id, is_on_duty, last_updated, updated_by)
-        VALUES (%s, %s, %s, %s, %s)
-        ON CONFLICT (guild_id, user_id) DO UPDATE 
-        SET is_on_duty = false, last_updated = %s, updated_by = %s
-    ''', (interaction.guild.id, interaction.user.id, False, datetime.now(), interaction.user.id,
-          datetime.now(), interaction.user.id))
-    
-    cur.execute('SELECT on_duty_role_id FROM duty_role_config WHERE guild_id = %s', (interaction.guild.id,))
-    role_config = cur.fetchone()
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('''
+            INSERT INTO duty_status (guild_id, user_id, is_on_duty, last_updated, updated_by)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (guild_id, user_id) DO UPDATE 
+            SET is_on_duty = false, last_updated = %s, updated_by = %s
+        ''', (interaction.guild.id, interaction.user.id, False, datetime.now(), interaction.user.id,
+              datetime.now(), interaction.user.id))
+        
+        await cur.execute('SELECT on_duty_role_id FROM duty_role_config WHERE guild_id = %s', (interaction.guild.id,))
+        role_config = cur.fetchone()
     
     if role_config and role_config['on_duty_role_id']:
         duty_role = interaction.guild.get_role(role_config['on_duty_role_id'])
@@ -1159,15 +4238,10 @@ async def duty_off(interaction: discord.Interaction):
 async def duty_status(interaction: discord.Interaction, member: discord.Member = None):
     target = member or interaction.user
     
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT * FROM duty_status WHERE guild_id = %s AND user_id = %s',
-                (interaction.guild.id, target.id))
-    status = cur.fetchone()
-    
-    cur.close()
-    conn.close()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('SELECT * FROM duty_status WHERE guild_id = %s AND user_id = %s',
+                    (interaction.guild.id, target.id))
+        status = cur.fetchone()
     
     if not status:
         await interaction.response.send_message(f'{target.mention} has no duty status recorded. Default: **OFF DUTY** 🔴')
@@ -1194,15 +4268,10 @@ async def duty_status(interaction: discord.Interaction, member: discord.Member =
 @bot.tree.command(name="dutylist", description="List all on-duty members")
 @app_commands.checks.has_permissions(manage_guild=True)
 async def duty_list(interaction: discord.Interaction):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT * FROM duty_status WHERE guild_id = %s AND is_on_duty = true ORDER BY last_updated DESC',
-                (interaction.guild.id,))
-    on_duty = cur.fetchall()
-    
-    cur.close()
-    conn.close()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('SELECT * FROM duty_status WHERE guild_id = %s AND is_on_duty = true ORDER BY last_updated DESC',
+                    (interaction.guild.id,))
+        on_duty = cur.fetchall()
     
     if not on_duty:
         await interaction.response.send_message('❌ No members are currently on duty!')
@@ -1232,18 +4301,12 @@ async def duty_list(interaction: discord.Interaction):
 @app_commands.describe(role="The role to assign when on duty")
 @app_commands.checks.has_permissions(administrator=True)
 async def set_duty_role(interaction: discord.Interaction, role: discord.Role):
-    conn = get_db()
-    cur = conn.cursor()
-    
-    cur.execute('''
-        INSERT INTO duty_role_config (guild_id, on_duty_role_id)
-        VALUES (%s, %s)
-        ON CONFLICT (guild_id) DO UPDATE SET on_duty_role_id = %s
-    ''', (interaction.guild.id, role.id, role.id))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with db.cursor() as cur:
+        await cur.execute('''
+            INSERT INTO duty_role_config (guild_id, on_duty_role_id)
+            VALUES (%s, %s)
+            ON CONFLICT (guild_id) DO UPDATE SET on_duty_role_id = %s
+        ''', (interaction.guild.id, role.id, role.id))
     
     await interaction.response.send_message(f'✅ On-duty role set to {role.mention}! Members will now receive this role when they go on duty.')
 
@@ -1267,18 +4330,15 @@ async def create_poll(interaction: discord.Interaction, question: str, option1:
     if option5:
         options.append(option5)
     
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('''
-        INSERT INTO polls (guild_id, channel_id, question, options, created_by, is_active)
-        VALUES (%s, %s, %s, %s, %s, %s)
-        RETURNING poll_id
-    ''', (interaction.guild.id, interaction.channel.id, question, json.dumps(options), 
-          interaction.user.id, True))
-    
-    poll_id = cur.fetchone()['poll_id']
-    conn.commit()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('''
+            INSERT INTO polls (guild_id, channel_id, question, options, created_by, is_active)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            RETURNING poll_id
+        ''', (interaction.guild.id, interaction.channel.id, question, json.dumps(options), 
+              interaction.user.id, True))
+        
+        poll_id = cur.fetchone()['poll_id']
     
     embed = discord.Embed(
         title="📊 " + question,
@@ -1294,11 +4354,8 @@ async def create_poll(interaction: discord.Interaction, question: str, option1:
     
     message = await interaction.original_response()
     
-    cur.execute('UPDATE polls SET message_id = %s WHERE poll_id = %s', (message.id, poll_id))
-    conn.commit()
-    
-    cur.close()
-    conn.close()
+    async with db.cursor() as cur:
+        await cur.execute('UPDATE polls SET message_id = %s WHERE poll_id = %s', (message.id, poll_id))
     
     log_event(interaction.guild.id, 'poll_created', actor_user_id=interaction.user.id,
              details={'question': question, 'options': options, 'poll_id': poll_id})
@@ -1307,31 +4364,27 @@ async def create_poll(interaction: discord.Interaction, question: str, option1:
 @app_commands.describe(poll_id="The ID of the poll to close")
 @app_commands.checks.has_permissions(manage_guild=True)
 async def close_poll(interaction: discord.Interaction, poll_id: int):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT * FROM polls WHERE poll_id = %s AND guild_id = %s', (poll_id, interaction.guild.id))
-    poll = cur.fetchone()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('SELECT * FROM polls WHERE poll_id = %s AND guild_id = %s', (poll_id, interaction.guild.id))
+        poll = cur.fetchone()
+        
+        if poll:
+            await cur.execute('UPDATE polls SET is_active = false WHERE poll_id = %s', (poll_id,))
+            
+            await cur.execute('''
+                SELECT option_index, COUNT(*) as vote_count
+                FROM poll_votes
+                WHERE poll_id = %s
+                GROUP BY option_index
+                ORDER BY option_index
+            ''', (poll_id,))
+            
+            results = cur.fetchall()
     
     if not poll:
         await interaction.response.send_message(f'❌ Poll #{poll_id} not found!', ephemeral=True)
-        cur.close()
-        conn.close()
         return
     
-    cur.execute('UPDATE polls SET is_active = false WHERE poll_id = %s', (poll_id,))
-    
-    cur.execute('''
-        SELECT option_index, COUNT(*) as vote_count
-        FROM poll_votes
-        WHERE poll_id = %s
-        GROUP BY option_index
-        ORDER BY option_index
-    ''', (poll_id,))
-    
-    results = cur.fetchall()
-    conn.commit()
-    
     options = json.loads(poll['options'])
     
     embed = discord.Embed(
@@ -1359,9 +4412,6 @@ async def close_poll(interaction: discord.Interaction, poll_id: int):
     
     await interaction.response.send_message(embed=embed)
     
-    cur.close()
-    conn.close()
-    
     log_event(interaction.guild.id, 'poll_closed', actor_user_id=interaction.user.id,
              details={'poll_id': poll_id, 'total_votes': total_votes})
 
@@ -1369,18 +4419,15 @@ async def close_poll(interaction: discord.Interaction, poll_id: int):
 @app_commands.describe(channel="The channel where all logs will be sent")
 @app_commands.checks.has_permissions(administrator=True)
 async def set_global_log(interaction: discord.Interaction, channel: discord.TextChannel):
-    conn = get_db()
-    cur = conn.cursor()
-    
-    cur.execute('''
-        INSERT INTO global_log_config (guild_id, channel_id, enabled)
-        VALUES (%s, %s, true)
-        ON CONFLICT (guild_id) DO UPDATE SET channel_id = %s, enabled = true
-    ''', (interaction.guild.id, channel.id, channel.id))
+    async with db.cursor() as cur:
+        await cur.execute('''
+            INSERT INTO global_log_config (guild_id, channel_id, enabled)
+            VALUES (%s, %s, true)
+            ON CONFLICT (guild_id) DO UPDATE SET channel_id = %s, enabled = true
+        ''', (interaction.guild.id, channel.id, channel.id))
+        await publish_config_change(cur, interaction.guild.id, 'global_log_config')
     
-    conn.commit()
-    cur.close()
-    conn.close()
+    await config_cache.refresh(interaction.guild.id, 'global_log_config')
     
     await interaction.response.send_message(
         f'✅ Global logging enabled! All server events will now be logged to {channel.mention}\n\n'
@@ -1391,16 +4438,13 @@ async def set_global_log(interaction: discord.Interaction, channel: discord.Text
 @bot.tree.command(name="disablegloballog", description="Disable the unified logging system")
 @app_commands.checks.has_permissions(administrator=True)
 async def disable_global_log(interaction: discord.Interaction):
-    conn = get_db()
-    cur = conn.cursor()
-    
-    cur.execute('''
-        UPDATE global_log_config SET enabled = false WHERE guild_id = %s
-    ''', (interaction.guild.id,))
+    async with db.cursor() as cur:
+        await cur.execute('''
+            UPDATE global_log_config SET enabled = false WHERE guild_id = %s
+        ''', (interaction.guild.id,))
+        await publish_config_change(cur, interaction.guild.id, 'global_log_config')
     
-    conn.commit()
-    cur.close()
-    conn.close()
+    await config_cache.refresh(interaction.guild.id, 'global_log_config')
     
     await interaction.response.send_message('✅ Global logging disabled!')
 
@@ -1409,32 +4453,46 @@ async def disable_global_log(interaction: discord.Interaction):
     anti_raid="Enable anti-raid detection",
     raid_threshold="Number of joins to trigger raid alert (default: 5)",
     raid_window="Time window in seconds for raid detection (default: 30)",
+    extra_windows="Extra windows as seconds:joins, e.g. 10:8,600:50 (use 'none' to clear)",
     min_account_age="Minimum account age in days (default: 7)",
+    wave_size="Alert when this many recent joiners' accounts were created together (0 to turn off, default: off)",
+    wave_minutes="How close together those accounts were created, in minutes (default: 10)",
+    blocklist_action="What to do when a blocklisted account joins",
     auto_lockdown="Automatically activate lockdown when raid detected",
+    pause_welcomes="During a raid, hold back welcomes and auto-roles and send one summary afterwards",
     permission_guard="Enable permission guard to monitor role permission changes",
+    watched_permissions="Permissions the guard alerts on, e.g. administrator,ban_members (use 'default' to reset)",
+    auto_revert="Undo watched permission changes made by anyone outside the trusted roles",
+    trusted_roles="Roles allowed to change watched permissions, e.g. @Admin @Director (use 'none' to clear)",
+    anti_nuke="Quarantine anyone doing too many destructive actions too fast",
+    nuke_limits="Per-action limits as action:count/seconds, e.g. channel_delete:3/10,ban:5/10 ('default' to reset)",
     alert_role="Role to ping for security alerts"
 )
+@app_commands.choices(blocklist_action=[
+    app_commands.Choice(name="Off", value="off"),
+    app_commands.Choice(name="Alert only", value="alert"),
+    app_commands.Choice(name="Time out for 7 days", value="quarantine"),
+    app_commands.Choice(name="Ban", value="ban")
+])
 @app_commands.checks.has_permissions(administrator=True)
 async def config_security(interaction: discord.Interaction, 
                          anti_raid: bool = None,
                          raid_threshold: int = None,
                          raid_window: int = None,
+                         extra_windows: str = None,
                          min_account_age: int = None,
+                         wave_size: int = None,
+                         wave_minutes: int = None,
+                         blocklist_action: str = None,
                          auto_lockdown: bool = None,
+                         pause_welcomes: bool = None,
                          permission_guard: bool = None,
+                         watched_permissions: str = None,
+                         auto_revert: bool = None,
+                         trusted_roles: str = None,
+                         anti_nuke: bool = None,
+                         nuke_limits: str = None,
                          alert_role: discord.Role = None):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT * FROM security_config WHERE guild_id = %s', (interaction.guild.id,))
-    existing = cur.fetchone()
-    
-    if not existing:
-        cur.execute('''
-            INSERT INTO security_config (guild_id) VALUES (%s)
-        ''', (interaction.guild.id,))
-        conn.commit()
-    
     updates = []
     params = []
     
@@ -1447,32 +4505,102 @@ async def config_security(interaction: discord.Interaction,
     if raid_window is not None:
         updates.append("raid_time_window = %s")
         params.append(raid_window)
+    if extra_windows is not None:
+        if extra_windows.strip().lower() == 'none':
+            extra_windows = ''
+        try:
+            windows = parse_raid_windows(extra_windows)
+        except ValueError:
+            await interaction.response.send_message('❌ Extra windows must look like `10:8,600:50` (seconds:joins)!', ephemeral=True)
+            return
+        updates.append("raid_windows = %s")
+        params.append(",".join(f"{seconds}:{limit}" for seconds, limit in windows) or None)
     if min_account_age is not None:
         updates.append("min_account_age = %s")
         params.append(min_account_age)
+    if wave_size is not None:
+        updates.append("join_wave_size = %s")
+        params.append(max(0, wave_size))
+    if wave_minutes is not None:
+        if wave_minutes <= 0:
+            await interaction.response.send_message('❌ Wave minutes must be at least 1!', ephemeral=True)
+            return
+        updates.append("join_wave_span = %s")
+        params.append(wave_minutes * 60)
+    if blocklist_action is not None:
+        updates.append("blocklist_action = %s")
+        params.append(blocklist_action)
     if auto_lockdown is not None:
         updates.append("auto_lockdown = %s")
         params.append(auto_lockdown)
+    if pause_welcomes is not None:
+        updates.append("raid_mode = %s")
+        params.append(pause_welcomes)
     if permission_guard is not None:
         updates.append("permission_guard_enabled = %s")
         params.append(permission_guard)
+    if watched_permissions is not None:
+        if watched_permissions.strip().lower() == 'default':
+            mask = None
+        else:
+            names = [name.strip().lower().replace(' ', '_') for name in watched_permissions.split(',') if name.strip()]
+            unknown = [name for name in names if name not in discord.Permissions.VALID_FLAGS]
+            if unknown or not names:
+                await interaction.response.send_message(
+                    f'❌ Unknown permissions: {", ".join(unknown) or "none given"}. Use names like `administrator,ban_members`.',
+                    ephemeral=True
+                )
+                return
+            mask = 0
+            for name in names:
+                mask |= discord.Permissions.VALID_FLAGS[name]
+        updates.append("dangerous_permissions = %s")
+        params.append(mask)
+    if auto_revert is not None:
+        updates.append("auto_revert = %s")
+        params.append(auto_revert)
+    if trusted_roles is not None:
+        role_ids = [int(role_id) for role_id in re.findall(r'\d{15,20}', trusted_roles)
+                    if interaction.guild.get_role(int(role_id))]
+        updates.append("trusted_role_ids = %s")
+        params.append(','.join(str(role_id) for role_id in role_ids) or None)
+    if anti_nuke is not None:
+        updates.append("anti_nuke_enabled = %s")
+        params.append(anti_nuke)
+    if nuke_limits is not None:
+        if nuke_limits.strip().lower() == 'default':
+            limits = {}
+        else:
+            try:
+                limits = parse_nuke_limits(nuke_limits)
+            except ValueError:
+                await interaction.response.send_message(
+                    f'❌ Limits must look like `channel_delete:3/10,ban:5/10`. Actions: {", ".join(DEFAULT_NUKE_LIMITS)}',
+                    ephemeral=True
+                )
+                return
+        updates.append("anti_nuke_limits = %s")
+        params.append(','.join(f"{action}:{count}/{seconds}" for action, (count, seconds) in limits.items()) or None)
     if alert_role is not None:
         updates.append("alert_role_id = %s")
         params.append(alert_role.id)
     
-    if updates:
-        params.append(interaction.guild.id)
-        cur.execute(f'''
-            UPDATE security_config SET {", ".join(updates)}
-            WHERE guild_id = %s
-        ''', params)
-        conn.commit()
-    
-    cur.execute('SELECT * FROM security_config WHERE guild_id = %s', (interaction.guild.id,))
-    config = cur.fetchone()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('''
+            INSERT INTO security_config (guild_id) VALUES (%s)
+            ON CONFLICT (guild_id) DO NOTHING
+        ''', (interaction.guild.id,))
+        
+        if updates:
+            params.append(interaction.guild.id)
+            await cur.execute(f'''
+                UPDATE security_config SET {", ".join(updates)}
+                WHERE guild_id = %s
+            ''', params)
+        
+        await publish_config_change(cur, interaction.guild.id, 'security_config')
     
-    cur.close()
-    conn.close()
+    config = await config_cache.refresh(interaction.guild.id, 'security_config')
     
     embed = discord.Embed(
         title="🛡️ Security Configuration Updated",
@@ -1480,18 +4608,35 @@ async def config_security(interaction: discord.Interaction,
         timestamp=datetime.now()
     )
     
+    join_wave_text = (f"{config['join_wave_size']} accounts made within {config['join_wave_span'] // 60} min"
+                      if config['join_wave_size'] else 'Off')
     embed.add_field(
         name="Anti-Raid Protection",
         value=f"{'✅ Enabled' if config['anti_raid_enabled'] else '❌ Disabled'}\n"
               f"Threshold: {config['raid_threshold']} joins in {config['raid_time_window']}s\n"
+              f"Extra Windows: {config['raid_windows'] or 'None'}\n"
               f"Min Account Age: {config['min_account_age']} days\n"
-              f"Auto-Lockdown: {'✅ Yes' if config['auto_lockdown'] else '❌ No'}",
+              f"Join Waves: {join_wave_text}\n"
+              f"Blocklist: {(config['blocklist_action'] or 'alert').title()} ({len(blocklist)} entries)\n"
+              f"Auto-Lockdown: {'✅ Yes' if config['auto_lockdown'] else '❌ No'}\n"
+              f"Pause Welcomes in Raids: {'✅ Yes' if config['raid_mode'] else '❌ No'}",
         inline=False
     )
     
     embed.add_field(
         name="Permission Guard",
-        value=f"{'✅ Enabled' if config['permission_guard_enabled'] else '❌ Disabled'}",
+        value=(f"{'✅ Enabled' if config['permission_guard_enabled'] else '❌ Disabled'}\n"
+               f"Auto-Revert: {'✅ Yes' if config['auto_revert'] else '❌ No'}\n"
+               f"Trusted Roles: {', '.join(f'<@&{role_id}>' for role_id in parse_id_list(config['trusted_role_ids'])) or 'None'}\n"
+               f"Watching: {', '.join(permission_names(dangerous_permissions_mask(config)))}")[:1024],
+        inline=False
+    )
+    
+    embed.add_field(
+        name="Anti-Nuke",
+        value=(f"{'✅ Enabled' if config['anti_nuke_enabled'] else '❌ Disabled'}\n"
+               + "\n".join(f"{action}: {count} in {seconds}s"
+                           for action, (count, seconds) in anti_nuke.limits_for(config).items()))[:1024],
         inline=False
     )
     
@@ -1504,29 +4649,22 @@ async def config_security(interaction: discord.Interaction,
 @bot.tree.command(name="securitystatus", description="View current security settings and stats")
 @app_commands.checks.has_permissions(manage_guild=True)
 async def security_status(interaction: discord.Interaction):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT * FROM security_config WHERE guild_id = %s', (interaction.guild.id,))
-    config = cur.fetchone()
-    
-    cur.execute('SELECT * FROM global_log_config WHERE guild_id = %s', (interaction.guild.id,))
-    log_config = cur.fetchone()
-    
-    cur.execute('''
-        SELECT COUNT(*) as suspicious_count FROM raid_tracking 
-        WHERE guild_id = %s AND is_suspicious = true AND joined_at > NOW() - INTERVAL '24 hours'
-    ''', (interaction.guild.id,))
-    suspicious = cur.fetchone()
-    
-    cur.execute('''
-        SELECT COUNT(*) as recent_joins FROM raid_tracking 
-        WHERE guild_id = %s AND joined_at > NOW() - INTERVAL '1 hour'
-    ''', (interaction.guild.id,))
-    recent = cur.fetchone()
-    
-    cur.close()
-    conn.close()
+    config = await config_cache.get('security_config', interaction.guild.id)
+    log_config = await config_cache.get('global_log_config', interaction.guild.id)
+    await raid_tracking_buffer.flush()
+    
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('''
+            SELECT COUNT(*) as suspicious_count FROM raid_tracking 
+            WHERE guild_id = %s AND is_suspicious = true AND joined_at > NOW() - INTERVAL '24 hours'
+        ''', (interaction.guild.id,))
+        suspicious = cur.fetchone()
+        
+        await cur.execute('''
+            SELECT COUNT(*) as recent_joins FROM raid_tracking 
+            WHERE guild_id = %s AND joined_at > NOW() - INTERVAL '1 hour'
+        ''', (interaction.guild.id,))
+        recent = cur.fetchone()
     
     recommendations = []
     protection_score = 0
@@ -1560,6 +4698,7 @@ async def security_status(interaction: discord.Interaction):
                 name="🛡️ Anti-Raid System",
                 value=f"✅ **Active**\n"
                       f"• Trigger: {config['raid_threshold']} joins in {config['raid_time_window']}s\n"
+                      f"• Extra Windows: {config['raid_windows'] or 'None'}\n"
                       f"• Min Account Age: {config['min_account_age']} days\n"
                       f"• Auto-Lockdown: {'✅ Enabled' if config['auto_lockdown'] else '❌ Disabled'}",
                 inline=False
@@ -1673,18 +4812,15 @@ async def security_status(interaction: discord.Interaction):
 ])
 @app_commands.checks.has_permissions(administrator=True)
 async def set_log_channel(interaction: discord.Interaction, event_type: str, channel: discord.TextChannel):
-    conn = get_db()
-    cur = conn.cursor()
+    async with db.cursor() as cur:
+        await cur.execute('''
+            INSERT INTO log_channels (guild_id, event_type, channel_id)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (guild_id, event_type) DO UPDATE SET channel_id = %s
+        ''', (interaction.guild.id, event_type, channel.id, channel.id))
+        await publish_config_change(cur, interaction.guild.id, 'log_channels')
     
-    cur.execute('''
-        INSERT INTO log_channels (guild_id, event_type, channel_id)
-        VALUES (%s, %s, %s)
-        ON CONFLICT (guild_id, event_type) DO UPDATE SET channel_id = %s
-    ''', (interaction.guild.id, event_type, channel.id, channel.id))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    await config_cache.refresh(interaction.guild.id, 'log_channels')
     
     event_names = {
         'member_join': 'Member Joins',
@@ -1708,28 +4844,26 @@ async def view_logs(interaction: discord.Interaction, event_type: str = None, li
     if limit > 25:
         limit = 25
     
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    if event_type:
-        cur.execute('''
-            SELECT * FROM activity_logs 
-            WHERE guild_id = %s AND event_type = %s
-            ORDER BY timestamp DESC 
-            LIMIT %s
-        ''', (interaction.guild.id, event_type, limit))
-    else:
-        cur.execute('''
-            SELECT * FROM activity_logs 
-            WHERE guild_id = %s
-            ORDER BY timestamp DESC 
-            LIMIT %s
-        ''', (interaction.guild.id, limit))
-    
-    logs = cur.fetchall()
-    
-    cur.close()
-    conn.close()
+    # Write out anything still buffered so the newest events show up
+    await activity_log_buffer.flush()
+    
+    async with db.cursor(dict_rows=True) as cur:
+        if event_type:
+            await cur.execute('''
+                SELECT * FROM activity_logs 
+                WHERE guild_id = %s AND event_type = %s
+                ORDER BY timestamp DESC 
+                LIMIT %s
+            ''', (interaction.guild.id, event_type, limit))
+        else:
+            await cur.execute('''
+                SELECT * FROM activity_logs 
+                WHERE guild_id = %s
+                ORDER BY timestamp DESC 
+                LIMIT %s
+            ''', (interaction.guild.id, limit))
+        
+        logs = cur.fetchall()
     
     if not logs:
         await interaction.response.send_message('❌ No logs found!', ephemeral=True)
@@ -1757,282 +4891,241 @@ async def view_logs(interaction: discord.Interaction, event_type: str = None, li
 @bot.tree.command(name="setlockdownconfig", description="Configure emergency lockdown settings (Director only)")
 @app_commands.describe(
     director_role="The role that can activate lockdown",
-    announcement_channel="Channel for lockdown announcements"
+    announcement_channel="Channel for lockdown announcements",
+    mode="Lock each channel, or lock @everyone and member roles (far fewer changes)",
+    member_roles="Roles locked in role mode besides @everyone, e.g. @Member @Verified"
 )
+@app_commands.choices(mode=[
+    app_commands.Choice(name="Channel (edit every channel)", value="channel"),
+    app_commands.Choice(name="Role (edit roles, only override channels that need it)", value="role")
+])
 @app_commands.checks.has_permissions(administrator=True)
 async def set_lockdown_config(interaction: discord.Interaction, director_role: discord.Role, 
-                              announcement_channel: discord.TextChannel):
-    conn = get_db()
-    cur = conn.cursor()
-    
-    cur.execute('''
-        INSERT INTO lockdown_config (guild_id, director_role_id, announcement_channel_id)
-        VALUES (%s, %s, %s)
-        ON CONFLICT (guild_id) DO UPDATE 
-        SET director_role_id = %s, announcement_channel_id = %s
-    ''', (interaction.guild.id, director_role.id, announcement_channel.id, 
-          director_role.id, announcement_channel.id))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+                              announcement_channel: discord.TextChannel,
+                              mode: str = None,
+                              member_roles: str = None):
+    role_ids = None
+    if member_roles is not None:
+        role_ids = [int(role_id) for role_id in re.findall(r'\d{15,20}', member_roles)
+                    if interaction.guild.get_role(int(role_id))]
+    
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('''
+            INSERT INTO lockdown_config (guild_id, director_role_id, announcement_channel_id)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (guild_id) DO UPDATE 
+            SET director_role_id = %s, announcement_channel_id = %s
+        ''', (interaction.guild.id, director_role.id, announcement_channel.id, 
+              director_role.id, announcement_channel.id))
+        
+        if mode is not None:
+            await cur.execute('UPDATE lockdown_config SET lockdown_mode = %s WHERE guild_id = %s',
+                              (mode, interaction.guild.id))
+        if role_ids is not None:
+            await cur.execute('UPDATE lockdown_config SET lockdown_role_ids = %s WHERE guild_id = %s',
+                              (','.join(str(role_id) for role_id in role_ids) or None, interaction.guild.id))
+        
+        await cur.execute('SELECT lockdown_mode, lockdown_role_ids FROM lockdown_config WHERE guild_id = %s',
+                          (interaction.guild.id,))
+        config = cur.fetchone()
+    
+    roles = [interaction.guild.get_role(role_id) for role_id in parse_id_list(config['lockdown_role_ids'])]
+    roles_text = ', '.join(role.mention for role in roles if role) or 'None'
     
     await interaction.response.send_message(
-        f'✅ Lockdown configured!\nDirector Role: {director_role.mention}\nAnnouncement Channel: {announcement_channel.mention}'
+        f'✅ Lockdown configured!\nDirector Role: {director_role.mention}\nAnnouncement Channel: {announcement_channel.mention}\n'
+        f'Mode: {(config["lockdown_mode"] or "channel").title()}\nMember Roles: {roles_text}'
+    )
+
+@bot.tree.command(name="lockdownplan", description="Dry run: show what lockdown would change and how many API calls it takes")
+@app_commands.checks.has_permissions(manage_guild=True)
+async def lockdown_plan(interaction: discord.Interaction):
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('SELECT * FROM lockdown_config WHERE guild_id = %s', (interaction.guild.id,))
+        config = cur.fetchone()
+    
+    config = config or {}
+    categories, individual, synced = plan_channel_lockdown(interaction.guild, config)
+    channel_calls = len(categories) + len(individual) + len(synced)
+    roles, channels = plan_role_lockdown(interaction.guild, config)
+    role_calls = len(roles) + len(channels)
+    
+    embed = discord.Embed(
+        title="🔒 Lockdown Plan",
+        description=f"Current mode: **{(config.get('lockdown_mode') or 'channel').title()}**\nNothing is changed by this command.",
+        color=discord.Color.blue(),
+        timestamp=datetime.now()
+    )
+    embed.add_field(
+        name="Channel Mode",
+        value=f"{channel_calls} changes to lock and to unlock\n"
+              f"({len(categories)} categories + {len(individual)} channels with their own settings "
+              f"+ {len(synced)} channels re-synced to their category)",
+        inline=False
+    )
+    embed.add_field(
+        name="Role Mode",
+        value=f"{role_calls} changes to lock and to unlock\n"
+              f"({len(roles)} roles + {len(channels)} channels with overrides)",
+        inline=False
     )
+    if categories:
+        embed.add_field(name="Categories Locked", value=', '.join(category.mention for category in categories)[:1024], inline=False)
+    if individual:
+        embed.add_field(name="Channels Locked One by One", value=', '.join(channel.mention for channel in individual)[:1024], inline=False)
+    embed.add_field(name="Roles Locked (Role Mode)", value=', '.join(role.mention for role in roles)[:1024], inline=False)
+    
+    await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @bot.tree.command(name="lockdown", description="Activate emergency lockdown (Director only)")
 @app_commands.describe(reason="Reason for lockdown")
 async def lockdown(interaction: discord.Interaction, reason: str):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT * FROM lockdown_config WHERE guild_id = %s', (interaction.guild.id,))
-    config = cur.fetchone()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('SELECT * FROM lockdown_config WHERE guild_id = %s', (interaction.guild.id,))
+        config = cur.fetchone()
     
     if not config:
         await interaction.response.send_message('❌ Lockdown not configured! Use /setlockdownconfig first.', ephemeral=True)
-        cur.close()
-        conn.close()
         return
     
     director_role = interaction.guild.get_role(config['director_role_id'])
     
     if director_role not in interaction.user.roles:
         await interaction.response.send_message('❌ Only the Director can activate lockdown!', ephemeral=True)
-        cur.close()
-        conn.close()
+        return
+    
+    if lockdown_engine.is_busy(interaction.guild.id):
+        await interaction.response.send_message('❌ A lockdown change is already in progress!', ephemeral=True)
         return
     
     if config['is_active']:
         await interaction.response.send_message('❌ Lockdown is already active!', ephemeral=True)
-        cur.close()
-        conn.close()
         return
     
-    cur.execute('''
-        UPDATE lockdown_config 
-        SET is_active = true, initiated_by = %s, initiated_at = %s
-        WHERE guild_id = %s
-    ''', (interaction.user.id, datetime.now(), interaction.guild.id))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
-    
     await interaction.response.send_message('🚨 **INITIATING EMERGENCY LOCKDOWN...** 🚨', ephemeral=True)
     
-    announcement_channel = interaction.guild.get_channel(config['announcement_channel_id'])
-    
-    if announcement_channel:
-        embed = discord.Embed(
-            title="🚨 EMERGENCY LOCKDOWN ACTIVATED 🚨",
-            description=f"**The server is now under emergency lockdown.**\n\nAll non-essential communications are restricted.",
-            color=discord.Color.red(),
-            timestamp=datetime.now()
-        )
-        embed.add_field(name="Initiated By", value=interaction.user.mention, inline=True)
-        embed.add_field(name="Reason", value=reason, inline=False)
-        embed.add_field(name="Instructions", value="Stay calm and await further instructions from leadership.", inline=False)
-        embed.set_footer(text="This is an emergency protocol")
-        
-        if director_role:
-            await announcement_channel.send(f'{director_role.mention} @everyone', embed=embed)
-        else:
-            await announcement_channel.send('@everyone', embed=embed)
-    
-    conn = get_db()
-    cur = conn.cursor()
-    
-    for channel in interaction.guild.text_channels:
-        try:
-            overwrites = channel.overwrites
-            
-            all_overwrites = {}
-            for target, overwrite in overwrites.items():
-                if isinstance(target, discord.Role):
-                    target_type = 'role'
-                    target_id = target.id
-                elif isinstance(target, discord.Member):
-                    target_type = 'member'
-                    target_id = target.id
-                else:
-                    continue
-                
-                perms_dict = {}
-                for perm_name in dir(overwrite):
-                    if not perm_name.startswith('_'):
-                        perm_value = getattr(overwrite, perm_name, None)
-                        if perm_value is not None and isinstance(perm_value, bool):
-                            perms_dict[perm_name] = perm_value
-                
-                all_overwrites[f'{target_type}_{target_id}'] = perms_dict
-            
-            cur.execute('''
-                INSERT INTO lockdown_permissions (guild_id, channel_id, permissions_json)
-                VALUES (%s, %s, %s)
-                ON CONFLICT (guild_id, channel_id) DO UPDATE SET permissions_json = %s
-            ''', (interaction.guild.id, channel.id, json.dumps(all_overwrites), json.dumps(all_overwrites)))
-            
-            if channel.id == config['announcement_channel_id']:
-                overwrites[interaction.guild.default_role] = discord.PermissionOverwrite(
-                    view_channel=True,
-                    send_messages=False,
-                    add_reactions=False
-                )
-            else:
-                overwrites[interaction.guild.default_role] = discord.PermissionOverwrite(
-                    view_channel=False
-                )
-            
-            await channel.edit(overwrites=overwrites)
-        except Exception as e:
-            print(f'Error locking channel {channel.name}: {e}')
-    
-    conn.commit()
-    cur.close()
-    conn.close()
-    
-    log_event(interaction.guild.id, 'lockdown_activated', actor_user_id=interaction.user.id,
-             details={'reason': reason})
+    progress = interaction_progress(interaction, '🚨 **LOCKING DOWN** 🚨')
+    if await lockdown_engine.activate(interaction.guild, interaction.user, reason, progress=progress):
+        await interaction.edit_original_response(content='🚨 **EMERGENCY LOCKDOWN COMPLETE** 🚨')
+    else:
+        await interaction.followup.send('❌ Lockdown could not be started. It may already be active.', ephemeral=True)
 
 @bot.tree.command(name="unlockdown", description="Deactivate emergency lockdown (Director only)")
 async def unlockdown(interaction: discord.Interaction):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT * FROM lockdown_config WHERE guild_id = %s', (interaction.guild.id,))
-    config = cur.fetchone()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('SELECT * FROM lockdown_config WHERE guild_id = %s', (interaction.guild.id,))
+        config = cur.fetchone()
     
     if not config:
         await interaction.response.send_message('❌ Lockdown not configured!', ephemeral=True)
-        cur.close()
-        conn.close()
         return
     
     director_role = interaction.guild.get_role(config['director_role_id'])
     
     if director_role not in interaction.user.roles:
         await interaction.response.send_message('❌ Only the Director can deactivate lockdown!', ephemeral=True)
-        cur.close()
-        conn.close()
+        return
+    
+    if lockdown_engine.is_busy(interaction.guild.id):
+        await interaction.response.send_message('❌ A lockdown change is already in progress!', ephemeral=True)
         return
     
     if not config['is_active']:
         await interaction.response.send_message('❌ Lockdown is not active!', ephemeral=True)
-        cur.close()
-        conn.close()
         return
     
-    cur.execute('UPDATE lockdown_config SET is_active = false WHERE guild_id = %s', (interaction.guild.id,))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
-    
     await interaction.response.send_message('✅ **Deactivating lockdown...** Please wait.', ephemeral=True)
     
-    announcement_channel = interaction.guild.get_channel(config['announcement_channel_id'])
+    progress = interaction_progress(interaction, '✅ **Unlocking**')
+    result = await lockdown_engine.deactivate(interaction.guild, interaction.user, progress=progress)
+    if result:
+        await interaction.edit_original_response(
+            content=f"✅ **Lockdown lifted.** {result['done']} restored, {result['skipped']} already unchanged and skipped"
+                    + (f", {result['failed']} failed." if result['failed'] else ".")
+        )
+    else:
+        await interaction.followup.send('❌ Lockdown could not be lifted. It may already be inactive.', ephemeral=True)
+
+@bot.tree.command(name="snapshotguild", description="Save a snapshot of roles and channels now and list recent snapshots")
+@app_commands.checks.has_permissions(manage_guild=True)
+async def snapshot_guild(interaction: discord.Interaction):
+    await interaction.response.defer(ephemeral=True)
     
-    if announcement_channel:
-        embed = discord.Embed(
-            title="✅ LOCKDOWN DEACTIVATED",
-            description="The emergency lockdown has been lifted. Normal operations may resume.",
-            color=discord.Color.green(),
-            timestamp=datetime.now()
+    snapshot_id = await guild_snapshotter.take(interaction.guild)
+    snapshots = await guild_snapshotter.recent(interaction.guild.id)
+    
+    embed = discord.Embed(
+        title="📸 Server Snapshots",
+        description=(f"✅ Saved snapshot **#{snapshot_id}**." if snapshot_id
+                     else "Nothing changed since the last snapshot, so no new one was needed."),
+        color=discord.Color.blue(),
+        timestamp=datetime.now()
+    )
+    if snapshots:
+        embed.add_field(
+            name="Recent Snapshots",
+            value="\n".join(
+                f"**#{snap['snapshot_id']}** - {snap['created_at'].strftime('%Y-%m-%d %H:%M')} "
+                f"({snap['role_count']} roles, {snap['channel_count']} channels)"
+                for snap in snapshots
+            )[:1024],
+            inline=False
         )
-        embed.add_field(name="Deactivated By", value=interaction.user.mention, inline=True)
-        embed.set_footer(text="Emergency protocol ended")
-        
-        await announcement_channel.send(embed=embed)
+    embed.set_footer(text="Use /restoreguild to rebuild deleted roles and channels")
+    
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="restoreguild", description="Recreate deleted roles and channels from a snapshot")
+@app_commands.describe(snapshot="Snapshot number from /snapshotguild (default: the latest)")
+@app_commands.checks.has_permissions(administrator=True)
+async def restore_guild(interaction: discord.Interaction, snapshot: int = None):
+    if guild_snapshotter.is_restoring(interaction.guild.id) or lockdown_engine.is_busy(interaction.guild.id):
+        await interaction.response.send_message('❌ A restore or lockdown change is already in progress!', ephemeral=True)
+        return
     
-    conn_perms = get_db()
-    cur_perms = conn_perms.cursor(cursor_factory=RealDictCursor)
+    await interaction.response.send_message('🛠️ **Loading snapshot...**', ephemeral=True)
     
-    for channel in interaction.guild.text_channels:
-        try:
-            cur_perms.execute('''
-                SELECT permissions_json FROM lockdown_permissions 
-                WHERE guild_id = %s AND channel_id = %s
-            ''', (interaction.guild.id, channel.id))
-            
-            stored_perms = cur_perms.fetchone()
-            
-            if stored_perms and stored_perms['permissions_json']:
-                perms_json = stored_perms['permissions_json']
-                
-                try:
-                    all_overwrites = json.loads(perms_json)
-                    new_overwrites = {}
-                    
-                    for target_key, perms_dict in all_overwrites.items():
-                        parts = target_key.split('_', 1)
-                        if len(parts) != 2:
-                            continue
-                        
-                        target_type, target_id_str = parts
-                        target_id = int(target_id_str)
-                        target = None
-                        
-                        if target_type == 'role':
-                            target = interaction.guild.get_role(target_id)
-                        elif target_type == 'member':
-                            target = interaction.guild.get_member(target_id)
-                            if not target:
-                                try:
-                                    target = await interaction.guild.fetch_member(target_id)
-                                except:
-                                    pass
-                        
-                        if not target:
-                            continue
-                        
-                        restored_overwrite = discord.PermissionOverwrite()
-                        for perm_name, perm_value in perms_dict.items():
-                            try:
-                                setattr(restored_overwrite, perm_name, perm_value)
-                            except:
-                                pass
-                        new_overwrites[target] = restored_overwrite
-                    
-                    await channel.edit(overwrites=new_overwrites)
-                except Exception as e:
-                    print(f'Error restoring permissions for {channel.name}: {e}')
-                    overwrites = channel.overwrites
-                    if interaction.guild.default_role in overwrites:
-                        del overwrites[interaction.guild.default_role]
-                        await channel.edit(overwrites=overwrites)
-            else:
-                overwrites = channel.overwrites
-                if interaction.guild.default_role in overwrites:
-                    del overwrites[interaction.guild.default_role]
-                    await channel.edit(overwrites=overwrites)
-        except Exception as e:
-            print(f'Error unlocking channel {channel.name}: {e}')
+    loaded = await guild_snapshotter.load(interaction.guild.id, snapshot)
+    if not loaded:
+        await interaction.edit_original_response(content='❌ No snapshot found! Use /snapshotguild to take one.')
+        return
+    snap, items = loaded
     
-    cur_perms.execute('DELETE FROM lockdown_permissions WHERE guild_id = %s', (interaction.guild.id,))
-    conn_perms.commit()
-    cur_perms.close()
-    conn_perms.close()
+    async def progress(stage, done, failed, total):
+        await interaction.edit_original_response(
+            content=f'🛠️ **Restoring snapshot #{snap["snapshot_id"]}** - {stage} {done + failed}/{total}...'
+        )
+    
+    results = await guild_snapshotter.restore(
+        interaction.guild, items, f'Restore from snapshot #{snap["snapshot_id"]} by {interaction.user}', progress
+    )
+    if results is None:
+        await interaction.edit_original_response(content='❌ A restore is already in progress!')
+        return
     
-    log_event(interaction.guild.id, 'lockdown_deactivated', actor_user_id=interaction.user.id)
+    lines = [f"**{stage.title()}:** {done} restored" + (f", {failed} failed" if failed else "")
+             for stage, (done, failed) in results.items()]
+    await interaction.edit_original_response(
+        content=f'✅ **Restore from snapshot #{snap["snapshot_id"]} complete.**\n' + '\n'.join(lines)
+    )
+    
+    log_event(interaction.guild.id, 'guild_restored', actor_user_id=interaction.user.id,
+             details={'snapshot_id': snap['snapshot_id'],
+                      'results': {stage: list(counts) for stage, counts in results.items()}})
 
 @bot.tree.command(name="setwelcomechannel", description="Set the channel where welcome messages will be sent")
 @app_commands.describe(channel="The channel for welcome messages")
 @app_commands.checks.has_permissions(administrator=True)
 async def set_welcome_channel(interaction: discord.Interaction, channel: discord.TextChannel):
-    conn = get_db()
-    cur = conn.cursor()
+    async with db.cursor() as cur:
+        await cur.execute('''
+            INSERT INTO welcome_config (guild_id, channel_id)
+            VALUES (%s, %s)
+            ON CONFLICT (guild_id) DO UPDATE SET channel_id = %s
+        ''', (interaction.guild.id, channel.id, channel.id))
+        await publish_config_change(cur, interaction.guild.id, 'welcome_config')
     
-    cur.execute('''
-        INSERT INTO welcome_config (guild_id, channel_id)
-        VALUES (%s, %s)
-        ON CONFLICT (guild_id) DO UPDATE SET channel_id = %s
-    ''', (interaction.guild.id, channel.id, channel.id))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    await config_cache.refresh(interaction.guild.id, 'welcome_config')
     
     await interaction.response.send_message(f'✅ Welcome channel set to {channel.mention}!')
 
@@ -2040,18 +5133,15 @@ async def set_welcome_channel(interaction: discord.Interaction, channel: discord
 @app_commands.describe(message="The welcome message (use {user} for mention, {server} for server name)")
 @app_commands.checks.has_permissions(administrator=True)
 async def set_welcome_message(interaction: discord.Interaction, message: str):
-    conn = get_db()
-    cur = conn.cursor()
-    
-    cur.execute('''
-        INSERT INTO welcome_config (guild_id, message)
-        VALUES (%s, %s)
-        ON CONFLICT (guild_id) DO UPDATE SET message = %s
-    ''', (interaction.guild.id, message, message))
+    async with db.cursor() as cur:
+        await cur.execute('''
+            INSERT INTO welcome_config (guild_id, message)
+            VALUES (%s, %s)
+            ON CONFLICT (guild_id) DO UPDATE SET message = %s
+        ''', (interaction.guild.id, message, message))
+        await publish_config_change(cur, interaction.guild.id, 'welcome_config')
     
-    conn.commit()
-    cur.close()
-    conn.close()
+    await config_cache.refresh(interaction.guild.id, 'welcome_config')
     
     await interaction.response.send_message(f'✅ Welcome message set!')
 
@@ -2059,32 +5149,22 @@ async def set_welcome_message(interaction: discord.Interaction, message: str):
 @app_commands.describe(role="The role to auto-assign")
 @app_commands.checks.has_permissions(administrator=True)
 async def set_auto_role(interaction: discord.Interaction, role: discord.Role):
-    conn = get_db()
-    cur = conn.cursor()
+    async with db.cursor() as cur:
+        await cur.execute('''
+            INSERT INTO welcome_config (guild_id, auto_role_id)
+            VALUES (%s, %s)
+            ON CONFLICT (guild_id) DO UPDATE SET auto_role_id = %s
+        ''', (interaction.guild.id, role.id, role.id))
+        await publish_config_change(cur, interaction.guild.id, 'welcome_config')
     
-    cur.execute('''
-        INSERT INTO welcome_config (guild_id, auto_role_id)
-        VALUES (%s, %s)
-        ON CONFLICT (guild_id) DO UPDATE SET auto_role_id = %s
-    ''', (interaction.guild.id, role.id, role.id))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    await config_cache.refresh(interaction.guild.id, 'welcome_config')
     
     await interaction.response.send_message(f'✅ Auto-role set to {role.mention}!')
 
 @bot.tree.command(name="testwelcome", description="Test the welcome message")
 @app_commands.checks.has_permissions(administrator=True)
 async def test_welcome(interaction: discord.Interaction):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT * FROM welcome_config WHERE guild_id = %s', (interaction.guild.id,))
-    config = cur.fetchone()
-    
-    cur.close()
-    conn.close()
+    config = await config_cache.get('welcome_config', interaction.guild.id)
     
     if not config or not config['channel_id']:
         await interaction.response.send_message('❌ Welcome channel not configured!')
@@ -2114,18 +5194,12 @@ async def test_welcome(interaction: discord.Interaction):
 ])
 @app_commands.checks.has_permissions(administrator=True)
 async def set_training_channel(interaction: discord.Interaction, training_type: str, channel: discord.TextChannel):
-    conn = get_db()
-    cur = conn.cursor()
-    
-    cur.execute('''
-        INSERT INTO training_config (guild_id, training_type, channel_id)
-        VALUES (%s, %s, %s)
-        ON CONFLICT (guild_id, training_type) DO UPDATE SET channel_id = %s
-    ''', (interaction.guild.id, training_type, channel.id, channel.id))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with db.cursor() as cur:
+        await cur.execute('''
+            INSERT INTO training_config (guild_id, training_type, channel_id)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (guild_id, training_type) DO UPDATE SET channel_id = %s
+        ''', (interaction.guild.id, training_type, channel.id, channel.id))
     
     training_display = training_type.replace('_', ' ').title()
     await interaction.response.send_message(f'✅ {training_display} training channel set to {channel.mention}!')
@@ -2143,18 +5217,12 @@ async def set_training_channel(interaction: discord.Interaction, training_type:
 ])
 @app_commands.checks.has_permissions(administrator=True)
 async def set_training_message(interaction: discord.Interaction, training_type: str, message: str):
-    conn = get_db()
-    cur = conn.cursor()
-    
-    cur.execute('''
-        INSERT INTO training_config (guild_id, training_type, message)
-        VALUES (%s, %s, %s)
-        ON CONFLICT (guild_id, training_type) DO UPDATE SET message = %s
-    ''', (interaction.guild.id, training_type, message, message))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with db.cursor() as cur:
+        await cur.execute('''
+            INSERT INTO training_config (guild_id, training_type, message)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (guild_id, training_type) DO UPDATE SET message = %s
+        ''', (interaction.guild.id, training_type, message, message))
     
     training_display = training_type.replace('_', ' ').title()
     await interaction.response.send_message(f'✅ {training_display} training message set!')
@@ -2190,24 +5258,18 @@ async def set_training_message(interaction: discord.Interaction, training_type:
 )
 @app_commands.checks.has_permissions(manage_guild=True)
 async def schedule_training(interaction: discord.Interaction, training_type: str, time: str):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT * FROM training_config WHERE guild_id = %s AND training_type = %s',
-                (interaction.guild.id, training_type))
-    config = cur.fetchone()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('SELECT * FROM training_config WHERE guild_id = %s AND training_type = %s',
+                    (interaction.guild.id, training_type))
+        config = cur.fetchone()
     
     if not config or not config['channel_id']:
         training_display = training_type.replace('_', ' ').title()
-        cur.close()
-        conn.close()
         await interaction.response.send_message(f'❌ {training_display} training channel not configured!')
         return
     
     channel = interaction.guild.get_channel(config['channel_id'])
     if not channel:
-        cur.close()
-        conn.close()
         await interaction.response.send_message('❌ Training channel not found!')
         return
     
@@ -2229,14 +5291,11 @@ async def schedule_training(interaction: discord.Interaction, training_type: str
     
     sent_message = await channel.send(formatted_message)
     
-    cur.execute('''
-        INSERT INTO training_messages (message_id, guild_id, channel_id, training_type, message_template, training_time, host_id)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-    ''', (sent_message.id, interaction.guild.id, channel.id, training_type, message_template, time, interaction.user.id))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with db.cursor() as cur:
+        await cur.execute('''
+            INSERT INTO training_messages (message_id, guild_id, channel_id, training_type, message_template, training_time, host_id)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ''', (sent_message.id, interaction.guild.id, channel.id, training_type, message_template, time, interaction.user.id))
     
     await interaction.response.send_message(f'✅ {training_display} training scheduled and posted to {channel.mention}!')
 
@@ -2244,18 +5303,12 @@ async def schedule_training(interaction: discord.Interaction, training_type: str
 @app_commands.describe(role="The role for training helpers")
 @app_commands.checks.has_permissions(administrator=True)
 async def set_helper_role(interaction: discord.Interaction, role: discord.Role):
-    conn = get_db()
-    cur = conn.cursor()
-    
-    cur.execute('''
-        INSERT INTO training_roles (guild_id, helper_role_id)
-        VALUES (%s, %s)
-        ON CONFLICT (guild_id) DO UPDATE SET helper_role_id = %s
-    ''', (interaction.guild.id, role.id, role.id))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with db.cursor() as cur:
+        await cur.execute('''
+            INSERT INTO training_roles (guild_id, helper_role_id)
+            VALUES (%s, %s)
+            ON CONFLICT (guild_id) DO UPDATE SET helper_role_id = %s
+        ''', (interaction.guild.id, role.id, role.id))
     
     await interaction.response.send_message(f'✅ Training helper role set to {role.mention}!')
 
@@ -2266,21 +5319,15 @@ async def set_helper_role(interaction: discord.Interaction, role: discord.Role):
 )
 @app_commands.checks.has_permissions(manage_guild=True)
 async def warn(interaction: discord.Interaction, user: discord.Member, reason: str):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT COUNT(*) as count FROM warnings WHERE guild_id = %s AND user_id = %s',
-                (interaction.guild.id, user.id))
-    warning_count = cur.fetchone()['count'] + 1
-    
-    cur.execute('''
-        INSERT INTO warnings (guild_id, user_id, warning_number, reason, issued_by)
-        VALUES (%s, %s, %s, %s, %s)
-    ''', (interaction.guild.id, user.id, warning_count, reason, interaction.user.id))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('SELECT COUNT(*) as count FROM warnings WHERE guild_id = %s AND user_id = %s',
+                    (interaction.guild.id, user.id))
+        warning_count = cur.fetchone()['count'] + 1
+        
+        await cur.execute('''
+            INSERT INTO warnings (guild_id, user_id, warning_number, reason, issued_by)
+            VALUES (%s, %s, %s, %s, %s)
+        ''', (interaction.guild.id, user.id, warning_count, reason, interaction.user.id))
     
     log_event(interaction.guild.id, 'warning_issued', target_user_id=user.id, actor_user_id=interaction.user.id,
              details={'reason': reason, 'warning_number': warning_count})
@@ -2301,16 +5348,11 @@ async def warn(interaction: discord.Interaction, user: discord.Member, reason: s
 @app_commands.describe(user="The user to clear warnings for")
 @app_commands.checks.has_permissions(administrator=True)
 async def clear_warnings(interaction: discord.Interaction, user: discord.Member):
-    conn = get_db()
-    cur = conn.cursor()
-    
-    cur.execute('DELETE FROM warnings WHERE guild_id = %s AND user_id = %s',
-                (interaction.guild.id, user.id))
-    
-    deleted_count = cur.rowcount
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with db.cursor() as cur:
+        await cur.execute('DELETE FROM warnings WHERE guild_id = %s AND user_id = %s',
+                    (interaction.guild.id, user.id))
+        
+        deleted_count = cur.rowcount
     
     log_event(interaction.guild.id, 'warnings_cleared', target_user_id=user.id, actor_user_id=interaction.user.id,
              details={'count': deleted_count})
@@ -2320,15 +5362,10 @@ async def clear_warnings(interaction: discord.Interaction, user: discord.Member)
 @bot.tree.command(name="viewwarnings", description="View warnings for a user")
 @app_commands.describe(user="The user to check warnings for")
 async def view_warnings(interaction: discord.Interaction, user: discord.Member):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT * FROM warnings WHERE guild_id = %s AND user_id = %s ORDER BY issued_at DESC',
-                (interaction.guild.id, user.id))
-    warnings = cur.fetchall()
-    
-    cur.close()
-    conn.close()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('SELECT * FROM warnings WHERE guild_id = %s AND user_id = %s ORDER BY issued_at DESC',
+                    (interaction.guild.id, user.id))
+        warnings = cur.fetchall()
     
     if not warnings:
         await interaction.response.send_message(f'{user.mention} has no warnings!', ephemeral=True)
@@ -2368,18 +5405,12 @@ async def view_warnings(interaction: discord.Interaction, user: discord.Member):
 ])
 @app_commands.checks.has_permissions(administrator=True)
 async def set_award_channel(interaction: discord.Interaction, award_type: str, channel: discord.TextChannel):
-    conn = get_db()
-    cur = conn.cursor()
-    
-    cur.execute('''
-        INSERT INTO monthly_awards (guild_id, award_type, channel_id)
-        VALUES (%s, %s, %s)
-        ON CONFLICT (guild_id, award_type) DO UPDATE SET channel_id = %s
-    ''', (interaction.guild.id, award_type, channel.id, channel.id))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with db.cursor() as cur:
+        await cur.execute('''
+            INSERT INTO monthly_awards (guild_id, award_type, channel_id)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (guild_id, award_type) DO UPDATE SET channel_id = %s
+        ''', (interaction.guild.id, award_type, channel.id, channel.id))
     
     award_display = "Employee of the Month" if award_type == "employee" else "Agent of the Month"
     await interaction.response.send_message(f'✅ {award_display} channel set to {channel.mention}!')
@@ -2395,18 +5426,12 @@ async def set_award_channel(interaction: discord.Interaction, award_type: str, c
 ])
 @app_commands.checks.has_permissions(administrator=True)
 async def set_award_message(interaction: discord.Interaction, award_type: str, message: str):
-    conn = get_db()
-    cur = conn.cursor()
-    
-    cur.execute('''
-        INSERT INTO monthly_awards (guild_id, award_type, message)
-        VALUES (%s, %s, %s)
-        ON CONFLICT (guild_id, award_type) DO UPDATE SET message = %s
-    ''', (interaction.guild.id, award_type, message, message))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with db.cursor() as cur:
+        await cur.execute('''
+            INSERT INTO monthly_awards (guild_id, award_type, message)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (guild_id, award_type) DO UPDATE SET message = %s
+        ''', (interaction.guild.id, award_type, message, message))
     
     award_display = "Employee of the Month" if award_type == "employee" else "Agent of the Month"
     await interaction.response.send_message(f'✅ {award_display} message set!')
@@ -2422,15 +5447,10 @@ async def set_award_message(interaction: discord.Interaction, award_type: str, m
 ])
 @app_commands.checks.has_permissions(administrator=True)
 async def send_monthly_award(interaction: discord.Interaction, award_type: str, winner: discord.Member):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT * FROM monthly_awards WHERE guild_id = %s AND award_type = %s',
-                (interaction.guild.id, award_type))
-    config = cur.fetchone()
-    
-    cur.close()
-    conn.close()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('SELECT * FROM monthly_awards WHERE guild_id = %s AND award_type = %s',
+                    (interaction.guild.id, award_type))
+        config = cur.fetchone()
     
     if not config or not config['channel_id']:
         await interaction.response.send_message('❌ Award channel not configured!')
@@ -2465,20 +5485,14 @@ async def send_monthly_award(interaction: discord.Interaction, award_type: str,
 )
 @app_commands.checks.has_permissions(administrator=True)
 async def create_reaction_role(interaction: discord.Interaction, group_name: str, description: str, exclusive: bool = True):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('''
-        INSERT INTO reaction_role_groups (guild_id, group_name, description, is_exclusive)
-        VALUES (%s, %s, %s, %s)
-        RETURNING id
-    ''', (interaction.guild.id, group_name, description, exclusive))
-    
-    group_id = cur.fetchone()['id']
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('''
+            INSERT INTO reaction_role_groups (guild_id, group_name, description, is_exclusive)
+            VALUES (%s, %s, %s, %s)
+            RETURNING id
+        ''', (interaction.guild.id, group_name, description, exclusive))
+        
+        group_id = cur.fetchone()['id']
     
     await interaction.response.send_message(
         f'✅ Created reaction role group "{group_name}" (ID: {group_id})!\n'
@@ -2500,27 +5514,20 @@ async def create_reaction_role(interaction: discord.Interaction, group_name: str
 ])
 @app_commands.checks.has_permissions(administrator=True)
 async def add_reaction_role_option(interaction: discord.Interaction, group_id: int, role: discord.Role, button_label: str, button_style: str = "primary"):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT * FROM reaction_role_groups WHERE id = %s AND guild_id = %s', (group_id, interaction.guild.id))
-    group = cur.fetchone()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('SELECT * FROM reaction_role_groups WHERE id = %s AND guild_id = %s', (group_id, interaction.guild.id))
+        group = cur.fetchone()
+        
+        if group:
+            await cur.execute('''
+                INSERT INTO reaction_role_options (group_id, role_id, button_label, button_style)
+                VALUES (%s, %s, %s, %s)
+            ''', (group_id, role.id, button_label, button_style))
     
     if not group:
-        cur.close()
-        conn.close()
         await interaction.response.send_message(f'❌ Reaction role group with ID {group_id} not found!')
         return
     
-    cur.execute('''
-        INSERT INTO reaction_role_options (group_id, role_id, button_label, button_style)
-        VALUES (%s, %s, %s, %s)
-    ''', (group_id, role.id, button_label, button_style))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
-    
     await interaction.response.send_message(f'✅ Added {role.mention} to group "{group["group_name"]}" with button "{button_label}"!')
 
 @bot.tree.command(name="postreactionrole", description="Post the reaction role message with buttons")
@@ -2532,24 +5539,20 @@ async def add_reaction_role_option(interaction: discord.Interaction, group_id: i
 async def post_reaction_role(interaction: discord.Interaction, group_id: int, channel: discord.TextChannel = None):
     target_channel = channel or interaction.channel
     
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT * FROM reaction_role_groups WHERE id = %s AND guild_id = %s', (group_id, interaction.guild.id))
-    group = cur.fetchone()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('SELECT * FROM reaction_role_groups WHERE id = %s AND guild_id = %s', (group_id, interaction.guild.id))
+        group = cur.fetchone()
+        
+        options = []
+        if group:
+            await cur.execute('SELECT * FROM reaction_role_options WHERE group_id = %s', (group_id,))
+            options = cur.fetchall()
     
     if not group:
-        cur.close()
-        conn.close()
         await interaction.response.send_message(f'❌ Reaction role group with ID {group_id} not found!')
         return
     
-    cur.execute('SELECT * FROM reaction_role_options WHERE group_id = %s', (group_id,))
-    options = cur.fetchall()
-    
     if not options:
-        cur.close()
-        conn.close()
         await interaction.response.send_message(f'❌ No role options configured for this group! Use `/addreactionroleoption` first.')
         return
     
@@ -2568,38 +5571,38 @@ async def post_reaction_role(interaction: discord.Interaction, group_id: int, ch
     
     message = await target_channel.send(embed=embed, view=view)
     
-    cur.execute('''
-        UPDATE reaction_role_groups 
-        SET message_id = %s, channel_id = %s 
-        WHERE id = %s
-    ''', (message.id, target_channel.id, group_id))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with db.cursor() as cur:
+        await cur.execute('''
+            UPDATE reaction_role_groups 
+            SET message_id = %s, channel_id = %s 
+            WHERE id = %s
+        ''', (message.id, target_channel.id, group_id))
     
     await interaction.response.send_message(f'✅ Reaction role message posted in {target_channel.mention}!')
 
 @bot.tree.command(name="listreactionroles", description="List all reaction role groups in this server")
 @app_commands.checks.has_permissions(administrator=True)
 async def list_reaction_roles(interaction: discord.Interaction):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT * FROM reaction_role_groups WHERE guild_id = %s', (interaction.guild.id,))
-    groups = cur.fetchall()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('SELECT * FROM reaction_role_groups WHERE guild_id = %s', (interaction.guild.id,))
+        groups = cur.fetchall()
+        
+        await cur.execute('''
+            SELECT o.group_id, COUNT(*) as count FROM reaction_role_options o
+            JOIN reaction_role_groups g ON g.id = o.group_id
+            WHERE g.guild_id = %s
+            GROUP BY o.group_id
+        ''', (interaction.guild.id,))
+        option_counts = {row['group_id']: row['count'] for row in cur.fetchall()}
     
     if not groups:
-        cur.close()
-        conn.close()
         await interaction.response.send_message('No reaction role groups configured yet!')
         return
     
     embed = discord.Embed(title="Reaction Role Groups", color=discord.Color.blue())
     
     for group in groups:
-        cur.execute('SELECT COUNT(*) as count FROM reaction_role_options WHERE group_id = %s', (group['id'],))
-        option_count = cur.fetchone()['count']
+        option_count = option_counts.get(group['id'], 0)
         
         status = "✅ Posted" if group['message_id'] else "⚠️ Not posted"
         exclusive = "Yes" if group['is_exclusive'] else "No"
@@ -2610,24 +5613,17 @@ async def list_reaction_roles(interaction: discord.Interaction):
             inline=False
         )
     
-    cur.close()
-    conn.close()
-    
     await interaction.response.send_message(embed=embed)
 
 @bot.tree.command(name="deletereactionrole", description="Delete a reaction role group")
 @app_commands.describe(group_id="The ID of the reaction role group to delete")
 @app_commands.checks.has_permissions(administrator=True)
 async def delete_reaction_role(interaction: discord.Interaction, group_id: int):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT * FROM reaction_role_groups WHERE id = %s AND guild_id = %s', (group_id, interaction.guild.id))
-    group = cur.fetchone()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('SELECT * FROM reaction_role_groups WHERE id = %s AND guild_id = %s', (group_id, interaction.guild.id))
+        group = cur.fetchone()
     
     if not group:
-        cur.close()
-        conn.close()
         await interaction.response.send_message(f'❌ Reaction role group with ID {group_id} not found!')
         return
     
@@ -2640,25 +5636,17 @@ async def delete_reaction_role(interaction: discord.Interaction, group_id: int):
         except:
             pass
     
-    cur.execute('DELETE FROM reaction_role_groups WHERE id = %s', (group_id,))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with db.cursor() as cur:
+        await cur.execute('DELETE FROM reaction_role_groups WHERE id = %s', (group_id,))
     
     await interaction.response.send_message(f'✅ Deleted reaction role group "{group["group_name"]}"!')
 
 @bot.tree.command(name="testreactionrole", description="Test the reaction role system")
 @app_commands.checks.has_permissions(administrator=True)
 async def test_reaction_role(interaction: discord.Interaction):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cur.execute('SELECT COUNT(*) as count FROM reaction_role_groups WHERE guild_id = %s', (interaction.guild.id,))
-    group_count = cur.fetchone()['count']
-    
-    cur.close()
-    conn.close()
+    async with db.cursor(dict_rows=True) as cur:
+        await cur.execute('SELECT COUNT(*) as count FROM reaction_role_groups WHERE guild_id = %s', (interaction.guild.id,))
+        group_count = cur.fetchone()['count']
     
     embed = discord.Embed(title="Reaction Role System Test", color=discord.Color.green())
     embed.add_field(name="Status", value="✅ Reaction role system is operational!", inline=False)
@@ -2700,6 +5688,212 @@ async def wakeup(interaction: discord.Interaction):
     await bot.change_presence(status=discord.Status.online, activity=discord.Game(name="Managing the Agency"))
     await interaction.response.send_message('✅ Bot is now online!')
 
+@bot.tree.command(name="configautomod", description="Configure spam, mass-mention and link flood protection")
+@app_commands.describe(
+    enabled="Turn automod on or off",
+    max_messages=f"Messages allowed per {AUTOMOD_WINDOWS['messages']} seconds (0 for no limit, default: 8)",
+    max_mentions=f"Mentions allowed per {AUTOMOD_WINDOWS['mentions']} seconds (0 for no limit, default: 10)",
+    max_duplicates=f"Repeated messages allowed per {AUTOMOD_WINDOWS['duplicates']} seconds (0 for no limit, default: 3)",
+    max_links=f"Links allowed per {AUTOMOD_WINDOWS['links']} seconds (0 for no limit, default: 5)",
+    timeout_minutes="How long to time out spammers (0 to only delete messages, default: 10)",
+    spam_wave_accounts="Act when more than this many accounts post the same message (0 to turn off, default: 4)",
+    spam_wave_seconds=f"Within this many seconds (default: 30, at most {CROSS_SPAM_MAX_WINDOW})",
+    exempt_roles="Roles automod ignores, e.g. @Moderator @Bots (use 'none' to clear)"
+)
+@app_commands.checks.has_permissions(administrator=True)
+async def config_automod(interaction: discord.Interaction,
+                         enabled: bool = None,
+                         max_messages: int = None,
+                         max_mentions: int = None,
+                         max_duplicates: int = None,
+                         max_links: int = None,
+                         timeout_minutes: int = None,
+                         spam_wave_accounts: int = None,
+                         spam_wave_seconds: int = None,
+                         exempt_roles: str = None):
+    updates = []
+    params = []
+    
+    if enabled is not None:
+        updates.append("enabled = %s")
+        params.append(enabled)
+    if spam_wave_seconds is not None:
+        spam_wave_seconds = min(spam_wave_seconds, CROSS_SPAM_MAX_WINDOW)
+    for column, value in (('max_messages', max_messages), ('max_mentions', max_mentions),
+                          ('max_duplicates', max_duplicates), ('max_links', max_links),
+                          ('timeout_minutes', timeout_minutes), ('cross_user_limit', spam_wave_accounts),
+                          ('cross_user_window', spam_wave_seconds)):
+        if value is not None:
+            updates.append(f"{column} = %s")
+            params.append(max(0, value))
+    if exempt_roles is not None:
+        role_ids = [int(role_id) for role_id in re.findall(r'\d{15,20}', exempt_roles)
+                    if interaction.guild.get_role(int(role_id))]
+        updates.append("exempt_role_ids = %s")
+        params.append(','.join(str(role_id) for role_id in role_ids) or None)
+    
+    async with db.cursor() as cur:
+        await cur.execute('''
+            INSERT INTO automod_config (guild_id) VALUES (%s)
+            ON CONFLICT (guild_id) DO NOTHING
+        ''', (interaction.guild.id,))
+        
+        if updates:
+            params.append(interaction.guild.id)
+            await cur.execute(f'''
+                UPDATE automod_config SET {", ".join(updates)}
+                WHERE guild_id = %s
+            ''', params)
+        
+        await publish_config_change(cur, interaction.guild.id, 'automod_config')
+    
+    config = await config_cache.refresh(interaction.guild.id, 'automod_config')
+    
+    def limit_text(name):
+        limit = config[AUTOMOD_LIMIT_COLUMNS[name]]
+        return f"{limit} per {AUTOMOD_WINDOWS[name]}s" if limit else "No limit"
+    
+    embed = discord.Embed(
+        title="🤖 Automod Configuration Updated",
+        description=f"{'✅ Enabled' if config['enabled'] else '❌ Disabled'}",
+        color=discord.Color.blue(),
+        timestamp=datetime.now()
+    )
+    embed.add_field(name="Messages", value=limit_text('messages'), inline=True)
+    embed.add_field(name="Mentions", value=limit_text('mentions'), inline=True)
+    embed.add_field(name="Repeats", value=limit_text('duplicates'), inline=True)
+    embed.add_field(name="Links", value=limit_text('links'), inline=True)
+    embed.add_field(
+        name="Timeout",
+        value=f"{config['timeout_minutes']} minutes" if config['timeout_minutes'] else "Delete only",
+        inline=True
+    )
+    embed.add_field(
+        name="Spam Waves",
+        value=(f"More than {config['cross_user_limit']} accounts in {config['cross_user_window']}s"
+               if config['cross_user_limit'] and config['cross_user_window'] else "Off"),
+        inline=True
+    )
+    embed.add_field(
+        name="Exempt Roles",
+        value=', '.join(f'<@&{role_id}>' for role_id in parse_id_list(config['exempt_role_ids'])) or 'None (plus Manage Messages)',
+        inline=False
+    )
+    
+    await interaction.response.send_message(embed=embed)
+
+@bot.tree.command(name="addnamepattern", description="Flag joiners whose names match a pattern")
+@app_commands.describe(
+    pattern="Text to look for in names, e.g. discord.gg or a shared suffix",
+    regex="Treat the pattern as a regular expression (no named groups, backreferences or nested repeats)",
+    weight="How much a match adds to the join's suspicion score (default: 1)"
+)
+@app_commands.checks.has_permissions(manage_guild=True)
+async def add_name_pattern(interaction: discord.Interaction, pattern: str, regex: bool = False, weight: int = 1):
+    problem = name_pattern_problem(pattern) if regex else None
+    if problem:
+        await interaction.response.send_message(f'❌ Can\'t use this pattern: {problem}', ephemeral=True)
+        return
+    if weight < 1:
+        await interaction.response.send_message('❌ Weight must be at least 1!', ephemeral=True)
+        return
+    
+    async with db.cursor() as cur:
+        await cur.execute('''
+            INSERT INTO name_patterns (guild_id, pattern, is_regex, weight, created_by)
+            VALUES (%s, %s, %s, %s, %s) RETURNING id
+        ''', (interaction.guild.id, pattern, regex, weight, interaction.user.id))
+        pattern_id = cur.fetchone()[0]
+        await publish_config_change(cur, interaction.guild.id, 'name_patterns')
+    
+    await config_cache.refresh(interaction.guild.id, 'name_patterns')
+    
+    await interaction.response.send_message(
+        f'✅ Added name pattern **#{pattern_id}**: `{pattern}`{" (regex)" if regex else ""}, weight {weight}.',
+        ephemeral=True
+    )
+
+@bot.tree.command(name="removenamepattern", description="Stop flagging a name pattern")
+@app_commands.describe(pattern_id="Pattern number from /namepatterns")
+@app_commands.checks.has_permissions(manage_guild=True)
+async def remove_name_pattern(interaction: discord.Interaction, pattern_id: int):
+    async with db.cursor() as cur:
+        await cur.execute('''
+            DELETE FROM name_patterns WHERE guild_id = %s AND id = %s
+        ''', (interaction.guild.id, pattern_id))
+        deleted = cur.rowcount
+        await publish_config_change(cur, interaction.guild.id, 'name_patterns')
+    
+    await config_cache.refresh(interaction.guild.id, 'name_patterns')
+    
+    if deleted:
+        await interaction.response.send_message(f'✅ Removed name pattern #{pattern_id}.', ephemeral=True)
+    else:
+        await interaction.response.send_message('❌ Pattern not found!', ephemeral=True)
+
+@bot.tree.command(name="namepatterns", description="List the name patterns flagged on join")
+@app_commands.checks.has_permissions(manage_guild=True)
+async def name_patterns_list(interaction: discord.Interaction):
+    rows = await config_cache.get('name_patterns', interaction.guild.id) or []
+    
+    embed = discord.Embed(
+        title="🏷️ Name Patterns",
+        description="\n".join(
+            f"**#{row['id']}** `{row['pattern']}`{' (regex)' if row['is_regex'] else ''} - weight {row['weight']}"
+            for row in rows
+        )[:4096] or "No patterns yet. Add one with /addnamepattern.",
+        color=discord.Color.blue(),
+        timestamp=datetime.now()
+    )
+    embed.set_footer(text="Matches raise a join's suspicion score (anti-raid must be on)")
+    
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="reloadblocklist", description="Reload the blocklist file now (Admin only)")
+@app_commands.checks.has_permissions(administrator=True)
+async def reload_blocklist(interaction: discord.Interaction):
+    try:
+        count = await blocklist.reload()
+    except OSError as e:
+        await interaction.response.send_message(f'❌ Could not read `{blocklist.path}`: {e}', ephemeral=True)
+        return
+    
+    await interaction.response.send_message(
+        f'✅ Loaded **{count}** blocklist entries ({blocklist.memory_bytes // 1024} KB in memory).',
+        ephemeral=True
+    )
+
+@bot.tree.command(name="botmetrics", description="Show internal performance metrics (Admin only)")
+@app_commands.checks.has_permissions(administrator=True)
+async def bot_metrics(interaction: discord.Interaction):
+    counters, timings = metrics.snapshot()
+    
+    embed = discord.Embed(
+        title="📈 Bot Metrics",
+        color=discord.Color.blue(),
+        timestamp=datetime.now()
+    )
+    
+    if timings:
+        lines = [
+            f"`{name}` - {count} calls, avg {avg_ms:.1f} ms, max {max_ms:.1f} ms"
+            for name, (count, avg_ms, max_ms) in sorted(timings.items())
+        ]
+        embed.add_field(name="Latency", value="\n".join(lines)[:1024], inline=False)
+    
+    if counters:
+        lines = [f"`{name}` - {value}" for name, value in sorted(counters.items())]
+        embed.add_field(name="Counters", value="\n".join(lines)[:1024], inline=False)
+    
+    embed.add_field(
+        name="Database Pool",
+        value=f"Size: {db.min_size}-{db.max_size} connections\nAcquire timeout: {db.acquire_timeout}s\n"
+              f"Slow query threshold: {DB_SLOW_QUERY_MS:.0f} ms",
+        inline=False
+    )
+    
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
 @bot.tree.command(name="purge", description="Delete multiple messages at once")
 @app_commands.describe(
     amount="Number of messages to delete (1-100)",
@@ -2759,8 +5953,13 @@ async def security_guide(interaction: discord.Interaction):
               "**Customize:** Set how many joins trigger an alert\n"
               "• `/configsecurity raid_threshold:10` - Alert if 10+ people join\n"
               "• `/configsecurity raid_window:60` - Within 60 seconds\n"
+              "• `/configsecurity extra_windows:10:8,600:50` - Also alert on 8 joins in 10s or 50 in 10 minutes\n"
               "• `/configsecurity min_account_age:7` - Flag accounts under 7 days old\n"
-              "**Auto-lockdown:** `/configsecurity auto_lockdown:True` to automatically lock the server during a raid",
+              "• `/configsecurity wave_size:10 wave_minutes:10` - Alert when 10 joiners' accounts were all made within 10 minutes\n"
+              "• `/configsecurity blocklist_action:Ban` - Ban accounts on the blocklist file as they join\n"
+              "• `/addnamepattern pattern:discord.gg` - Flag joiners with names like this\n"
+              "**Auto-lockdown:** `/configsecurity auto_lockdown:True` to automatically lock the server during a raid (needs a Director role from /setlockdownconfig)\n"
+              "**Raid mode:** Welcomes and auto-roles pause during a raid and catch up afterwards (`pause_welcomes:False` to turn off)",
         inline=False
     )
     
@@ -2768,11 +5967,32 @@ async def security_guide(interaction: discord.Interaction):
         name="3️⃣ Permission Guard",
         value="**What it does:** Monitors when someone changes important role permissions\n"
               "**Setup:** `/configsecurity permission_guard:True`\n"
-              "**Tracks:** Administrator, Manage Server, Manage Roles, Manage Channels, Kick/Ban permissions\n"
+              "**Tracks:** Administrator, Manage Server, Manage Roles, Manage Channels, Webhooks, Messages, Kick/Ban/Timeout and @everyone pings\n"
+              "**Customize:** `/configsecurity watched_permissions:administrator,ban_members`\n"
+              "**Auto-Revert:** `/configsecurity auto_revert:True trusted_roles:@Admin` undoes changes by anyone else\n"
               "**Alerts:** Sends warnings when dangerous permissions are modified",
         inline=False
     )
     
+    embed.add_field(
+        name="🛡️ Anti-Nuke",
+        value="**What it does:** Stops anyone who deletes channels or roles, bans, kicks or makes webhooks too fast\n"
+              "**Setup:** `/configsecurity anti_nuke:True`\n"
+              "**Customize:** `/configsecurity nuke_limits:channel_delete:3/10,ban:5/10` - 3 channel deletes or 5 bans in 10 seconds\n"
+              "**Response:** Takes away their roles and times them out for 1 hour (trusted roles are left alone)",
+        inline=False
+    )
+    
+    embed.add_field(
+        name="🤖 Automod",
+        value="**What it does:** Deletes spam floods, mass pings, repeated messages and link spam, then times out the sender\n"
+              "**Setup:** `/configautomod enabled:True`\n"
+              "**Customize:** `/configautomod max_messages:8 max_mentions:10 timeout_minutes:10`\n"
+              "**Spam Waves:** `/configautomod spam_wave_accounts:4` - Clean up when 5+ accounts post the same message\n"
+              "**Ignored:** Staff with Manage Messages and roles set with `exempt_roles`",
+        inline=False
+    )
+    
     embed.add_field(
         name="4️⃣ Alert Role",
         value="**What it does:** Pings a specific role when security events happen\n"
@@ -2845,10 +6065,19 @@ async def setup_guide(interaction: discord.Interaction):
         name="⚙️ Optional: Configure Lockdown",
         value="Set up emergency lockdown for serious situations:\n"
               "`/setlockdownconfig` - Set director role and announcement channel\n"
+              "`/setlockdownconfig mode:Role` - Lock roles instead of every channel (use `/lockdownplan` to compare)\n"
               "`/configsecurity auto_lockdown:True` - Auto-lockdown during raids",
         inline=False
     )
     
+    embed.add_field(
+        name="📸 Optional: Server Backups",
+        value="The bot saves your roles and channels every hour by itself.\n"
+              "`/snapshotguild` - Save a backup now and see recent ones\n"
+              "`/restoreguild` - Rebuild roles and channels that were deleted",
+        inline=False
+    )
+    
     embed.set_footer(text="Need more details? Use /security to see what each feature does")
     
     await interaction.response.send_message(embed=embed)
@@ -2922,6 +6151,10 @@ async def commands_list(interaction: discord.Interaction):
         "`/securitystatus` - View current settings\n"
         "`/logevents` - See all trackable events\n"
         "`/configsecurity` - Configure security features\n"
+        "`/configautomod` - Configure spam protection\n"
+        "`/addnamepattern` - Flag joiners by name\n"
+        "`/removenamepattern` - Remove a name pattern\n"
+        "`/namepatterns` - List name patterns\n"
         "`/setgloballog` - Set unified log channel\n"
         "`/disablegloballog` - Disable global logging"
     ), inline=False)
@@ -2954,7 +6187,13 @@ async def commands_list(interaction: discord.Interaction):
     embed.add_field(name="🚨 **Emergency Lockdown**", value=(
         "`/setlockdownconfig` - Configure lockdown (Admin)\n"
         "`/lockdown` - Activate lockdown (Director)\n"
-        "`/unlockdown` - Deactivate lockdown (Director)"
+        "`/unlockdown` - Deactivate lockdown (Director)\n"
+        "`/lockdownplan` - Preview what lockdown would change (Manager)"
+    ), inline=False)
+    
+    embed.add_field(name="📸 **Server Backup**", value=(
+        "`/snapshotguild` - Save roles and channels now (Manager)\n"
+        "`/restoreguild` - Rebuild deleted roles and channels (Admin)"
     ), inline=False)
     
     embed.add_field(name="👋 **Welcome System**", value=(
@@ -2996,6 +6235,8 @@ async def commands_list(interaction: discord.Interaction):
         "`/setbotactivity` - Set bot status (Admin)\n"
         "`/sendembed` - Send custom embed (Admin)\n"
         "`/wakeup` - Wake up bot (Admin)\n"
+        "`/botmetrics` - Show performance metrics (Admin)\n"
+        "`/reloadblocklist` - Reload the blocklist file (Admin)\n"
         "`/purge` - Delete multiple messages (Manage Messages)\n"
         "`/commands` - Show this list"
     ), inline=False)